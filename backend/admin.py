@@ -0,0 +1,139 @@
+"""
+Consultas de los endpoints /admin.
+
+Antes llamaban a métodos del bot que ya no existen (load_messages,
+load_authorized_users...) y cargaban todos los mensajes en Python para sacar
+los chat_id distintos. Ahora todo se calcula en SQL sobre la base de datos:
+
+- un chat "autorizado" es el que tiene al menos una conexión aprobada en
+  user_connections (authorize/revoke crean y borran esas conexiones),
+- los listados agregan con GROUP BY telegram_chat_id y se paginan por clave
+  (WHERE telegram_chat_id > :after ORDER BY telegram_chat_id LIMIT n), así que
+  cada página lee solo sus filas del índice y la memoria no crece con la tabla.
+
+El total (COUNT DISTINCT) solo se calcula en la primera página.
+"""
+from sqlalchemy import select, func, exists, delete
+from sqlalchemy.exc import IntegrityError
+
+from .database import async_session, read_session, DeviceData, UserConnections, FamilyMessages
+
+
+# Tamaño de página por defecto y máximo de los listados
+ADMIN_PAGE_SIZE = 50
+ADMIN_MAX_PAGE_SIZE = 500
+
+
+def _page(rows, limit):
+    """Filas de la página y cursor de la siguiente (se piden limit + 1)"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return rows, (rows[-1].chat_id if has_more else None)
+
+
+async def list_authorized_chats(after=None, limit=ADMIN_PAGE_SIZE):
+    """Chats con dispositivos conectados: nº de dispositivos y fecha de la primera conexión"""
+    chat_id = UserConnections.telegram_chat_id
+    stmt = (
+        select(
+            chat_id.label("chat_id"),
+            func.count().label("devices"),
+            func.min(UserConnections.created_at).label("connected_since"),
+        )
+        .group_by(chat_id)
+        .order_by(chat_id)
+        .limit(limit + 1)
+    )
+    if after is not None:
+        stmt = stmt.where(chat_id > after)
+
+    async with read_session() as session:
+        rows, next_after = _page((await session.execute(stmt)).all(), limit)
+        total = None
+        if after is None:
+            total = (await session.execute(select(func.count(func.distinct(chat_id))))).scalar()
+
+    users = [
+        {
+            "chat_id": row.chat_id,
+            "devices": row.devices,
+            "connected_since": row.connected_since.isoformat() if row.connected_since else None,
+        }
+        for row in rows
+    ]
+    return {"authorized_users": users, "total": total, "next_after": next_after}
+
+
+async def list_message_senders(after=None, limit=ADMIN_PAGE_SIZE, only_unauthorized=False):
+    """Chats que han enviado mensajes familiares, con su nombre, nº de mensajes y si están autorizados"""
+    chat_id = FamilyMessages.telegram_chat_id
+    authorized = exists().where(UserConnections.telegram_chat_id == chat_id)
+    filters = []
+    if after is not None:
+        filters.append(chat_id > after)
+    if only_unauthorized:
+        filters.append(~authorized)
+
+    stmt = (
+        select(
+            chat_id.label("chat_id"),
+            func.max(FamilyMessages.sender_name).label("name"),
+            func.count().label("messages"),
+            func.max(FamilyMessages.timestamp).label("last_message_at"),
+            authorized.label("authorized"),
+        )
+        .where(*filters)
+        .group_by(chat_id)
+        .order_by(chat_id)
+        .limit(limit + 1)
+    )
+
+    async with read_session() as session:
+        rows, next_after = _page((await session.execute(stmt)).all(), limit)
+        total = None
+        if after is None:
+            count_stmt = select(func.count(func.distinct(chat_id)))
+            if only_unauthorized:
+                count_stmt = count_stmt.where(~authorized)
+            total = (await session.execute(count_stmt)).scalar()
+
+    users = [
+        {
+            "chat_id": row.chat_id,
+            "name": row.name,
+            "messages": row.messages,
+            "last_message_at": row.last_message_at.isoformat() if row.last_message_at else None,
+            "authorized": bool(row.authorized),
+        }
+        for row in rows
+    ]
+    return {"users": users, "total": total, "next_after": next_after}
+
+
+async def authorize_chat(chat_id, device_id, alias=None):
+    """
+    Conecta un chat a un dispositivo sin pasar por /connect.
+    Devuelve True si se creó, False si ya estaba conectado y None si el dispositivo no existe.
+    """
+    async with async_session() as session:
+        device = await session.get(DeviceData, device_id)
+        if device is None:
+            return None
+        session.add(UserConnections(telegram_chat_id=chat_id, device_id=device_id, alias=alias))
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            return False
+    return True
+
+
+async def revoke_chat(chat_id, device_id=None):
+    """Borra las conexiones de un chat (o solo la de un dispositivo); devuelve cuántas borró"""
+    stmt = delete(UserConnections).where(UserConnections.telegram_chat_id == chat_id)
+    if device_id:
+        stmt = stmt.where(UserConnections.device_id == device_id)
+    async with async_session() as session:
+        result = await session.execute(stmt)
+        await session.commit()
+    return result.rowcount
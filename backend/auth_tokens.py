@@ -0,0 +1,64 @@
+"""
+Tokens de sesión y enlaces mágicos guardados como resumen SHA-256.
+
+La base de datos solo guarda hash_token(token): 64 caracteres hex en una
+columna única e indexada, así que buscar un token es una consulta por índice
+sobre una clave corta y una copia filtrada de la base de datos no contiene
+tokens utilizables. Los tokens son aleatorios de 256 bits (secrets), por lo que
+no hace falta sal ni un hash lento. La comprobación del token es la propia
+búsqueda por igualdad del resumen: no hay una comparación aparte.
+
+find_active_session valida un token de sesión leyendo de una réplica (ver
+read_session en database.py) y, si no lo encuentra, del primario: una sesión
+recién creada puede no haber llegado aún a la réplica.
+"""
+import os
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+from .database import async_session, read_session, get_replica_engines, UserSession
+
+
+# last_activity solo se reescribe si tiene más de estos segundos: validar una
+# sesión no escribe en el primario en cada petición
+SESSION_ACTIVITY_RESOLUTION_SECONDS = int(os.getenv("SESSION_ACTIVITY_RESOLUTION_SECONDS", "60"))
+
+
+def new_token():
+    return secrets.token_urlsafe(32)
+
+
+def hash_token(token):
+    """Resumen de longitud fija que se guarda y se busca en la base de datos"""
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+async def find_active_session(token):
+    """Sesión verificada y no caducada del token (None si no hay), con last_activity al día"""
+    if not token:
+        return None
+    now = datetime.utcnow()
+    stmt = select(UserSession).where(
+        UserSession.token_hash == hash_token(token),
+        UserSession.verified == True,
+        UserSession.expires_at > now
+    )
+    async with read_session() as db_session:
+        session = (await db_session.execute(stmt)).scalar_one_or_none()
+    if session is None and get_replica_engines():
+        async with read_session(primary=True) as db_session:
+            session = (await db_session.execute(stmt)).scalar_one_or_none()
+    if session is None:
+        return None
+
+    if session.last_activity is None or now - session.last_activity > timedelta(seconds=SESSION_ACTIVITY_RESOLUTION_SECONDS):
+        async with async_session() as db_session:
+            await db_session.execute(
+                update(UserSession).where(UserSession.id == session.id).values(last_activity=now)
+            )
+            await db_session.commit()
+        session.last_activity = now
+    return session
@@ -0,0 +1,191 @@
+"""
+Cola (outbox) entre el bot de Telegram y el servidor web.
+
+El bot puede correr en su propio proceso (python -m backend.bot_worker), así
+que ya no escribe directamente en los WebSockets de ACTIVE_WEBSOCKETS. Los
+comandos del bot añaden un evento a la tabla bot_outbox en la misma
+transacción que sus cambios (enqueue), y cada lado lo reparte:
+
+- canal "device": el servidor web entrega el frame al WebSocket del
+  dispositivo si está conectado en este proceso (deliver_to_devices); si no,
+  el evento espera a que se conecte hasta que caduca. Al entregarlo marca el
+  dispositivo con mark_written: el GET que provoca el aviso lee del primario,
+  aunque el cambio lo escribiera el proceso del bot,
+- canal "telegram": el proceso del bot envía el mensaje al chat
+  (deliver_to_telegram), p. ej. la respuesta a una solicitud de /connect.
+
+Los eventos se reclaman en lotes con claimed_until (FOR UPDATE SKIP LOCKED en
+PostgreSQL, para varias réplicas) y delivered_at solo se marca tras enviarlos.
+Si el envío falla el evento se libera y se reintenta; si el proceso muere con
+eventos reclamados, vuelven a la cola al pasar OUTBOX_CLAIM_SECONDS. La entrega
+es al menos una vez: un corte entre el envío y la marca lo repite.
+session_gc borra los caducados.
+
+Métricas: outbox.<canal>.delivered, outbox.<canal>.errors y la espera de cada
+evento desde que se encoló en outbox.<canal>.latency.
+"""
+import os
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, update, or_
+
+from .database import async_session, mark_written, BotOutbox
+from .metrics import metrics
+from .ws_protocol import send_frame
+
+
+DEVICE = "device"
+TELEGRAM = "telegram"
+
+# Segundos entre consultas al outbox cuando no hay eventos pendientes
+OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "0.5"))
+
+# Eventos reclamados por consulta
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+
+# Segundos que un evento reclamado queda reservado antes de volver a la cola
+OUTBOX_CLAIM_SECONDS = float(os.getenv("OUTBOX_CLAIM_SECONDS", "60"))
+
+
+def enqueue(session, channel, recipient, payload):
+    """Añade un evento a la transacción de la sesión (se publica con su commit)"""
+    session.add(BotOutbox(channel=channel, recipient=str(recipient), payload=payload))
+
+
+async def enqueue_many(session, channel, recipients, payload):
+    """El mismo evento para varios destinatarios, en un único INSERT de varias filas"""
+    await session.execute(insert(BotOutbox).values([
+        {"channel": channel, "recipient": str(recipient), "payload": payload}
+        for recipient in recipients
+    ]))
+
+
+async def claim(channel, recipients=None, limit=None):
+    """Reclama (reserva durante OUTBOX_CLAIM_SECONDS) y devuelve los eventos pendientes de un canal"""
+    now = datetime.utcnow()
+    async with async_session() as session:
+        stmt = select(BotOutbox).where(
+            BotOutbox.channel == channel,
+            BotOutbox.delivered_at.is_(None),
+            BotOutbox.expires_at > now,
+            or_(BotOutbox.claimed_until.is_(None), BotOutbox.claimed_until < now)
+        )
+        if recipients is not None:
+            stmt = stmt.where(BotOutbox.recipient.in_(recipients))
+        stmt = stmt.order_by(BotOutbox.id).limit(limit or OUTBOX_BATCH_SIZE).with_for_update(skip_locked=True)
+        events = (await session.execute(stmt)).scalars().all()
+        if events:
+            await session.execute(
+                update(BotOutbox)
+                .where(BotOutbox.id.in_([e.id for e in events]))
+                .values(claimed_until=now + timedelta(seconds=OUTBOX_CLAIM_SECONDS))
+            )
+            await session.commit()
+    return events
+
+
+async def mark_delivered(event_ids):
+    """Marca como entregados eventos reclamados que ya se enviaron"""
+    if not event_ids:
+        return
+    async with async_session() as session:
+        await session.execute(
+            update(BotOutbox).where(BotOutbox.id.in_(event_ids)).values(delivered_at=datetime.utcnow())
+        )
+        await session.commit()
+
+
+async def release(event_ids):
+    """Devuelve a la cola eventos reclamados que no se pudieron entregar"""
+    if not event_ids:
+        return
+    async with async_session() as session:
+        await session.execute(update(BotOutbox).where(BotOutbox.id.in_(event_ids)).values(claimed_until=None))
+        await session.commit()
+
+
+def _delivered(channel, event):
+    metrics.inc(f"outbox.{channel}.delivered")
+    metrics.observe(f"outbox.{channel}.latency", (datetime.utcnow() - event.created_at).total_seconds())
+
+
+async def _deliver_device_events(recipient, websocket, events):
+    """Frames de un dispositivo, en orden; devuelve los ids que no se entregaron"""
+    for n, event in enumerate(events):
+        try:
+            if websocket is None:
+                raise ConnectionError("dispositivo desconectado")
+            await send_frame(websocket, event.payload)
+            _delivered(DEVICE, event)
+        except Exception as e:
+            print(f"⚠️ No se pudo entregar el evento {event.id} a {recipient}: {e}")
+            metrics.inc(f"outbox.{DEVICE}.errors")
+            return [pending.id for pending in events[n:]]
+    return []
+
+
+async def deliver_to_devices(active_websockets):
+    """Servidor web: entrega los frames pendientes de los dispositivos conectados aquí"""
+    if not active_websockets:
+        return 0
+    events = await claim(DEVICE, list(active_websockets))
+    by_device = {}
+    for event in events:
+        by_device.setdefault(event.recipient, []).append(event)
+    # El evento se encoló con el cambio que anuncia (p. ej. un mensaje de /m),
+    # quizá desde el proceso del bot: las lecturas que provoque van al primario
+    mark_written(*by_device)
+    # Dispositivos en paralelo (p. ej. un /m a varios): un WebSocket lento no retrasa al resto
+    results = await asyncio.gather(*(
+        _deliver_device_events(recipient, active_websockets.get(recipient), device_events)
+        for recipient, device_events in by_device.items()
+    ))
+    failed = {event_id for ids in results for event_id in ids}
+    await mark_delivered([event.id for event in events if event.id not in failed])
+    await release(list(failed))
+    return len(events) - len(failed)
+
+
+async def deliver_to_telegram(bot):
+    """Proceso del bot: envía los mensajes pendientes a los chats de Telegram"""
+    # Solo corre en el proceso del bot: el servidor web no carga python-telegram-bot
+    from telegram.error import BadRequest, Forbidden
+
+    events = await claim(TELEGRAM)
+    done = []
+    try:
+        for event in events:
+            try:
+                await bot.send_message(chat_id=int(event.recipient), **event.payload)
+                _delivered(TELEGRAM, event)
+                done.append(event.id)
+            except (Forbidden, BadRequest, ValueError) as e:
+                # Chat bloqueado, borrado o no válido: fallaría siempre, se descarta
+                print(f"❌ Evento {event.id} descartado para el chat {event.recipient}: {e}")
+                metrics.inc(f"outbox.{TELEGRAM}.errors")
+                done.append(event.id)
+            except Exception as e:
+                print(f"⚠️ No se pudo enviar el evento {event.id} al chat {event.recipient}: {e}")
+                metrics.inc(f"outbox.{TELEGRAM}.errors")
+    finally:
+        await mark_delivered(done)
+        # Los fallidos y los que no se llegaron a intentar (cancelación) vuelven a la cola
+        sent = set(done)
+        await release([event.id for event in events if event.id not in sent])
+    return len(done)
+
+
+async def run_dispatcher(deliver, *args, interval=None):
+    """Bucle de reparto para el lifespan de la app o del bot (se cancela al cerrar)"""
+    interval = interval or OUTBOX_POLL_SECONDS
+    while True:
+        try:
+            delivered = await deliver(*args)
+        except Exception as e:
+            print(f"❌ Error repartiendo el outbox: {e}")
+            metrics.inc("outbox.errors")
+            delivered = 0
+        # Con un lote lleno puede haber más eventos: se sigue sin esperar
+        if delivered < OUTBOX_BATCH_SIZE:
+            await asyncio.sleep(interval)
@@ -0,0 +1,73 @@
+"""
+Bot de Telegram como proceso independiente del servidor web.
+
+Con TELEGRAM_BOT_MODE=worker el servidor web no hace polling de Telegram: los
+picos de tráfico del bot ya no añaden latencia a las conversaciones de /ws y
+cada lado escala por separado (una sola instancia del bot, tantas réplicas web
+como haga falta). Ambos procesos comparten la base de datos y se comunican por
+la tabla bot_outbox (ver bot_outbox.py):
+
+- los comandos del bot encolan frames para los dispositivos, que entrega el
+  servidor web que tenga abierto su WebSocket,
+- el servidor web encola los mensajes para Telegram (respuesta a /connect) y
+  este proceso los envía.
+
+Los contadores de uso de los mensajes familiares (usage_rollups.py) se
+vuelcan desde aquí con el planificador de tareas local (scheduler.py).
+
+Uso:
+    TELEGRAM_BOT_MODE=worker uvicorn backend.main:app ...   # servidor web
+    python -m backend.bot_worker                             # bot
+
+Prueba de extremo a extremo con los dos procesos: scripts/e2e_bot_worker.py
+"""
+import os
+import sys
+import signal
+import asyncio
+
+from dotenv import load_dotenv
+
+from .database import dispose_engines
+from .migrations import verify_schema
+from .usage_rollups import usage_rollups
+from .scheduler import scheduler
+
+
+async def run_worker():
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token:
+        print("❌ TELEGRAM_BOT_TOKEN no configurado")
+        return 1
+
+    await verify_schema()
+    from .telegram_bot import FamilyMessagesBot
+    bot = FamilyMessagesBot(token)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    scheduler_task = asyncio.create_task(scheduler.run())
+    try:
+        if not await bot.start_bot():
+            return 1
+        print("🤖 Bot worker en marcha (Ctrl+C para salir)")
+        await stop.wait()
+    finally:
+        await bot.stop_bot()
+        scheduler_task.cancel()
+        await scheduler.stop()
+        await usage_rollups.flush()
+        await dispose_engines()
+    return 0
+
+
+def main():
+    load_dotenv()
+    sys.exit(asyncio.run(run_worker()))
+
+
+if __name__ == "__main__":
+    main()
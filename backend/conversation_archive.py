@@ -0,0 +1,310 @@
+"""
+Archivo en frío de los turnos antiguos de conversation_history.
+
+device_data.conversation_history guardaba hasta 1000 turnos y tiraba los más
+antiguos; los que quedaban engordaban la fila caliente que lee y reescribe
+cada turno de /ws. La tarea conversation_archive (scheduler.py, una réplica a
+la vez) mueve a disco los turnos de más de ARCHIVE_AFTER_DAYS días, y los que
+pasen de ARCHIVE_MAX_HOT_ENTRIES aunque sean recientes, para que el tope de
+1000 no se alcance y no se pierda nada.
+
+Formato, por dispositivo y mes (ARCHIVE_DIR/<sha256 del device_id>/<AAAA-MM>.seg/.idx):
+- .seg: bloques JSONL (un turno por línea) comprimidos cada uno con zlib por
+  separado, de hasta ARCHIVE_BLOCK_ENTRIES turnos; solo se añaden al final,
+- .idx: un registro fijo de 32 bytes por bloque (offset, tamaño comprimido,
+  nº de turnos, timestamp del primero y del último).
+Para leer el turno n se busca su bloque en el índice y solo se descomprime ese
+bloque, leído del .seg con mmap (acceso aleatorio sin cargar el fichero).
+
+Si el proceso muere entre escribir el bloque y su registro de índice, el
+siguiente append recorta los bytes sin indexar. Si falla la actualización de
+la fila tras escribir, el reintento no duplica turnos: se descartan los
+primeros que coinciden, turno a turno y completos, con el final ya archivado
+del mes (no se compara por timestamp, así que no se pierden turnos con el
+mismo timestamp o sin él).
+
+Como MEDIA_DIR, ARCHIVE_DIR debe ser compartido si hay varias réplicas.
+"""
+import os
+import re
+import mmap
+import hashlib
+import zlib
+import json
+import struct
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, func, or_
+
+from .database import async_session, DeviceData
+from .metrics import metrics
+from .scheduler import scheduler
+
+
+# Directorio del archivo
+script_dir = os.path.dirname(__file__)
+project_root = os.path.abspath(os.path.join(script_dir, '..'))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(project_root, "data", "archive"))
+
+# Antigüedad a partir de la cual un turno se archiva
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+
+# Turnos que se dejan como mucho en la fila caliente (por debajo del tope de 1000)
+ARCHIVE_MAX_HOT_ENTRIES = int(os.getenv("ARCHIVE_MAX_HOT_ENTRIES", "500"))
+
+# Turnos por bloque comprimido
+ARCHIVE_BLOCK_ENTRIES = int(os.getenv("ARCHIVE_BLOCK_ENTRIES", "64"))
+
+# Segundos entre pasadas del archivador y dispositivos por consulta
+ARCHIVE_INTERVAL_SECONDS = float(os.getenv("ARCHIVE_INTERVAL_SECONDS", "3600"))
+ARCHIVE_PAGE_SIZE = 100
+
+# offset, tamaño comprimido, nº de turnos, primer y último timestamp (epoch)
+INDEX_RECORD = struct.Struct("<QIIdd")
+
+_MONTH_RE = re.compile(r"^\d{4}-\d{2}$")
+
+
+def entry_time(entry):
+    try:
+        return datetime.fromisoformat(entry["timestamp"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def _entry_epoch(entry):
+    moment = entry_time(entry)
+    return moment.timestamp() if moment else 0.0
+
+
+def _overlap(tail, entries):
+    """Cuántos turnos del principio de entries son el final de tail (ya archivados)"""
+    for size in range(min(len(tail), len(entries)), 0, -1):
+        if tail[-size] == entries[0] and tail[-size:] == entries[:size]:
+            return size
+    return 0
+
+
+class ConversationArchive:
+    def __init__(self, directory=ARCHIVE_DIR):
+        self.directory = directory
+
+    def _device_dir(self, device_id):
+        # sha256 del id: "dev/1" y "dev_1" no comparten carpeta y ".." no sale de ARCHIVE_DIR
+        return os.path.join(self.directory, hashlib.sha256(device_id.encode("utf-8")).hexdigest())
+
+    def _paths(self, device_id, month):
+        if not _MONTH_RE.match(month or ""):
+            raise ValueError(f"Mes no válido: {month!r}")
+        base = os.path.join(self._device_dir(device_id), month)
+        return base + ".seg", base + ".idx"
+
+    def _index(self, idx_path):
+        """Registros (offset, tamaño, nº, primero, último) de un segmento"""
+        try:
+            with open(idx_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % INDEX_RECORD.size
+        return list(INDEX_RECORD.iter_unpack(data[:usable]))
+
+    # ---------- ESCRITURA ----------
+
+    def append(self, device_id, month, entries):
+        """Añade turnos (ordenados) al segmento del mes; devuelve cuántos escribió"""
+        seg_path, idx_path = self._paths(device_id, month)
+        os.makedirs(os.path.dirname(seg_path), exist_ok=True)
+        index = self._index(idx_path)
+        end = index[-1][0] + index[-1][1] if index else 0
+
+        # Reintento tras un fallo: lo ya archivado no se repite
+        pending = entries[_overlap(self._tail(seg_path, index, len(entries)), entries):]
+        if not pending:
+            return 0
+
+        with open(seg_path, "ab") as seg, open(idx_path, "ab") as idx:
+            # Bytes de un bloque que quedó sin indexar
+            seg.truncate(end)
+            idx.truncate(len(index) * INDEX_RECORD.size)
+            for start in range(0, len(pending), ARCHIVE_BLOCK_ENTRIES):
+                block = pending[start:start + ARCHIVE_BLOCK_ENTRIES]
+                times = [_entry_epoch(e) for e in block]
+                payload = zlib.compress(
+                    "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in block).encode("utf-8")
+                )
+                seg.write(payload)
+                seg.flush()
+                os.fsync(seg.fileno())
+                idx.write(INDEX_RECORD.pack(end, len(payload), len(block), min(times), max(times)))
+                idx.flush()
+                end += len(payload)
+        metrics.inc("archive.entries", len(pending))
+        return len(pending)
+
+    def _tail(self, seg_path, index, count):
+        """Al menos los últimos count turnos archivados del segmento (los de sus últimos bloques)"""
+        first = len(index)
+        taken = 0
+        while first > 0 and taken < count:
+            first -= 1
+            taken += index[first][2]
+        if first == len(index):
+            return []
+        tail = []
+        with open(seg_path, "rb") as f:
+            for block_offset, size, _, _, _ in index[first:]:
+                f.seek(block_offset)
+                lines = zlib.decompress(f.read(size)).decode("utf-8").splitlines()
+                tail.extend(json.loads(line) for line in lines)
+        return tail
+
+    # ---------- LECTURA ----------
+
+    def months(self, device_id):
+        """[{"month", "entries"}] de los segmentos del dispositivo, en orden"""
+        try:
+            names = os.listdir(self._device_dir(device_id))
+        except FileNotFoundError:
+            return []
+        result = []
+        for name in sorted(names):
+            month, ext = os.path.splitext(name)
+            if ext == ".idx" and _MONTH_RE.match(month):
+                count = sum(record[2] for record in self._index(os.path.join(self._device_dir(device_id), name)))
+                result.append({"month": month, "entries": count})
+        return result
+
+    def iter_month(self, device_id, month, offset=0, limit=None):
+        """Turnos del mes desde la posición offset; solo descomprime los bloques necesarios"""
+        seg_path, idx_path = self._paths(device_id, month)
+        index = self._index(idx_path)
+        if not index:
+            return
+        remaining = limit
+        position = 0
+        with open(seg_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for block_offset, size, count, _, _ in index:
+                if position + count <= offset:
+                    # Bloque entero antes de offset: ni se lee
+                    position += count
+                    continue
+                lines = zlib.decompress(mm[block_offset:block_offset + size]).decode("utf-8").splitlines()
+                for line in lines[max(offset - position, 0):]:
+                    if remaining is not None:
+                        if remaining <= 0:
+                            return
+                        remaining -= 1
+                    yield json.loads(line)
+                position += count
+
+    def iter_entries(self, device_id, start_month=None, end_month=None, offset=0, limit=None):
+        """Turnos archivados entre dos meses (incluidos), en orden, desde la posición offset"""
+        for item in self.months(device_id):
+            month = item["month"]
+            if (start_month and month < start_month) or (end_month and month > end_month):
+                continue
+            if offset >= item["entries"]:
+                # Mes entero antes de offset: basta con el índice
+                offset -= item["entries"]
+                continue
+            if limit is not None and limit <= 0:
+                return
+            taken = item["entries"] - offset if limit is None else min(limit, item["entries"] - offset)
+            yield from self.iter_month(device_id, month, offset, taken)
+            offset = 0
+            if limit is not None:
+                limit -= taken
+
+    # ---------- ARCHIVADOR ----------
+
+    @staticmethod
+    def split(history, now=None):
+        """(turnos a archivar por mes, turnos que se quedan en la fila)"""
+        now = now or datetime.now()
+        cutoff = now - timedelta(days=ARCHIVE_AFTER_DAYS)
+        keep_from = max(len(history) - ARCHIVE_MAX_HOT_ENTRIES, 0)
+        # Los turnos van en orden: se archiva el prefijo antiguo o que sobra
+        while keep_from < len(history):
+            moment = entry_time(history[keep_from])
+            if moment is None or moment >= cutoff:
+                break
+            keep_from += 1
+        archived = history[:keep_from]
+        # Un turno sin timestamp va al mes del anterior (o del siguiente) que lo
+        # tenga: así un reintento en otro mes lo vuelve a mandar al mismo segmento
+        moment = next(filter(None, map(entry_time, archived)), None) or now
+        by_month = defaultdict(list)
+        for entry in archived:
+            moment = entry_time(entry) or moment
+            by_month[moment.strftime("%Y-%m")].append(entry)
+        return by_month, history[keep_from:]
+
+    async def archive_device(self, device_id):
+        """Mueve al archivo los turnos antiguos de un dispositivo; devuelve cuántos"""
+        async with async_session() as session:
+            row = (await session.execute(
+                select(DeviceData.conversation_history, DeviceData.last_updated)
+                .where(DeviceData.device_id == device_id)
+            )).one_or_none()
+        if row is None or not isinstance(row.conversation_history, list):
+            return 0
+        by_month, remaining = self.split(row.conversation_history)
+        if not by_month:
+            return 0
+
+        for month, entries in sorted(by_month.items()):
+            await asyncio.to_thread(self.append, device_id, month, entries)
+
+        # Solo si la fila no cambió mientras tanto (si no, se repite en la próxima pasada)
+        seen = DeviceData.last_updated == row.last_updated if row.last_updated else DeviceData.last_updated.is_(None)
+        async with async_session() as session:
+            result = await session.execute(
+                update(DeviceData)
+                .where(DeviceData.device_id == device_id, seen)
+                .values(conversation_history=remaining)
+            )
+            await session.commit()
+        if result.rowcount != 1:
+            metrics.inc("archive.conflicts")
+            return 0
+        return sum(len(entries) for entries in by_month.values())
+
+    async def archive_all(self):
+        """Pasada del archivador por los dispositivos con turnos que archivar"""
+        cutoff = (datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+        history = DeviceData.conversation_history
+        # Se filtra en SQL por el primer turno y la longitud, sin cargar los historiales
+        candidates = or_(
+            history[(0, "timestamp")].as_string() < cutoff,
+            func.json_array_length(history) > ARCHIVE_MAX_HOT_ENTRIES,
+        )
+        total = 0
+        after = ""
+        while True:
+            async with async_session() as session:
+                device_ids = (await session.execute(
+                    select(DeviceData.device_id)
+                    .where(DeviceData.device_id > after, candidates)
+                    .order_by(DeviceData.device_id)
+                    .limit(ARCHIVE_PAGE_SIZE)
+                )).scalars().all()
+            for device_id in device_ids:
+                try:
+                    total += await self.archive_device(device_id)
+                except Exception as e:
+                    print(f"❌ Error archivando la conversación de {device_id}: {e}")
+                    metrics.inc("archive.errors")
+            if len(device_ids) < ARCHIVE_PAGE_SIZE:
+                break
+            after = device_ids[-1]
+        if total:
+            print(f"🗄️ {total} turno(s) de conversación archivados")
+        return total
+
+
+conversation_archive = ConversationArchive()
+
+scheduler.add_job("conversation_archive", conversation_archive.archive_all, every=ARCHIVE_INTERVAL_SECONDS)
@@ -1,19 +1,147 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, BigInteger, Boolean, ForeignKey, UniqueConstraint
+from sqlalchemy.orm import sessionmaker, declarative_base, Session
+from sqlalchemy import event, Column, Integer, Float, String, Text, Date, DateTime, JSON, BigInteger, Boolean, ForeignKey, UniqueConstraint, Index
 import os
+import time
+import itertools
 from datetime import datetime, timedelta
 import secrets
 
-# --- Configuración del motor (sin cambios) ---
-DATABASE_URL = os.getenv("DATABASE_URL", "")
-if DATABASE_URL.startswith("postgresql://"):
-    DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
-elif DATABASE_URL.startswith("postgres://"):
-    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql+asyncpg://", 1)
+from .db_instrumentation import install as install_query_counter
+from .metrics import metrics
+
+# --- Configuración del motor ---
+# El motor (y el driver asyncpg) se crean en el primer uso, no al importar:
+# así el arranque en frío es más rápido y DATABASE_URL puede venir del .env
+def get_database_url_for(database_url):
+    """URL con el driver async (asyncpg) para SQLAlchemy"""
+    if database_url.startswith("postgresql://"):
+        return database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if database_url.startswith("postgres://"):
+        return database_url.replace("postgres://", "postgresql+asyncpg://", 1)
+    return database_url
+
+
+def get_database_url():
+    return get_database_url_for(os.getenv("DATABASE_URL", ""))
+
+
+_engine = None
+_session_factory = None
+
+
+def get_engine():
+    """Motor async compartido, creado la primera vez que se necesita"""
+    global _engine
+    if _engine is None:
+        _engine = create_async_engine(get_database_url(), echo=False, future=True)
+        # Cuenta las consultas por petición/turno (ver db_instrumentation.py)
+        install_query_counter(_engine)
+    return _engine
+
+
+def async_session():
+    """Nueva sesión (se usa igual que el antiguo sessionmaker: `async with async_session()`)"""
+    global _session_factory
+    if _session_factory is None:
+        _session_factory = sessionmaker(
+            get_engine(), class_=AsyncSession, sync_session_class=WriterSession, expire_on_commit=False
+        )
+    return _session_factory()
+
+
+# --- Réplicas de lectura ---
+# Con DATABASE_REPLICA_URLS (URLs separadas por comas) las lecturas que no
+# escriben usan read_session() y se reparten por turnos entre las réplicas;
+# async_session() sigue yendo siempre al primario. Lectura de lo escrito: tras
+# escribir datos de un dispositivo, sus lecturas van al primario durante
+# READ_YOUR_WRITES_SECONDS (debe ser mayor que el retraso de las réplicas).
+# Sin réplicas configuradas read_session() es igual que async_session().
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+_replica_engines = None
+_replica_factories = []
+_replica_turn = itertools.count()
+_recent_writes = {}  # device_id -> instante (monotonic) de la última escritura
+
+
+def get_replica_urls():
+    urls = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+    return [get_database_url_for(url) for url in urls]
+
+
+def get_replica_engines():
+    """Motores de las réplicas (lista vacía si no hay), creados en el primer uso"""
+    global _replica_engines
+    if _replica_engines is None:
+        _replica_engines = [create_async_engine(url, echo=False, future=True) for url in get_replica_urls()]
+        for engine in _replica_engines:
+            install_query_counter(engine)
+            _replica_factories.append(sessionmaker(engine, class_=AsyncSession, expire_on_commit=False))
+    return _replica_engines
+
+
+def mark_written(*device_ids):
+    """Las próximas lecturas de estos dispositivos irán al primario"""
+    now = time.monotonic()
+    for device_id in device_ids:
+        if device_id:
+            _recent_writes[device_id] = now
+    # Limpieza de las marcas caducadas para que el diccionario no crezca
+    if len(_recent_writes) > 10000:
+        for device_id, written_at in list(_recent_writes.items()):
+            if now - written_at > READ_YOUR_WRITES_SECONDS:
+                del _recent_writes[device_id]
+
+
+def read_session(device_id=None, primary=False):
+    """
+    Sesión para consultas de solo lectura: una réplica, o el primario si no hay
+    réplicas, si se pide primary=True o si device_id escribió hace poco.
+    """
+    get_replica_engines()
+    written_at = _recent_writes.get(device_id) if device_id else None
+    if (
+        primary
+        or not _replica_factories
+        or (written_at is not None and time.monotonic() - written_at < READ_YOUR_WRITES_SECONDS)
+    ):
+        metrics.inc("db.reads.primary")
+        return async_session()
+    metrics.inc("db.reads.replica")
+    return _replica_factories[next(_replica_turn) % len(_replica_factories)]()
+
+
+async def dispose_engines():
+    """Cierra las conexiones del primario y de las réplicas"""
+    await get_engine().dispose()
+    for engine in get_replica_engines():
+        await engine.dispose()
+
+
+class WriterSession(Session):
+    """Sesión del primario: anota los device_id de los objetos ORM que escribe"""
+
+
+@event.listens_for(WriterSession, "after_flush")
+def _collect_written_devices(session, flush_context):
+    written = session.info.setdefault("written_devices", set())
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        device_id = getattr(obj, "device_id", None)
+        if isinstance(device_id, str):
+            written.add(device_id)
+
+
+@event.listens_for(WriterSession, "after_commit")
+def _mark_written_devices(session):
+    mark_written(*session.info.pop("written_devices", ()))
+
+
+@event.listens_for(WriterSession, "after_rollback")
+def _forget_written_devices(session):
+    session.info.pop("written_devices", None)
+
 
-engine = create_async_engine(DATABASE_URL, echo=False, future=True)
-async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 Base = declarative_base()
 
 
@@ -28,6 +156,17 @@ class Memory(Base):
     category = Column(String(50), default="personal")
     timestamp = Column(DateTime, default=datetime.utcnow)
     last_recalled = Column(DateTime, nullable=True)
+    # Extraído en segundo plano (backend/memory_enrichment.py); enriched_at NULL = pendiente
+    people = Column(JSON, nullable=True)
+    places = Column(JSON, nullable=True)
+    era = Column(String(50), nullable=True)
+    enriched_at = Column(DateTime, nullable=True)
+
+    # Recuerdos de un dispositivo ordenados por fecha (migración 2)
+    __table_args__ = (
+        Index('ix_memories_device_timestamp', 'device_id', 'timestamp'),
+        Index('ix_memories_enriched_at', 'enriched_at'),
+    )
 
 
 # --- Tabla 'device_data' (MODIFICADA) ---
@@ -57,10 +196,11 @@ class UserSession(Base):
     id = Column(String(100), primary_key=True, default=lambda: secrets.token_urlsafe(32))
     phone_number = Column(String(20), index=True, nullable=False) # Mantenemos esto para el login
     device_id = Column(String(100), index=True, nullable=True)
-    session_token = Column(String(200), unique=True, nullable=False)
+    # SHA-256 del token de sesión (auth_tokens.hash_token); el token nunca se guarda
+    token_hash = Column(String(64), unique=True, index=True, nullable=False)
     verified = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime, default=lambda: datetime.utcnow() + timedelta(days=30))
+    expires_at = Column(DateTime, index=True, default=lambda: datetime.utcnow() + timedelta(days=30))
     last_activity = Column(DateTime, default=datetime.utcnow)
 
 
@@ -71,9 +211,10 @@ class PhoneVerification(Base):
     
     id = Column(String(100), primary_key=True)
     phone_number = Column(String(20), index=True, nullable=False)
-    verification_code = Column(String(200), nullable=False) # Mantenemos el String(200)
+    # SHA-256 del código o del token del enlace mágico de /login
+    code_hash = Column(String(64), unique=True, index=True, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
-    expires_at = Column(DateTime, default=lambda: datetime.utcnow() + timedelta(minutes=10))
+    expires_at = Column(DateTime, index=True, default=lambda: datetime.utcnow() + timedelta(minutes=10))
     attempts = Column(Integer, default=0)
     verified = Column(Boolean, default=False)
 
@@ -87,7 +228,7 @@ class UserConnections(Base):
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     telegram_chat_id = Column(BigInteger, index=True, nullable=False)
-    device_id = Column(String(100), ForeignKey("device_data.device_id", ondelete="CASCADE"), nullable=False)
+    device_id = Column(String(100), ForeignKey("device_data.device_id", ondelete="CASCADE"), index=True, nullable=False)
     alias = Column(String(50), index=True) # El nombre (ej. "Mama", "Abuelo")
     created_at = Column(DateTime, default=datetime.utcnow)
     
@@ -113,11 +254,104 @@ class FamilyMessages(Base):
     message = Column(Text, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
     read = Column(Boolean, default=False)
+    # Nota de voz o foto adjunta: SHA-256 del fichero en media_store (migración 8)
+    media_hash = Column(String(64), nullable=True)
+    media_type = Column(String(16), nullable=True)  # "voice" | "photo"
+    media_size = Column(Integer, nullable=True)
+
+    # Mensajes no leídos de un dispositivo por fecha (migración 2)
+    __table_args__ = (
+        Index('ix_family_messages_device_read_timestamp', 'device_id', 'read', 'timestamp'),
+        # Listados de /admin agrupados y paginados por chat (migración 9)
+        Index('ix_family_messages_chat_timestamp', 'telegram_chat_id', 'timestamp'),
+    )
+
+
+# --- Tabla 'connection_requests' ---
+class ConnectionRequest(Base):
+    """
+    Solicitudes de /connect pendientes de aprobación en el dispositivo.
+    Sustituye al diccionario PENDING_REQUESTS: el bot y el servidor web pueden
+    estar en procesos distintos (backend/bot_worker.py).
+    """
+    __tablename__ = "connection_requests"
+
+    id = Column(String(32), primary_key=True)  # request_id que viaja en el frame
+    telegram_chat_id = Column(BigInteger, nullable=False)
+    device_id = Column(String(100), ForeignKey("device_data.device_id", ondelete="CASCADE"), index=True, nullable=False)
+    device_code = Column(String(6))
+    user_info = Column(JSON, default=lambda: {})
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, index=True, default=lambda: datetime.utcnow() + timedelta(minutes=10))
+
+
+# --- Tabla 'bot_outbox' ---
+class BotOutbox(Base):
+    """
+    Cola entre el bot de Telegram y el servidor web (ver backend/bot_outbox.py).
+    channel "device": frame para el WebSocket de recipient (device_id);
+    channel "telegram": mensaje para el chat recipient.
+    """
+    __tablename__ = "bot_outbox"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    channel = Column(String(16), nullable=False)
+    recipient = Column(String(100), nullable=False)
+    payload = Column(JSON, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    delivered_at = Column(DateTime, nullable=True)
+    # Reclamado por un repartidor hasta entonces (si muere, otro lo reintenta)
+    claimed_until = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, index=True, default=lambda: datetime.utcnow() + timedelta(days=1))
+
+    # Eventos pendientes de un canal para los destinatarios conectados
+    __table_args__ = (
+        Index('ix_bot_outbox_pending', 'channel', 'delivered_at', 'recipient'),
+    )
+
+
+# --- Tabla 'usage_daily' ---
+class UsageDaily(Base):
+    """
+    Contadores de uso por dispositivo y día, que se suman en bloque desde
+    backend/usage_rollups.py. device_id "*" guarda los totales de todos.
+    Sin ForeignKey: el histórico se conserva aunque se borre el dispositivo.
+    """
+    __tablename__ = "usage_daily"
+
+    device_id = Column(String(100), primary_key=True)
+    day = Column(Date, primary_key=True)
+    turns = Column(Integer, nullable=False, default=0)
+    memories_saved = Column(Integer, nullable=False, default=0)
+    family_messages_received = Column(Integer, nullable=False, default=0)
+    family_messages_read = Column(Integer, nullable=False, default=0)
+
+
+# --- Tabla 'scheduled_jobs' ---
+class ScheduledJob(Base):
+    """
+    Programación y lease de las tareas periódicas compartidas (ver backend/scheduler.py).
+    enabled=False pausa la tarea en todas las réplicas.
+    """
+    __tablename__ = "scheduled_jobs"
+
+    name = Column(String(100), primary_key=True)
+    schedule = Column(String(100), nullable=False)  # "every 3600s" o expresión cron
+    enabled = Column(Boolean, nullable=False, default=True)
+    next_run_at = Column(DateTime, nullable=False)
+    last_run_at = Column(DateTime, nullable=True)
+    last_duration = Column(Float, nullable=True)  # segundos
+    last_error = Column(Text, nullable=True)
+    runs = Column(Integer, nullable=False, default=0)
+    lease_owner = Column(String(100), nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
 
 
-# --- Función 'init_db' (sin cambios) ---
+# --- Función 'init_db' ---
+# Los cambios de esquema van ahora en backend/migrations.py; al arrancar solo
+# se comprueba la versión con migrations.verify_schema()
 async def init_db():
-    """Create database tables"""
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+    """Apply pending schema migrations"""
+    from .migrations import upgrade
+    await upgrade()
     print("✅ Base de datos inicializada correctamente")
\ No newline at end of file
@@ -0,0 +1,228 @@
+"""
+Contador de consultas SQL por petición HTTP, turno de /ws o comando del bot.
+
+Se engancha a los eventos del motor de SQLAlchemy y suma las sentencias, las
+transacciones y las conexiones usadas en el ámbito activo (un ContextVar, así
+que las tareas creadas dentro del ámbito también cuentan). Cada ámbito cerrado
+se registra en /metrics y avisa si supera su presupuesto de QUERY_BUDGETS.
+
+Con DB_EXPLAIN=true también guarda el texto y los parámetros de cada SELECT
+para que benchmarks/bench_query_budget.py pueda pedir su plan (EXPLAIN) y
+detectar recorridos secuenciales.
+"""
+import os
+import functools
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from .metrics import metrics
+
+
+# Guarda las sentencias SELECT de cada ámbito para poder hacer EXPLAIN después
+DB_EXPLAIN = os.getenv("DB_EXPLAIN", "false").lower() in ("1", "true", "yes")
+
+# Presupuesto de sentencias SQL por ámbito (los que no aparecen no se comprueban)
+QUERY_BUDGETS = {
+    "ws.handshake": 1,
+    "ws.turn": 7,
+    "http.get_family_messages": 2,
+    "http.get_memory_cofre": 1,
+    "http.get_authorized_users": 2,
+    "http.get_pending_requests": 2,
+    "http.authorize_user": 2,
+    "http.revoke_user": 1,
+    "http.mark_message_read": 2,
+    "http.get_usage_daily": 1,
+    "http.get_usage_summary": 1,
+    "http.export_device_data": 3,
+    "bot.connect": 4,
+    "bot.alias": 3,
+    "bot.disconnect": 1,
+    "bot.m": 3,
+    "bot.media": 3,
+    "bot.login": 2,
+}
+
+_current = ContextVar("db_query_stats", default=None)
+
+# Último resultado de cada ámbito (los nombres son fijos, no crece)
+LAST_SCOPES = {}
+
+
+class QueryStats:
+    """Sentencias, transacciones y conexiones usadas dentro de un ámbito"""
+
+    def __init__(self, name, capture=None):
+        self.name = name
+        self.capture = DB_EXPLAIN if capture is None else capture
+        self.statements = 0
+        self.begins = 0
+        self.commits = 0
+        self.rollbacks = 0
+        self.connections = 0
+        self.captured = []
+
+    @property
+    def round_trips(self):
+        # Cada sentencia y cada BEGIN/COMMIT/ROLLBACK es un viaje a la base de datos
+        return self.statements + self.begins + self.commits + self.rollbacks
+
+    @property
+    def budget(self):
+        return QUERY_BUDGETS.get(self.name)
+
+    def over_budget(self):
+        return self.budget is not None and self.statements > self.budget
+
+    def as_dict(self):
+        return {
+            "statements": self.statements,
+            "round_trips": self.round_trips,
+            "transactions": self.commits + self.rollbacks,
+            "connections": self.connections,
+            "budget": self.budget,
+        }
+
+
+# ============================================
+# EVENTOS DEL MOTOR
+# ============================================
+
+def _on_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None:
+        return
+    stats.statements += 1
+    if stats.capture and statement.lstrip().upper().startswith("SELECT"):
+        stats.captured.append((statement, parameters))
+
+
+def _counter(attribute):
+    def listener(*args):
+        stats = _current.get()
+        if stats is not None:
+            setattr(stats, attribute, getattr(stats, attribute) + 1)
+    return listener
+
+
+_installed = set()
+
+
+def install(engine):
+    """Registra los listeners en el motor (una sola vez por motor)"""
+    sync_engine = engine.sync_engine
+    if id(sync_engine) in _installed:
+        return
+    event.listen(sync_engine, "before_cursor_execute", _on_cursor_execute)
+    event.listen(sync_engine, "begin", _counter("begins"))
+    event.listen(sync_engine, "commit", _counter("commits"))
+    event.listen(sync_engine, "rollback", _counter("rollbacks"))
+    event.listen(sync_engine.pool, "checkout", _counter("connections"))
+    _installed.add(id(sync_engine))
+
+
+# ============================================
+# ÁMBITOS
+# ============================================
+
+@contextmanager
+def track(stats):
+    """Cuenta en `stats` las consultas del bloque (y de las tareas que cree)"""
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+def record(stats):
+    """Publica un ámbito terminado en /metrics y avisa si pasa de presupuesto"""
+    LAST_SCOPES[stats.name] = stats
+    metrics.inc(f"db.{stats.name}.scopes")
+    metrics.inc(f"db.{stats.name}.statements", stats.statements)
+    metrics.inc(f"db.{stats.name}.round_trips", stats.round_trips)
+    if stats.over_budget():
+        metrics.inc(f"db.{stats.name}.over_budget")
+        print(f"⚠️ {stats.name} ejecutó {stats.statements} consultas SQL (presupuesto {stats.budget})")
+
+
+@contextmanager
+def query_scope(name, capture=None):
+    """Ámbito nuevo: cuenta las consultas del bloque y lo registra al salir"""
+    stats = QueryStats(name, capture)
+    try:
+        with track(stats):
+            yield stats
+    finally:
+        record(stats)
+
+
+def counted(name):
+    """Decorador para handlers async (comandos del bot): un ámbito por llamada"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with query_scope(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class QueryCountMiddleware:
+    """Middleware ASGI: un ámbito por petición HTTP, con el nombre del endpoint"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = QueryStats("http")
+        try:
+            with track(stats):
+                await self.app(scope, receive, send)
+        finally:
+            # El router deja el endpoint en el scope; sin él (404) no se registra
+            endpoint = scope.get("endpoint")
+            if endpoint is not None:
+                stats.name = f"http.{endpoint.__name__}"
+                record(stats)
+
+
+# ============================================
+# PLANES DE EJECUCIÓN
+# ============================================
+
+def is_sequential_scan(dialect, plan):
+    """True si el plan recorre una tabla entera en vez de usar un índice"""
+    if dialect == "postgresql":
+        return any("Seq Scan" in line for line in plan)
+    # SQLite: "SCAN tabla" sin índice (los "SCAN ... USING INDEX" sí usan índice)
+    return any(line.startswith("SCAN") and "USING" not in line for line in plan)
+
+
+async def explain(engine, stats):
+    """Devuelve [(sentencia, plan, recorrido_secuencial)] de los SELECT capturados"""
+    results = []
+    async with engine.connect() as conn:
+        dialect = conn.dialect.name
+        prefix = "EXPLAIN QUERY PLAN " if dialect == "sqlite" else "EXPLAIN "
+
+        def run_explain(sync_conn, statement, parameters):
+            # Se usa el cursor DBAPI: la sentencia ya está en el formato de parámetros del driver
+            cursor = sync_conn.connection.cursor()
+            try:
+                cursor.execute(prefix + statement, parameters)
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+            # SQLite: (id, parent, notused, detalle); PostgreSQL: una columna de texto
+            return [row[-1] for row in rows]
+
+        for statement, parameters in stats.captured:
+            plan = await conn.run_sync(run_explain, statement, parameters)
+            results.append((statement, plan, is_sequential_scan(dialect, plan)))
+    return results
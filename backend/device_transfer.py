@@ -0,0 +1,374 @@
+"""
+Exportación e importación de los datos de un dispositivo en NDJSON.
+
+Sirve para que cuidadores y operadores se lleven los recuerdos, la
+conversación y los mensajes familiares de un dispositivo y los restauren en
+otro. El formato es una línea JSON por registro, con "type":
+
+- "device": cabecera con user_memory (primera línea),
+- "memory": un recuerdo (sin id: al importar se asigna uno nuevo),
+- "conversation": un turno, primero los archivados (conversation_archive.py)
+  y después los de la fila, en orden cronológico,
+- "family_message": un mensaje familiar (los adjuntos siguen en MEDIA_DIR).
+
+La exportación no carga el dispositivo entero en memoria: recuerdos y
+mensajes se leen con cursores del servidor (session.stream con yield_per) y
+el archivo por bloques de EXPORT_BATCH_SIZE turnos, usando su índice para ir
+directamente a cada bloque.
+
+La importación lee el cuerpo de la petición línea a línea, comprueba cada
+registro (campos obligatorios, tipos y fechas; un error es un 400 sin haber
+escrito nada) y lo guarda en un fichero temporal. Después escribe los turnos
+que no caben en la fila (los más antiguos que ARCHIVE_MAX_HOT_ENTRIES)
+directamente al archivo, que no repite lo ya archivado, e inserta recuerdos y
+mensajes en trozos de IMPORT_CHUNK_SIZE filas (un INSERT de varias filas por
+tabla y trozo) en una única transacción con la actualización del dispositivo:
+o se importa todo o nada. Tras el commit los recuerdos se añaden al índice
+semántico por trozos, los que no traían enriquecimiento se encolan en
+memory_enrichment y lo que sobre del historial se archiva como haría la tarea
+conversation_archive.
+
+Importar dos veces el mismo fichero completo duplica recuerdos y mensajes:
+está pensado para restaurar en un dispositivo nuevo.
+"""
+import os
+import json
+import asyncio
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select, insert
+
+from .database import async_session, read_session, mark_written, DeviceData, Memory, FamilyMessages
+from .conversation_archive import conversation_archive, ARCHIVE_MAX_HOT_ENTRIES, entry_time
+from .memory_index import memory_index
+from .memory_enrichment import memory_enrichment, index_text
+from .metrics import metrics
+
+
+# Versión del formato (cabecera "device")
+EXPORT_FORMAT = 1
+
+# Filas por lectura del cursor del servidor y turnos archivados por bloque
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+
+# Filas por INSERT de varias filas al importar
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
+
+# Longitud máxima de una línea del fichero importado
+IMPORT_MAX_LINE_BYTES = 1024 * 1024
+
+MEMORY_FIELDS = ("content", "category", "timestamp", "last_recalled", "people", "places", "era", "enriched_at")
+FAMILY_MESSAGE_FIELDS = (
+    "telegram_chat_id", "sender_name", "message", "timestamp", "read", "media_hash", "media_type", "media_size",
+)
+DATETIME_FIELDS = ("timestamp", "last_recalled", "enriched_at")
+
+# Tipo JSON de cada campo importado (None también vale si no es obligatorio)
+FIELD_TYPES = {
+    "content": str, "category": str, "people": list, "places": list, "era": str,
+    "telegram_chat_id": int, "sender_name": str, "message": str, "read": bool,
+    "media_hash": str, "media_type": str, "media_size": int,
+    "timestamp": str, "last_recalled": str, "enriched_at": str,
+}
+
+
+class DeviceImportError(ValueError):
+    """Línea del fichero importado que no se puede interpretar"""
+
+    def __init__(self, line_number, message):
+        super().__init__(f"Línea {line_number}: {message}")
+        self.line_number = line_number
+
+
+def _line(record):
+    return json.dumps(record, ensure_ascii=False, default=str) + "\n"
+
+
+def _archive_block(device_id, month, offset):
+    return list(conversation_archive.iter_month(device_id, month, offset, EXPORT_BATCH_SIZE))
+
+
+def _row_record(kind, row, fields):
+    record = {"type": kind}
+    for field in fields:
+        value = getattr(row, field)
+        record[field] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+
+# ============================================
+# EXPORTACIÓN
+# ============================================
+
+async def export_device(device_id):
+    """Generador de líneas NDJSON del dispositivo, o None si no existe"""
+    async with read_session(device_id) as session:
+        device = (await session.execute(
+            select(DeviceData.user_memory, DeviceData.conversation_history)
+            .where(DeviceData.device_id == device_id)
+        )).one_or_none()
+    if device is None:
+        return None
+    return _export_lines(device_id, device.user_memory, device.conversation_history)
+
+
+async def _export_lines(device_id, user_memory, hot_history):
+    yield _line({
+        "type": "device",
+        "format": EXPORT_FORMAT,
+        "device_id": device_id,
+        "exported_at": datetime.utcnow().isoformat(),
+        "user_memory": user_memory or {},
+    })
+
+    async with read_session(device_id) as session:
+        stmt = (
+            select(*(getattr(Memory, f) for f in MEMORY_FIELDS))
+            .where(Memory.device_id == device_id)
+            .order_by(Memory.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        result = await session.stream(stmt)
+        async for rows in result.partitions():
+            yield "".join(_line(_row_record("memory", row, MEMORY_FIELDS)) for row in rows)
+
+        # Archivo: un bloque de turnos por hilo, sin cargar el mes entero
+        for item in await asyncio.to_thread(conversation_archive.months, device_id):
+            for offset in range(0, item["entries"], EXPORT_BATCH_SIZE):
+                entries = await asyncio.to_thread(_archive_block, device_id, item["month"], offset)
+                yield "".join(_line({"type": "conversation", **entry}) for entry in entries)
+        if isinstance(hot_history, list) and hot_history:
+            yield "".join(_line({"type": "conversation", **entry}) for entry in hot_history)
+
+        stmt = (
+            select(*(getattr(FamilyMessages, f) for f in FAMILY_MESSAGE_FIELDS))
+            .where(FamilyMessages.device_id == device_id)
+            .order_by(FamilyMessages.id)
+            .execution_options(yield_per=EXPORT_BATCH_SIZE)
+        )
+        result = await session.stream(stmt)
+        async for rows in result.partitions():
+            yield "".join(_line(_row_record("family_message", row, FAMILY_MESSAGE_FIELDS)) for row in rows)
+    metrics.inc("transfer.exports")
+
+
+# ============================================
+# IMPORTACIÓN
+# ============================================
+
+async def _records(chunks):
+    """(nº de línea, registro) de un cuerpo NDJSON que llega por trozos"""
+    buffer = b""
+    line_number = 0
+    async for chunk in chunks:
+        buffer += chunk
+        if len(buffer) > IMPORT_MAX_LINE_BYTES and b"\n" not in buffer:
+            raise DeviceImportError(line_number + 1, "línea demasiado larga")
+        *lines, buffer = buffer.split(b"\n")
+        for raw in lines:
+            line_number += 1
+            if raw.strip():
+                yield line_number, _parse(line_number, raw)
+    if buffer.strip():
+        yield line_number + 1, _parse(line_number + 1, buffer)
+
+
+def _parse(line_number, raw):
+    try:
+        record = json.loads(raw)
+    except ValueError as e:
+        raise DeviceImportError(line_number, f"JSON no válido ({e})")
+    if not isinstance(record, dict) or not isinstance(record.get("type"), str):
+        raise DeviceImportError(line_number, "falta el campo type")
+    return record
+
+
+def _check_type(line_number, field, value):
+    expected = FIELD_TYPES.get(field)
+    if value is None or expected is None:
+        return
+    # bool es subclase de int: un chat id true no vale
+    if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+        raise DeviceImportError(line_number, f"tipo no válido en {field}")
+    if expected is list and not all(isinstance(item, str) for item in value):
+        raise DeviceImportError(line_number, f"{field} debe ser una lista de textos")
+
+
+def _row(line_number, record, fields, required):
+    row = {field: record.get(field) for field in fields}
+    for field in required:
+        if row[field] in (None, ""):
+            raise DeviceImportError(line_number, f"falta el campo {field}")
+    for field, value in row.items():
+        _check_type(line_number, field, value)
+    for field in DATETIME_FIELDS:
+        if field == "timestamp" and row.get(field) is None:
+            row[field] = datetime.utcnow()
+        elif isinstance(row.get(field), str):
+            try:
+                row[field] = datetime.fromisoformat(row[field])
+            except ValueError:
+                raise DeviceImportError(line_number, f"fecha no válida en {field}")
+    return row
+
+
+def _validate(line_number, record):
+    """Comprueba un registro antes de tocar la base de datos; devuelve su tipo"""
+    kind = record["type"]
+    if kind == "device":
+        if not isinstance(record.get("user_memory", {}), dict):
+            raise DeviceImportError(line_number, "tipo no válido en user_memory")
+    elif kind == "memory":
+        _row(line_number, record, MEMORY_FIELDS, ("content",))
+    elif kind == "conversation":
+        if entry_time(record) is None:
+            raise DeviceImportError(line_number, "turno sin timestamp válido")
+    elif kind == "family_message":
+        _row(line_number, record, FAMILY_MESSAGE_FIELDS, ("telegram_chat_id", "message"))
+    else:
+        raise DeviceImportError(line_number, f"tipo desconocido: {kind}")
+    return kind
+
+
+class DeviceImport:
+    """Estado de una importación: trozos pendientes y contadores"""
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.memories = []
+        self.family_messages = []
+        self.user_memory = None
+        self.hot_turns = []
+        # Recuerdos insertados: se indexan y enriquecen tras el commit
+        self.indexed = []
+        self.to_enrich = []
+        self.counts = {"memories": 0, "conversation": 0, "conversation_archived": 0, "family_messages": 0}
+
+    async def run(self, chunks):
+        with tempfile.TemporaryFile("w+b") as staged:
+            # 1. Todo el fichero se valida (y se guarda aparte) antes de escribir nada
+            turns = 0
+            async for line_number, record in _records(chunks):
+                if _validate(line_number, record) == "conversation":
+                    turns += 1
+                staged.write(_line(record).encode("utf-8"))
+            # Los turnos que no caben en la fila van directamente al archivo
+            to_archive = max(turns - ARCHIVE_MAX_HOT_ENTRIES, 0)
+
+            # 2. Archivo: append no repite lo ya archivado, así que un reintento no duplica
+            staged.seek(0)
+            archive_turns = []
+            for kind, record in self._staged(staged):
+                if kind != "conversation":
+                    continue
+                if self.counts["conversation"] < to_archive:
+                    archive_turns.append(record)
+                    if len(archive_turns) >= IMPORT_CHUNK_SIZE:
+                        await self._append_archive(archive_turns)
+                        archive_turns = []
+                else:
+                    self.hot_turns.append(record)
+                self.counts["conversation"] += 1
+            await self._append_archive(archive_turns)
+
+            # 3. Recuerdos, mensajes y dispositivo en una sola transacción
+            staged.seek(0)
+            async with async_session() as session:
+                await self._ensure_device(session)
+                for kind, record in self._staged(staged):
+                    if kind == "device":
+                        self.user_memory = record.get("user_memory") or None
+                    elif kind == "memory":
+                        row = _row(0, record, MEMORY_FIELDS, ())
+                        row["category"] = row["category"] or "personal"
+                        self.memories.append(row)
+                        if len(self.memories) >= IMPORT_CHUNK_SIZE:
+                            await self._flush_memories(session)
+                    elif kind == "family_message":
+                        row = _row(0, record, FAMILY_MESSAGE_FIELDS, ())
+                        row["read"] = bool(row["read"])
+                        self.family_messages.append(row)
+                        if len(self.family_messages) >= IMPORT_CHUNK_SIZE:
+                            await self._flush_family_messages(session)
+                await self._flush_memories(session)
+                await self._flush_family_messages(session)
+                await self._finish_device(session)
+                await session.commit()
+
+        # 4. Índice semántico, enriquecimiento y archivo de lo que sobre en la fila
+        mark_written(self.device_id)
+        for start in range(0, len(self.indexed), IMPORT_CHUNK_SIZE):
+            # Una codificación y una instantánea por trozo, no por fila
+            memory_index.add_memories(self.device_id, self.indexed[start:start + IMPORT_CHUNK_SIZE])
+        for memory_id in self.to_enrich:
+            memory_enrichment.submit(self.device_id, memory_id)
+        self.counts["conversation_archived"] += await conversation_archive.archive_device(self.device_id)
+        metrics.inc("transfer.imports")
+        return self.counts
+
+    @staticmethod
+    def _staged(staged):
+        for raw in staged:
+            record = json.loads(raw)
+            yield record.pop("type"), record
+
+    async def _ensure_device(self, session):
+        # Los mensajes familiares tienen FK a device_data
+        if await session.get(DeviceData, self.device_id) is None:
+            session.add(DeviceData(device_id=self.device_id, user_memory={}, conversation_history=[]))
+            await session.flush()
+
+    async def _flush_memories(self, session):
+        if not self.memories:
+            return
+        rows, self.memories = self.memories, []
+        result = await session.execute(
+            insert(Memory).returning(Memory.id, sort_by_parameter_order=True),
+            [{"device_id": self.device_id, **row} for row in rows],
+        )
+        for memory_id, row in zip(result.scalars().all(), rows):
+            self.indexed.append((memory_id, index_text(row["content"], row["people"], row["places"], row["era"])))
+            if row["enriched_at"] is None:
+                self.to_enrich.append(memory_id)
+        self.counts["memories"] += len(rows)
+
+    async def _flush_family_messages(self, session):
+        if not self.family_messages:
+            return
+        rows, self.family_messages = self.family_messages, []
+        await session.execute(insert(FamilyMessages), [{"device_id": self.device_id, **row} for row in rows])
+        self.counts["family_messages"] += len(rows)
+
+    async def _append_archive(self, turns):
+        by_month = defaultdict(list)
+        for entry in turns:
+            by_month[entry_time(entry).strftime("%Y-%m")].append(entry)
+        for month, entries in sorted(by_month.items()):
+            self.counts["conversation_archived"] += await asyncio.to_thread(
+                conversation_archive.append, self.device_id, month, entries
+            )
+
+    async def _finish_device(self, session):
+        """Junta los turnos recientes con el historial y rellena user_memory"""
+        device_data = (await session.execute(
+            select(DeviceData).where(DeviceData.device_id == self.device_id).with_for_update()
+        )).scalar_one()
+        if self.hot_turns:
+            history = device_data.conversation_history if isinstance(device_data.conversation_history, list) else []
+            device_data.conversation_history = sorted(
+                history + self.hot_turns, key=lambda entry: str(entry.get("timestamp", ""))
+            )
+        if self.user_memory:
+            # Lo que ya tenía el dispositivo manda; solo se rellenan las claves vacías
+            current = dict(device_data.user_memory or {})
+            for key, value in self.user_memory.items():
+                if not current.get(key):
+                    current[key] = value
+            device_data.user_memory = current
+
+
+async def import_device(device_id, chunks):
+    """Importa un cuerpo NDJSON (iterable async de bytes); devuelve cuántos registros de cada tipo"""
+    return await DeviceImport(device_id).run(chunks)
@@ -1,44 +1,112 @@
 
-from sqlalchemy import select
-from .database import async_session, DeviceData
+import importlib
+import secrets
+from datetime import datetime
 
+from sqlalchemy import select, func, literal_column
+from sqlalchemy.exc import IntegrityError
+from .database import async_session, mark_written, DeviceData, UserConnections
+
+
+# Backends con INSERT ... ON CONFLICT DO UPDATE ... RETURNING
+UPSERT_DIALECTS = ("postgresql", "sqlite")
+
+# Reintentos si el device_code choca con el de otro dispositivo
+DEVICE_CODE_ATTEMPTS = 10
 
-async def link_chat_to_device(device_code: str, chat_id: str) -> bool:
-    """
-    Search a device by its 'device_code' and assings a 'telegram_chat_id'.
-    """
-    async with async_session() as session:
-        stmt = select(DeviceData).where(DeviceData.device_code == device_code)
-        result = await session.execute(stmt)
-        device_data = result.scalar_one_or_none()
-
-        if device_data:
-            device_data.telegram_chat_id = int(chat_id)
-            await session.commit()
-            print(f"🔗 Dispositivo {device_data.device_id} vinculado a chat {chat_id}")
-            return True
-        
-        print(f"⚠️ No se encontró dispositivo con código {device_code} para vincular.")
-        return False
-
-
-async def get_chat_id_from_device_db(device_id: str) -> str | None:
-    """
-    Get the telegram_chat_id for a device_id.
-    """
-    async with async_session() as session:
-        stmt = select(DeviceData.telegram_chat_id).where(DeviceData.device_id == device_id)
-        result = await session.execute(stmt)
-        chat_id = result.scalar_one_or_none()
-        return chat_id
 
+def new_device_code():
+    """Código aleatorio de 6 dígitos (la unicidad la garantiza la restricción UNIQUE)"""
+    return f"{secrets.randbelow(1000000):06d}"
 
-async def get_device_from_chat_db(chat_id: str) -> str | None:
+
+async def register_device(device_id=None, device_code=None):
     """
-    Get the device code from the database
+    Registro del handshake de /ws: crea el dispositivo o marca la reconexión y
+    devuelve (device_id, device_code, chat_id) con una sola sentencia:
+    INSERT ... ON CONFLICT (device_id) DO UPDATE ... RETURNING, que además trae
+    el chat de Telegram conectado con una subconsulta.
+
+    Si el dispositivo ya existe se conserva su código guardado. Si el código
+    choca con el de otro dispositivo se genera uno nuevo y se reintenta.
+    Sin upsert (otros backends) se hace SELECT + INSERT/UPDATE en una sesión.
     """
-    async with async_session() as session:
-        stmt = select(DeviceData.device_id).where(DeviceData.telegram_chat_id == int(chat_id))
-        result = await session.execute(stmt)
-        device_id = result.scalar_one_or_none()
-        return device_id
\ No newline at end of file
+    if not device_id or not device_code:
+        device_code = new_device_code()
+        device_id = f"device_{device_code}"
+        generated = True
+    else:
+        generated = False
+
+    for _ in range(DEVICE_CODE_ATTEMPTS):
+        try:
+            async with async_session() as session:
+                dialect = session.bind.dialect.name
+                if dialect in UPSERT_DIALECTS:
+                    row = await _upsert_device(session, dialect, device_id, device_code)
+                else:
+                    row = await _select_or_insert_device(session, device_id, device_code)
+                await session.commit()
+                mark_written(device_id)
+                return device_id, row[0], row[1]
+        except IntegrityError:
+            # UNIQUE de device_code: el código ya es de otro dispositivo
+            print(f"⚠️ Código {device_code} en uso, generando otro para {device_id}")
+            device_code = new_device_code()
+            if generated:
+                device_id = f"device_{device_code}"
+    raise RuntimeError(f"No se pudo asignar un código único a {device_id}")
+
+
+async def _upsert_device(session, dialect, device_id, device_code):
+    # El módulo del dialecto se importa aquí para no cargarlo al arrancar
+    insert = importlib.import_module(f"sqlalchemy.dialects.{dialect}").insert
+    now = datetime.utcnow()
+    table = DeviceData.__table__
+    connected_chat = (
+        select(UserConnections.telegram_chat_id)
+        # Nombre cualificado: en el RETURNING, device_id a secas es ambiguo
+        .where(UserConnections.device_id == literal_column("device_data.device_id"))
+        .limit(1)
+        .scalar_subquery()
+    )
+    stmt = insert(table).values(
+        device_id=device_id,
+        device_code=device_code,
+        user_memory={},
+        conversation_history=[],
+        last_updated=now,
+        last_connected=now,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.device_id],
+        set_={
+            # El código guardado manda; solo se rellena si no tenía
+            "device_code": func.coalesce(table.c.device_code, stmt.excluded.device_code),
+            "last_connected": stmt.excluded.last_connected,
+        },
+    ).returning(table.c.device_code, connected_chat)
+    return (await session.execute(stmt)).one()
+
+
+async def _select_or_insert_device(session, device_id, device_code):
+    stmt = select(DeviceData).where(DeviceData.device_id == device_id).with_for_update()
+    device_data = (await session.execute(stmt)).scalar_one_or_none()
+    if device_data is None:
+        device_data = DeviceData(
+            device_id=device_id,
+            device_code=device_code,
+            user_memory={},
+            conversation_history=[],
+            last_connected=datetime.utcnow(),
+        )
+        session.add(device_data)
+        await session.flush()
+        return device_data.device_code, None
+    if device_data.device_code is None:
+        device_data.device_code = device_code
+    device_data.last_connected = datetime.utcnow()
+    chat_id = (await session.execute(
+        select(UserConnections.telegram_chat_id).where(UserConnections.device_id == device_id).limit(1)
+    )).scalar()
+    return device_data.device_code, chat_id
@@ -0,0 +1,186 @@
+"""
+Respuestas rápidas sin LLM para saludos, agradecimientos e intenciones simples.
+
+Frases cortas como "hola", "gracias", "sí" o "buenas noches" no necesitan
+recuperar recuerdos ni llamar a Gemini. Se responden desde una tabla de frases
+precompilada por idioma, con el mismo tono afectuoso de ALZHEIMER_PROMPT.
+Las tablas se pueden ampliar o sustituir con un JSON (FAST_RESPONDER_TABLES).
+"""
+import os
+import json
+import itertools
+
+from .metrics import metrics
+from .response_cache import normalize_utterance
+
+
+DEFAULT_LOCALE = os.getenv("COMPA_LOCALE", "es")
+
+# Frases de más palabras que esto siempre van al flujo normal
+FAST_RESPONDER_MAX_WORDS = int(os.getenv("FAST_RESPONDER_MAX_WORDS", "5"))
+
+# Palabras de relleno que no cambian la intención ("hola compa", "gracias querida")
+FILLER_WORDS = {
+    "es": {"compa", "querida", "querido", "cariño", "pues", "bueno", "eh", "ah", "oye", "mira", "muchas", "mucho"},
+    "en": {"compa", "dear", "oh", "well", "so", "very", "much"},
+}
+
+PHRASE_TABLES = {
+    "es": {
+        "greeting": {
+            "phrases": ["hola", "holi", "hola hola", "buenas", "que tal", "hola que tal", "ey", "hey"],
+            "responses": [
+                "¡Hola, querida! Qué alegría escucharte. ¿Cómo te sientes hoy?",
+                "¡Hola! Aquí estoy contigo. ¿Qué te apetece contarme?",
+                "¡Hola, cariño! Me alegra mucho que me hables. ¿Cómo estás?",
+            ],
+        },
+        "good_morning": {
+            "phrases": ["buenos dias", "buen dia"],
+            "responses": [
+                "¡Buenos días, querida! ¿Has descansado bien?",
+                "¡Buenos días! Qué bonito empezar el día contigo. ¿Cómo te encuentras?",
+            ],
+        },
+        "good_afternoon": {
+            "phrases": ["buenas tardes"],
+            "responses": [
+                "¡Buenas tardes, querida! ¿Qué tal va tu día?",
+                "¡Buenas tardes! Me alegra oírte. ¿Qué has hecho hoy?",
+            ],
+        },
+        "good_night": {
+            "phrases": ["buenas noches", "me voy a dormir", "me voy a la cama", "a dormir", "hasta mañana"],
+            "responses": [
+                "Buenas noches, querida. Que descanses muy bien, aquí estaré mañana.",
+                "Que duermas muy bien, cariño. Ha sido un placer hablar contigo.",
+            ],
+        },
+        "thanks": {
+            "phrases": ["gracias", "muchas gracias", "mil gracias", "gracias compa", "te lo agradezco"],
+            "responses": [
+                "De nada, querida. Para mí es un placer acompañarte.",
+                "¡A ti! Me encanta estar contigo.",
+                "No hay de qué, cariño. Aquí estoy siempre que quieras.",
+            ],
+        },
+        "yes": {
+            "phrases": ["si", "si si", "vale", "claro", "claro que si", "de acuerdo", "venga", "por supuesto", "eso es"],
+            "responses": [
+                "¡Qué bien! Cuéntame, te escucho.",
+                "Estupendo, querida. Sigue, que me encanta escucharte.",
+                "Muy bien. ¿Qué más me cuentas?",
+            ],
+        },
+        "no": {
+            "phrases": ["no", "no no", "no gracias", "ahora no", "nada"],
+            "responses": [
+                "Está bien, querida. Aquí estoy cuando quieras.",
+                "De acuerdo, cariño. Si te apetece hablar luego, me avisas.",
+            ],
+        },
+        "goodbye": {
+            "phrases": ["adios", "hasta luego", "chao", "chau", "nos vemos", "hasta pronto"],
+            "responses": [
+                "¡Hasta luego, querida! Ha sido un placer hablar contigo.",
+                "¡Adiós, cariño! Aquí estaré cuando me necesites.",
+            ],
+        },
+        "how_are_you": {
+            "phrases": ["como estas", "que tal estas", "como te va", "como andas"],
+            "responses": [
+                "Muy bien, y mejor ahora que hablo contigo. ¿Y tú cómo te sientes?",
+                "¡Estoy muy contenta de escucharte! ¿Cómo estás tú, querida?",
+            ],
+        },
+    },
+    "en": {
+        "greeting": {
+            "phrases": ["hi", "hello", "hey", "hello there"],
+            "responses": [
+                "Hello, dear! It's so nice to hear you. How are you feeling today?",
+                "Hi! I'm right here with you. What would you like to tell me?",
+            ],
+        },
+        "good_night": {
+            "phrases": ["good night", "goodnight"],
+            "responses": ["Good night, dear. Sleep well, I'll be here tomorrow."],
+        },
+        "thanks": {
+            "phrases": ["thanks", "thank you", "thank you so"],
+            "responses": ["You're welcome, dear. I love keeping you company."],
+        },
+        "yes": {
+            "phrases": ["yes", "yeah", "ok", "okay", "sure", "of course"],
+            "responses": ["Wonderful! Tell me more, I'm listening."],
+        },
+        "no": {
+            "phrases": ["no", "no thanks", "not now"],
+            "responses": ["That's fine, dear. I'm here whenever you want."],
+        },
+        "goodbye": {
+            "phrases": ["bye", "goodbye", "see you", "see you later"],
+            "responses": ["Goodbye, dear! It was lovely talking with you."],
+        },
+    },
+}
+
+
+class FastResponder:
+    """Respondedor por plantillas compilado a un diccionario frase -> intención"""
+
+    def __init__(self, tables=None, max_words=FAST_RESPONDER_MAX_WORDS):
+        self.max_words = max_words
+        self._lookup = {}
+        self._responses = {}
+        self.load_tables(tables or PHRASE_TABLES)
+
+    def load_tables(self, tables):
+        """Precompila (o amplía) las tablas de frases por idioma"""
+        for locale, intents in tables.items():
+            lookup = self._lookup.setdefault(locale, {})
+            for intent, spec in intents.items():
+                for phrase in spec.get("phrases", []):
+                    lookup[self._canonical(phrase, locale)] = intent
+                if spec.get("responses"):
+                    self._responses[(locale, intent)] = itertools.cycle(spec["responses"])
+
+    @staticmethod
+    def _canonical(text, locale):
+        fillers = FILLER_WORDS.get(locale, set())
+        words = [w for w in normalize_utterance(text).split() if w not in fillers]
+        return " ".join(words)
+
+    def match(self, text, locale=DEFAULT_LOCALE):
+        """Intención reconocida o None"""
+        if len(text.split()) > self.max_words:
+            return None
+        lookup = self._lookup.get(locale) or self._lookup.get(DEFAULT_LOCALE, {})
+        return lookup.get(self._canonical(text, locale))
+
+    def respond(self, text, locale=DEFAULT_LOCALE):
+        """Respuesta de plantilla o None si la frase debe ir al LLM"""
+        if locale not in self._lookup:
+            locale = DEFAULT_LOCALE
+        intent = self.match(text, locale)
+        if intent is None:
+            return None
+        responses = self._responses.get((locale, intent))
+        if responses is None:
+            return None
+        metrics.inc("fast_path.turns")
+        metrics.inc(f"fast_path.{intent}")
+        return next(responses)
+
+
+fast_responder = FastResponder()
+
+# Tablas adicionales por idioma desde un JSON con el mismo formato que PHRASE_TABLES
+_extra_tables_path = os.getenv("FAST_RESPONDER_TABLES")
+if _extra_tables_path:
+    try:
+        with open(_extra_tables_path, encoding="utf-8") as f:
+            fast_responder.load_tables(json.load(f))
+        print(f"✅ Tablas de respuestas rápidas cargadas desde {_extra_tables_path}")
+    except Exception as e:
+        print(f"⚠️ No se pudieron cargar las tablas de respuestas rápidas: {e}")
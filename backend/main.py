@@ -2,59 +2,82 @@ from random import random
 from fastapi import Request, Header, FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, StreamingResponse
 from sqlalchemy import select, or_, func, Column, String, JSON, DateTime, update
 from sqlalchemy.sql import text
 import uvicorn
 import os
 import json
 import re
-from datetime import datetime, timedelta 
+import time
+from datetime import date, datetime, timedelta 
 from dotenv import load_dotenv
 import asyncio
-from googlesearch import search
+import functools
 import traceback
-import google.generativeai as genai
+import importlib
+from contextlib import asynccontextmanager
 import uuid
-import secrets
 from collections import defaultdict
 from pydantic import BaseModel
 
 # --- MODIFICADO ---
 # Importamos UserConnections que ahora necesitamos
-from .database import async_session, Memory, init_db, DeviceData, UserSession, PhoneVerification, FamilyMessages, UserConnections
-from .device_utils import link_chat_to_device, get_chat_id_from_device_db, get_device_from_chat_db
-from .sms_service import sms_service
-from .telegram_bot import FamilyMessagesBot
+from .database import async_session, read_session, mark_written, Memory, DeviceData, UserSession, PhoneVerification, FamilyMessages, UserConnections
+from .migrations import verify_schema
+from .unit_of_work import TurnUnitOfWork
+from .auth_tokens import new_token, hash_token, find_active_session
+from .scheduler import scheduler
+from . import session_gc  # registers the session_gc job
+from .bot_outbox import run_dispatcher, deliver_to_devices
+from .media_store import media_info, media_response
+from .usage_rollups import usage_rollups, daily_usage, ALL_DEVICES, USAGE_MAX_DAYS
+from .conversation_archive import conversation_archive  # registers the conversation_archive job
+from .device_transfer import export_device, import_device, DeviceImportError
+from . import admin
+from .admin import ADMIN_PAGE_SIZE, ADMIN_MAX_PAGE_SIZE
+from .memory_index import memory_index
+from .memory_enrichment import memory_enrichment, GeminiExtractor, RuleExtractor, index_text
+from .turn_queue import TurnQueue
+from .message_dedup import message_dedup, DONE, PENDING
+from .metrics import metrics
+from .db_instrumentation import QueryCountMiddleware, query_scope
+from .response_cache import response_cache
+from .fast_responder import fast_responder, DEFAULT_LOCALE
+from . import ws_protocol
+from .ws_protocol import send_frame, receive_frame, ProtocolError
+from .text_processing import (
+    SPANISH_MONTHS, memory_regex, is_question, detect_message_intent, detect_intent,
+    parse_spanish_date_fragment, analyze_utterance, limit_sentences
+)
+from .device_utils import register_device
 
 
 # Telegram bot handler comment moved to imports section
-
-# Dictionary mapping Spanish month names to month numbers for date parsing
-SPANISH_MONTHS = {
-    "enero": 1, "ene": 1,
-    "febrero": 2, "feb": 2,
-    "marzo": 3, "mar": 3,
-    "abril": 4, "abr": 4,
-    "mayo": 5, "may": 5,
-    "junio": 6, "jun": 6,
-    "julio": 7, "jul": 7,
-    "agosto": 8, "ago": 8,
-    "septiembre": 9, "sep": 9, "setiembre": 9, "sept": 9,
-    "octubre": 10, "oct": 10,
-    "noviembre": 11, "nov": 11,
-    "diciembre": 12, "dic": 12
-}
+# Pure text helpers (date parsing, intents, memory regex) live in text_processing.py
+# Gemini, googlesearch, Twilio (sms_service) and python-telegram-bot are heavy:
+# they are imported lazily (see LAZY INTEGRATIONS) to keep cold starts short
 
 # Load environment variables from .env file
 load_dotenv()
 
+
+@asynccontextmanager
+async def lifespan(app):
+    """Startup/shutdown of the app (defined at the end of this file)"""
+    await startup_event()
+    try:
+        yield
+    finally:
+        await shutdown_event()
+
+
 # Initialize FastAPI application
-app = FastAPI(title="Asistente Alzheimer", version="1.0.0")
+app = FastAPI(title="Asistente Alzheimer", version="1.0.0", lifespan=lifespan)
 
-# Global dictionaries to track real-time state
+# WebSockets connected to this process, by device_id; the bot reaches them
+# through the bot_outbox table (see bot_outbox.py)
 ACTIVE_WEBSOCKETS = {}
-PENDING_REQUESTS = {}
 
 # Configure CORS middleware to allow cross-origin requests
 app.add_middleware(
@@ -65,52 +88,87 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Count SQL statements per HTTP request (budgets in db_instrumentation.QUERY_BUDGETS)
+app.add_middleware(QueryCountMiddleware)
+
 # Configure Google Gemini API with API key from environment
 GEMINI_TOKEN = os.getenv("GEMINI_TOKEN")
 if not GEMINI_TOKEN:
     print("ERROR: GEMINI_TOKEN not found in environment variables.")
-    GEMINI_CLIENT = None
-else:
-    genai.configure(api_key=GEMINI_TOKEN)
 
 # Specify the Gemini model to use (DO NOT CHANGE THIS MODEL)
 GEMINI_MODEL = "gemini-2.5-flash-lite"
 
-# Initialize Gemini client ONCE
-GEMINI_CLIENT = genai.GenerativeModel(GEMINI_MODEL) if GEMINI_TOKEN else None
-
-# Regex patterns for memory detection
-memory_patterns = [
-    r'\b(me\s+)?acuerdo\s+(de|que|cuando)\b',  
-    r'\brecuerdo\s+(que|cuando|a|el|la)\b',     
-    r'\bmi\s+(hijo|hija|esposo|esposa|mamá|papá|familia|nieto|nieta)\b',
-    r'\bcuando\s+(era|vivía|trabajaba|estaba)\b',
-    r'\b(extraño|añoro)\s+(a|mucho)\b',
-    r'\b(me\s+gustaba|disfrutaba|me\s+encantaba)\b',
-    r'\ben\s+mi\s+(infancia|juventud)\b',
-    r'\bqué\s+ilusión\b',
-    r'\baquella\s+vez\b',
-    r'\bsiempre\s+(he|me)\b',
-]
-memory_regex = re.compile('|'.join(memory_patterns), re.IGNORECASE)
-
-def is_question(text):
-    """Detecta si el mensaje es una pregunta"""
-    text_lower = text.lower().strip()
-    
-    if text_lower.startswith('¿') or text_lower.endswith('?'):
-        return True
-    
-    question_words = [
-        'qué', 'quién', 'cómo', 'cuándo', 'dónde', 'por qué', 'cuál', 
-        'tienes', 'hay', 'sabes', 'conoces', 'puedes', 'podrías'
-    ]
-
-    first_words = text_lower.split()[:2]
-    if any(qw in first_words for qw in question_words):
-        return True
-    
-    return False
+# Gemini client, created ONCE on first use or by the warm-up task (get_gemini_client)
+GEMINI_CLIENT = None
+
+
+# ============================================
+# LAZY INTEGRATIONS - Heavy clients loaded on first use or warmed up after startup
+# ============================================
+
+_genai = None
+_sms_service = None
+
+# Readiness of each heavy integration; /ready answers 200 once all are warm.
+# "disabled" means not configured, which does not block readiness; "failed"
+# means it could not be loaded (the Telegram bot keeps retrying).
+READINESS = {"database": False, "gemini": False, "telegram": False, "sms": False}
+
+# Seconds between attempts to start the Telegram bot after a failure
+TELEGRAM_START_RETRY_SECONDS = float(os.getenv("TELEGRAM_START_RETRY_SECONDS", "30"))
+
+
+def get_genai():
+    """Imports and configures google.generativeai once"""
+    global _genai
+    if _genai is None:
+        module = importlib.import_module("google.generativeai")
+        if GEMINI_TOKEN:
+            module.configure(api_key=GEMINI_TOKEN)
+        _genai = module
+    return _genai
+
+
+def get_gemini_client():
+    """Gemini model client, or None if GEMINI_TOKEN is not configured"""
+    global GEMINI_CLIENT
+    if GEMINI_CLIENT is None and GEMINI_TOKEN:
+        GEMINI_CLIENT = get_genai().GenerativeModel(GEMINI_MODEL)
+    return GEMINI_CLIENT
+
+
+async def generate_enrichment(prompt):
+    """Gemini call for a batch of memories to enrich, answered as JSON"""
+    generation_config = get_genai().types.GenerationConfig(
+        max_output_tokens=2000,
+        temperature=0.0,
+        response_mime_type="application/json"
+    )
+    response = await get_gemini_client().generate_content_async(prompt, generation_config=generation_config)
+    return response.text
+
+
+def get_sms_service():
+    """Twilio verification service, or None if it is not configured"""
+    global _sms_service
+    if _sms_service is None:
+        try:
+            from .sms_service import sms_service
+        except Exception as e:
+            print(f"⚠️ Servicio SMS no disponible: {e}")
+            sms_service = None
+        _sms_service = sms_service or False
+    return _sms_service or None
+
+
+def is_ready():
+    return all(state in (True, "disabled") for state in READINESS.values())
+
+# Hybrid retrieval: how many candidates per requested memory are pulled from
+# each source, and how much a full keyword match adds to the cosine score
+SEMANTIC_CANDIDATES_FACTOR = 4
+KEYWORD_RERANK_WEIGHT = 0.35
 
 # Comprehensive system prompt for the AI assistant
 # Instructs the model to behave as "Compa", an empathetic conversational companion
@@ -190,129 +248,6 @@ Usuario: "{user_message}"
 Respuesta (1 frase, tono afectuoso):
 """
 
-# Function to detect user intent regarding family messages
-# Identifies whether user wants to read, query, or access old/specific date messages
-def detect_message_intent(user_message):
-    """Detección más inteligente de intenciones sobre mensajes"""
-    lower_msg = user_message.lower()
-    
-    # Keywords that indicate user wants to immediately read messages
-    immediate_read_keywords = [
-        "léeme", "lee", "leer", "dime", "cuéntame", "escucha", 
-        "ponme", "reproduce", "escuchar", "oír", "qué dice",
-        "qué escribió", "contenido", "mensaje", "recibir", "lee el"
-    ]
-    
-    # Keywords that indicate user is querying message availability
-    query_keywords = [
-        "tengo", "hay", "mensajes", "familiares", "familiar",
-        "alguno", "algún", "recibí", "llegó", "tienes"
-    ]
-    
-    # Keywords indicating user wants to access historical/old messages
-    old_messages_keywords = [
-        "antiguos", "antiguo", "leídos", "pasados", "anteriores", 
-        "historial", "todos", "todos los", "todos mis"
-    ]
-    
-    # Keywords indicating a date specification might follow
-    date_keywords = ["del", "de fecha", "de"]
-    
-    # Check for presence of each keyword category
-    has_immediate = any(keyword in lower_msg for keyword in immediate_read_keywords)
-    has_query = any(keyword in lower_msg for keyword in query_keywords)
-    has_old = any(keyword in lower_msg for keyword in old_messages_keywords)
-    has_date = any(keyword in lower_msg for keyword in date_keywords)
-    
-    # Attempt to extract explicit date from message if date-related keywords present
-    explicit_date = parse_spanish_date_fragment(lower_msg) if any(word in lower_msg for word in ["del", "de"]) else None
-    
-    # Return detection results as dictionary
-    return {
-        "is_read_intent": has_immediate,
-        "is_query_intent": has_query,
-        "wants_old_messages": has_old,
-        "has_explicit_date": explicit_date is not None,
-        "explicit_date": explicit_date
-    }
-
-# Simpler general intent detection (used for non-message related requests)
-def detect_intent(user_message):
-    """Detecta la intención del usuario de manera más robusta"""
-    lower_msg = user_message.lower()
-    
-    # Keywords indicating read intent
-    read_keywords = [
-        "léeme", "lee", "leer", "dime", "cuéntame", "escucha", 
-        "qué dice", "qué escribió", "contenido", "mensaje", "recibir",
-        "ponme", "reproduce", "escuchar", "oír"
-    ]
-    
-    # Keywords indicating query intent
-    query_keywords = ["tengo", "hay", "mensajes", "nuevos", "familiares"]
-    
-    # Check for keyword matches
-    is_read_intent = any(keyword in lower_msg for keyword in read_keywords)
-    is_query_intent = any(keyword in lower_msg for keyword in query_keywords)
-    
-    # Return detection results
-    return {
-        "is_read_intent": is_read_intent,
-        "is_query_intent": is_query_intent,
-        "wants_immediate_reading": is_read_intent
-    }
-
-# Robust date parser for Spanish date formats
-# Handles formats like: "20 de octubre", "20 octubre 2025", "5/10", "05-10-2025"
-def parse_spanish_date_fragment(text):
-    """
-    Intenta extraer una fecha en formato dd/mm[/yyyy] desde textos tipo:
-    "20 de octubre", "20 octubre 2025", "el 3 de mayo", "5/10", "05-10-2025".
-    Devuelve 'dd/mm/yyyy' o None si no la encuentra.
-    """
-    text = text.lower().strip()
-
-    # Try to match numeric date formats (dd/mm or dd/mm/yyyy)
-    m = re.search(r'\b(\d{1,2})[\/\-](\d{1,2})(?:[\/\-](\d{2,4}))?\b', text)
-    if m:
-        d = int(m.group(1)); mo = int(m.group(2))
-        y = m.group(3)
-        if y:
-            y = int(y)
-            # Convert 2-digit years to 4-digit years (assume 2000s)
-            if y < 100:  
-                y += 2000
-        else:
-            # Default to current year if not specified
-            y = datetime.now().year
-        try:
-            return f"{d:02d}/{mo:02d}/{int(y)}"
-        except Exception:
-            return None
-
-    # Try to match text-based date formats (e.g., "3 de mayo")
-    m2 = re.search(r'\b(\d{1,2})\s*(?:de\s+)?([a-záéíóúñ]+)(?:\s+(\d{2,4}))?\b', text, flags=re.IGNORECASE)
-    if m2:
-        d = int(m2.group(1))
-        month_word = m2.group(2).lower()
-        y = m2.group(3)
-        # Look up month number from Spanish month dictionary
-        month_num = SPANISH_MONTHS.get(month_word)
-        if month_num:
-            if y:
-                y = int(y)
-                # Convert 2-digit years to 4-digit years
-                if y < 100:
-                    y += 2000
-            else:
-                # Default to current year if not specified
-                y = datetime.now().year
-            try:
-                return f"{d:02d}/{month_num:02d}/{int(y)}"
-            except Exception:
-                return None
-    return None
-
 # Utility function to decode bytes with fallback encoding support
 # Attempts UTF-8 first, then cp1252, then latin-1
 def _try_decode_bytes(b: bytes):
@@ -406,6 +341,12 @@ class MemoryManager:
             await session.commit()
             await session.refresh(new_memory)
             
+            # Append incremental al índice semántico del dispositivo
+            try:
+                memory_index.add_memory(self.device_id, new_memory.id, new_memory.content)
+            except Exception as e:
+                print(f"⚠️ No se pudo indexar el recuerdo {new_memory.id}: {e}")
+            
             return {
                 "id": new_memory.id,
                 "content": new_memory.content,
@@ -414,12 +355,39 @@ class MemoryManager:
                 "last_recalled": None
             }
         
-    async def get_relevant_memories(self, query, limit=3):
-        """Retrieve relevant memories based on query keywords from database"""
+    async def _sync_memory_index(self, session):
+        """Pone al día el índice semántico con los recuerdos que aún no contiene"""
+        if memory_index.is_synced(self.device_id):
+            return
+        db_ids = (await session.execute(
+            select(Memory.id).where(Memory.device_id == self.device_id)
+        )).scalars().all()
+        missing_ids = memory_index.missing_ids(self.device_id, db_ids)
+        rows = []
+        if missing_ids:
+            stmt = select(Memory.id, Memory.content, Memory.people, Memory.places, Memory.era).where(
+                Memory.device_id == self.device_id,
+                Memory.id.in_(missing_ids)
+            ).order_by(Memory.id)
+            # Enriched memories are indexed with their people, places and era (see memory_enrichment.py)
+            rows = [(row.id, index_text(row.content, row.people, row.places, row.era)) for row in (await session.execute(stmt)).all()]
+        memory_index.build(self.device_id, rows)
+        if rows:
+            print(f"🧭 Índice semántico actualizado con {len(rows)} recuerdos para {self.device_id}")
+
+    async def get_relevant_memories(self, query, limit=3, touch=True):
+        """
+        Retrieve relevant memories for a query.
+        Semantic candidates from the local vector index are merged with the
+        keyword matches from the database and re-ranked together.
+        With touch=False last_recalled is not written here (the /ws turn does it
+        in its unit of work, see unit_of_work.py).
+        """
         try:
             # Extraer palabras clave relevantes (>3 caracteres)
             query_words = [w.lower() for w in query.split() if len(w) > 3]
-            async with async_session() as session:
+            # Only the touch=True path writes; otherwise it is a read-only query
+            async with read_session(self.device_id, primary=touch) as session:
                 stmt = select(Memory).where(
                     Memory.device_id == self.device_id
                 )
@@ -436,13 +404,43 @@ class MemoryManager:
                     # Devolver TODOS los recuerdos, no solo los que coinciden
                     stmt = select(Memory).where(Memory.device_id == self.device_id)
                     stmt = stmt.order_by(Memory.timestamp.desc()).limit(20)  # Últimos 20
+                    result = await session.execute(stmt)
+                    memories = result.scalars().all()
                 else:
-                    # Búsqueda normal con keywords
-                    stmt = stmt.order_by(Memory.timestamp.desc()).limit(limit)
-                result = await session.execute(stmt)
-                memories = result.scalars().all()
+                    # Búsqueda híbrida: candidatos semánticos + keywords
+                    stmt = stmt.order_by(Memory.timestamp.desc()).limit(limit * SEMANTIC_CANDIDATES_FACTOR)
+                    result = await session.execute(stmt)
+                    keyword_memories = {m.id: m for m in result.scalars().all()}
+
+                    await self._sync_memory_index(session)
+                    semantic_scores = dict(memory_index.search(
+                        self.device_id, query, k=limit * SEMANTIC_CANDIDATES_FACTOR
+                    ))
+                    missing_ids = [mid for mid in semantic_scores if mid not in keyword_memories]
+                    candidates = dict(keyword_memories)
+                    if missing_ids:
+                        extra = await session.execute(
+                            select(Memory).where(
+                                Memory.device_id == self.device_id,
+                                Memory.id.in_(missing_ids)
+                            )
+                        )
+                        candidates.update({m.id: m for m in extra.scalars().all()})
+
+                    # Re-ranking: similitud coseno + bonus por palabras clave que aparecen
+                    def hybrid_score(mem):
+                        content = mem.content.lower()
+                        keyword_hits = sum(1 for word in query_words if word in content)
+                        keyword_score = keyword_hits / len(query_words) if query_words else 0.0
+                        return semantic_scores.get(mem.id, 0.0) + KEYWORD_RERANK_WEIGHT * keyword_score
+
+                    memories = sorted(
+                        candidates.values(),
+                        key=lambda m: (hybrid_score(m), m.timestamp),
+                        reverse=True
+                    )[:limit]
                 # Actualizar last_recalled para los recuerdos recuperados
-                if memories:
+                if memories and touch:
                     for mem in memories:
                         mem.last_recalled = datetime.now()
                     await session.commit()
@@ -469,7 +467,7 @@ class MemoryManager:
         
     async def load_conversation(self):
         """Load conversation history from the database"""
-        async with async_session() as session:
+        async with read_session(self.device_id) as session:
             stmt = select(DeviceData).where(
                 DeviceData.device_id == self.device_id
             )
@@ -541,29 +539,16 @@ async def validate_session_token(session_token: str) -> dict:
     Esta función es independiente de sms_service.
     """
     try:
-        async with async_session() as db_session:
-            stmt = select(UserSession).where(
-                UserSession.session_token == session_token,
-                UserSession.verified == True,
-                UserSession.expires_at > datetime.utcnow()
-            )
-            result = await db_session.execute(stmt)
-            session = result.scalar_one_or_none()
-            
-            if session:
-                # Actualizar última actividad
-                session.last_activity = datetime.utcnow()
-                await db_session.commit()
-                
-                return {
-                    "valid": True,
-                    "session_id": session.id,
-                    "phone_number": session.phone_number, # Esto ahora es el chat_id
-                    "device_id": session.device_id
-                }
-            else:
-                return {"valid": False}
-                
+        # Index lookup by the token's SHA-256 on a replica (see auth_tokens.py)
+        session = await find_active_session(session_token)
+        if session is None:
+            return {"valid": False}
+        return {
+            "valid": True,
+            "session_id": session.id,
+            "phone_number": session.phone_number, # Esto ahora es el chat_id
+            "device_id": session.device_id
+        }
     except Exception as e:
         print(f"❌ Error validando sesión (función local): {e}")
         return {"valid": False, "error": str(e)}
@@ -573,7 +558,7 @@ async def validate_session_token(session_token: str) -> dict:
 async def load_conversation_from_db(device_id: str) -> list:
     """Helper function to load conversation history from database"""
     try:
-        async with async_session() as session:
+        async with read_session(device_id) as session:
             stmt = select(DeviceData).where(DeviceData.device_id == device_id)
             result = await session.execute(stmt)
             device_data = result.scalar_one_or_none()
@@ -586,23 +571,26 @@ async def load_conversation_from_db(device_id: str) -> list:
 
 
 # Tracks which device is connected to which Telegram chat for message delivery
-# Initialize Telegram bot if token is configured in environment
+# The Telegram bot is created by the warm-up task if the token is configured
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 telegram_bot = None
 
-if TELEGRAM_TOKEN:
-    telegram_bot = FamilyMessagesBot(TELEGRAM_TOKEN)
-    # Inject global state into the bot
-    try:
-        from .telegram_bot import set_shared_state
-        set_shared_state(ACTIVE_WEBSOCKETS, PENDING_REQUESTS)
-    except ImportError:
-        from backend.telegram_bot import set_shared_state
-        set_shared_state(ACTIVE_WEBSOCKETS, PENDING_REQUESTS)
-    print("✅ Bot de Telegram initialized with shared state")
-else:
+# "embedded": the bot polls Telegram inside this process (default)
+# "worker": the bot runs apart with `python -m backend.bot_worker`; this process
+# only uses its DB helpers and delivers the bot_outbox frames to the WebSockets
+TELEGRAM_BOT_MODE = os.getenv("TELEGRAM_BOT_MODE", "embedded").lower()
+
+if not TELEGRAM_TOKEN:
     print("⚠️ TELEGRAM_BOT_TOKEN not configured - family messages functionality disabled")
 
+
+def create_telegram_bot():
+    """Imports python-telegram-bot and creates the bot"""
+    from .telegram_bot import FamilyMessagesBot
+    bot = FamilyMessagesBot(TELEGRAM_TOKEN)
+    print("✅ Bot de Telegram initialized")
+    return bot
+
 # Utility function to send updated memory/conversation data to client for local persistence
 async def send_data_update_to_client(websocket, memory_data, conversation_data):
     """Envía datos actualizados al cliente para guardar localmente"""
@@ -612,12 +600,340 @@ async def send_data_update_to_client(websocket, memory_data, conversation_data):
             "user_memory": memory_data,
             "conversation_history": conversation_data
         }
-        await websocket.send_text(json.dumps(update_data, ensure_ascii=False))
+        await send_frame(websocket, update_data)
         print("📤 Datos actualizados enviados al cliente")
     except Exception as e:
         print("Error enviando actualización al cliente:", e)
 
 
+# ============================================
+# CONVERSATION TURNS - Prepare (cancellable) and commit (persistent) phases
+# ============================================
+
+async def generate_ai_response(user_message, memory_context, relevant_memories, is_memory_question):
+    """Builds the prompt for a turn, calls Gemini and post-processes the reply"""
+    # Customize prompt...
+    if is_memory_question and memory_context:
+        full_prompt = f"""
+Eres "Compa", un asistente especializado en Alzheimer. Responde con frases cortas y tono afectuoso.
+INFORMACIÓN CRÍTICA - ESTOS SON LOS RECUERDOS REALES DEL USUARIO:
+{memory_context}
+El usuario te pregunta: "{user_message}"
+RESPONDE mencionando específicamente los recuerdos de arriba. Si no encajan perfectamente, adapta tu respuesta afectivamente.
+Tu respuesta (1-2 frases, mencionando los recuerdos):
+"""
+    elif is_memory_question and not memory_context:
+        full_prompt = f"""
+Eres "Compa", un asistente especializado en Alzheimer.
+El usuario pregunta: "{user_message}"
+No tengo recuerdos específicos guardados sobre este tema. Responde con empatía.
+Tu respuesta (1-2 frases, ofreciendo ayuda):
+"""
+    else:
+        full_prompt = f"""
+Eres "Compa", un asistente especializado en Alzheimer.
+{f"CONTEXTO DEL USUARIO: {memory_context}" if memory_context else ""}
+Usuario: {user_message}
+Tu respuesta (1-2 frases, tono afectuoso):
+"""
+
+    # Call Gemini API without blocking the event loop, so other
+    # devices keep being served and this call can be superseded
+    response = await get_gemini_client().generate_content_async(full_prompt)
+    ai_response = response.text.strip()
+
+    # Verify response mentions memories if relevant memories exist
+    if is_memory_question and memory_context:
+        response_uses_memories = any(
+            any(word in mem["content"].lower() for word in ai_response.lower().split()[:100])
+            for mem in relevant_memories
+        )
+
+        if not response_uses_memories:
+            # Without logging the memories themselves
+            metrics.inc("ai.forced_memory_mentions")
+            memory_summary = ". ".join([mem["content"] for mem in relevant_memories[:2]])
+            ai_response = f"Recuerdo que me contaste: {memory_summary}. ¡Son momentos muy especiales!"
+
+    # Limit response to maximum 2 sentences
+    return limit_sentences(ai_response, 2)
+
+
+async def prepare_turn(memory_manager, user_message, locale=DEFAULT_LOCALE):
+    """
+    Cancellable phase of a turn: family-message lookup, memory retrieval and
+    the Gemini call. Nothing conversational is written here, so the turn can be
+    superseded while the user keeps talking.
+    Returns a dict that commit_turn() persists and sends to the client.
+    """
+    # Zero-LLM fast path: greetings, thanks and short acknowledgements are
+    # answered from the phrase table (the turn is still recorded on commit)
+    fast_response = fast_responder.respond(user_message, locale)
+    if fast_response is not None:
+        print(f"⚡ Respuesta rápida sin LLM para '{user_message}'")
+        return {"user_message": user_message, "ai_response": fast_response, "save_memory": False}
+
+    # Per-message pre-processing: family-message request, today, memory flags
+    analysis = analyze_utterance(user_message)
+    is_family_request = analysis["is_family_request"]
+    asking_today = analysis["asking_today"]
+    
+    print(f"🔍 is_family_request={is_family_request}, asking_today={asking_today}")
+
+    # Handle family message requests (if Telegram bot is configured)
+    if is_family_request and telegram_bot:
+        try:
+            print(f"🔍 Detectada solicitud de mensajes familiares: '{user_message}'")
+            
+            # Analyze user intent to determine which messages to fetch
+            intent = detect_message_intent(user_message)
+            
+            # Fetch messages based on detected intent
+            if intent["has_explicit_date"]:
+                # Get messages from specific date requested
+                messages = await telegram_bot.get_messages_by_date(intent["explicit_date"])
+                message_type = f"del {intent['explicit_date']}"
+            elif intent["wants_old_messages"] or any(word in user_message.lower() for word in ["antiguos", "todos", "historial"]):
+                # Get all historical messages
+                messages = await telegram_bot.get_all_messages()
+                message_type = "guardados"
+            else:
+                # Get unread messages (default)
+                messages = await telegram_bot.get_unread_messages()
+                message_type = "nuevos"
+            
+            print(f"📬 Mensajes {message_type} encontrados: {len(messages)}")
+            
+            # If messages found, send them with AI confirmation
+            if messages:
+                # Generate brief confirmation message using AI
+                prompt = FAMILY_MESSAGES_PROMPT.format(
+                    count=len(messages),
+                    user_message=user_message
+                )
+                
+                try:
+                    # Query Gemini for brief acknowledgement
+                    gemini = get_gemini_client()
+                    if gemini:
+                        generation_config = get_genai().types.GenerationConfig(
+                            max_output_tokens=1000,
+                            temperature=0.3
+                        )
+                        # Usa el cliente global
+                        response = await gemini.generate_content_async(prompt, generation_config=generation_config)
+                    else:
+                        raise Exception("GEMINI_CLIENT no está configurado")
+                    ai_response = response.text.strip()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print("Error generando respuesta breve:", e)
+                    # Fallback simple message if AI fails
+                    ai_response = f"Tienes {len(messages)} mensajes {message_type}."
+                
+                print(f"✅ Enviados {len(messages)} mensajes {message_type} para lectura")
+                return {
+                    "user_message": user_message,
+                    "payload": {
+                        "type": "message",
+                        "text": ai_response,
+                        "has_family_messages": True,
+                        "messages": messages[:100]  # Limit to first 100
+                    }
+                }
+            
+            # No messages found - compose appropriate response
+            if intent["has_explicit_date"]:
+                ai_response = f"No tienes mensajes del {intent['explicit_date']}, querida."
+            elif intent["wants_old_messages"]:
+                ai_response = "No tienes mensajes guardados todavía, querida."
+            else:
+                ai_response = "No tienes mensajes nuevos de tus familiares en este momento, querida."
+            return {"user_message": user_message, "payload": {"type": "message", "text": ai_response}}
+            
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Error leyendo mensajes familiares: {e}")
+            traceback.print_exc()
+            # Error handling response
+            ai_response = "Lo siento querida, he tenido un problema al revisar tus mensajes. Intenta preguntarme de nuevo en un momento."
+            return {"user_message": user_message, "payload": {"type": "message", "text": ai_response}}
+
+    # Retrieve relevant memories for context in AI response
+    # Read-only here: last_recalled is updated in the turn's unit of work
+    with metrics.timer("turn.retrieval"):
+        relevant_memories = await memory_manager.get_relevant_memories(user_message, touch=False)
+    # Format memories for inclusion in AI prompt
+    memory_context = ""
+    if relevant_memories:
+        memory_context = "\n".join([f"- {mem['content']}" for mem in relevant_memories])
+
+    # The memory itself is written in commit_turn, once the turn is final
+    memory_saved = analysis["saves_memory"]
+    is_memory_question = False
+
+    try:
+        # Validate Gemini API is configured
+        if not get_gemini_client():
+            ai_response = "Error: El asistente de IA no está configurado."
+        else:
+            # Check if user is asking about memories/past
+            is_memory_question = analysis["is_memory_question"]
+
+            # Repeated questions are answered from the per-device cache;
+            # turns that store a new memory always get a fresh reply
+            cached_response = None
+            if not memory_saved:
+                cached_response = response_cache.get(memory_manager.device_id, user_message, memory_context)
+
+            if cached_response is not None:
+                print("💾 Respuesta servida desde la caché de preguntas repetidas")
+                ai_response = cached_response
+            else:
+                with metrics.timer("turn.llm"):
+                    ai_response = await generate_ai_response(
+                        user_message, memory_context, relevant_memories, is_memory_question
+                    )
+                if not memory_saved:
+                    response_cache.put(memory_manager.device_id, user_message, memory_context, ai_response)
+
+            # Add memory confirmation if a new memory is being saved
+            if memory_saved and "recuerdo" not in ai_response.lower():
+                ai_response += " ¡Qué bonito recuerdo! Lo guardaré en tu cofre especial."
+
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # Fallback responses if Gemini API fails
+        print("Error Gemini API:", e)
+        traceback.print_exc()
+
+        if memory_saved:
+            # Generate response confirming memory was saved
+            memory_count = len((await memory_manager.load_memory())["important_memories"])
+            ai_response = f"¡Qué bonito recuerdo! Lo he guardado en tu cofre. Ya tienes {memory_count} recuerdos especiales conmigo."
+        elif memory_context and is_memory_question:
+            # Present relevant memories if available
+            memory_list = "\n".join([f"- {mem['content']}" for mem in relevant_memories])
+            ai_response = f"Tus recuerdos especiales:\n{memory_list}\n\n¿Te gustaría que hablemos más de alguno?"
+        else:
+            # Default fallback message
+            ai_response = "Estoy aquí para acompañarte. ¿Podrías contarme más sobre lo que necesitas?"
+
+    return {
+        "user_message": user_message,
+        "ai_response": ai_response,
+        "save_memory": memory_saved,
+        "recalled_ids": [mem["id"] for mem in relevant_memories]
+    }
+
+
+async def commit_turn(websocket, memory_manager, turn, message_ids=()):
+    """
+    Persistent phase of a turn: saves the memory and the conversation entry,
+    sends a single data_update and then the assistant response.
+    The reply frames are kept in the dedup window under the client message ids.
+    """
+    reply_frames = []
+
+    # Family-message answers are only sent, not recorded
+    if "payload" in turn:
+        payload = dict(turn["payload"])
+        if message_ids:
+            payload["reply_to"] = list(message_ids)
+        try:
+            await send_frame(websocket, payload)
+        except Exception as e:
+            print("Error enviando respuesta por websocket:", e)
+        message_dedup.complete(memory_manager.device_id, message_ids, [payload])
+        return
+
+    user_message = turn["user_message"]
+    ai_response = turn["ai_response"]
+
+    # All the turn's writes (new memory, last_recalled, conversation entry) in one transaction
+    unit_of_work = TurnUnitOfWork(memory_manager.device_id)
+    if turn["save_memory"]:
+        unit_of_work.add_memory(user_message, "personal")
+    unit_of_work.mark_recalled(turn.get("recalled_ids", ()))
+    unit_of_work.append_conversation(user_message, ai_response)
+
+    try:
+        with metrics.timer("turn.persist"):
+            await unit_of_work.commit()
+        print(f"✅ Conversación guardada en DB para {memory_manager.device_id}")
+        usage_rollups.record(memory_manager.device_id, "turns")
+        if unit_of_work.saved_memory:
+            usage_rollups.record(memory_manager.device_id, "memories_saved")
+    except Exception as e:
+        print("Warning: fallo guardando conversación:", e)
+        traceback.print_exc()
+
+    if unit_of_work.saved_memory:
+        new_memory = unit_of_work.saved_memory
+        # People, places, era and category are extracted in the background
+        memory_enrichment.submit(memory_manager.device_id, new_memory['id'])
+        print(f"✅ Recuerdo guardado: {new_memory['id']} - '{user_message[:50]}...'")
+        confirmation = "📝 He guardado este recuerdo especial en tu cofre."
+        memory_frame = {
+            "type": "memory_saved",
+            "text": confirmation,
+            "memory_id": new_memory['id']
+        }
+        reply_frames.append(memory_frame)
+        try:
+            await send_frame(websocket, memory_frame)
+        except Exception as e:
+            print(f"Error enviando confirmación de recuerdo: {e}")
+
+    # The data_update reuses the state loaded by the unit of work (no reloads)
+    if unit_of_work.conversation_history is not None:
+        try:
+            with metrics.timer("turn.data_update"):
+                await send_data_update_to_client(
+                    websocket,
+                    unit_of_work.user_memory,
+                    unit_of_work.conversation_history
+                )
+        except Exception as e:
+            print("Warning: fallo enviando data_update:", e)
+
+    # Send AI response to client
+    payload = {"type": "message", "text": ai_response}
+    if message_ids:
+        payload["reply_to"] = list(message_ids)
+    reply_frames.append(payload)
+    message_dedup.complete(memory_manager.device_id, message_ids, reply_frames)
+    try:
+        await send_frame(websocket, payload)
+    except Exception as e:
+        print("Error enviando respuesta por websocket:", e)
+
+
+async def replay_cached_reply(websocket, entry, on_lost=None, timeout=60.0):
+    """
+    Re-sends the reply of an already processed (or in-flight) client message.
+    If the original turn is discarded (e.g. its connection closed before the
+    commit), on_lost() is called so the retry is processed from scratch.
+    """
+    try:
+        frames = await asyncio.wait_for(asyncio.shield(entry.future), timeout=timeout)
+    except asyncio.TimeoutError:
+        return
+    except asyncio.CancelledError:
+        if entry.future.cancelled() and on_lost:
+            on_lost()
+        return
+    for frame in frames:
+        try:
+            await send_frame(websocket, frame)
+        except Exception as e:
+            print("Error reenviando respuesta cacheada:", e)
+            return
+
+
 # ============================================
 # WEBSOCKET ENDPOINT - Main communication channel
 # ============================================
@@ -626,100 +942,43 @@ async def send_data_update_to_client(websocket, memory_data, conversation_data):
 async def websocket_endpoint(websocket: WebSocket):
     # Accept incoming WebSocket connection
     try:
-        await asyncio.wait_for(websocket.accept(), timeout=10.0)
+        # Negotiates the frame codec (JSON/MessagePack) while accepting
+        await asyncio.wait_for(ws_protocol.accept(websocket), timeout=10.0)
     except asyncio.TimeoutError:
         print("❌ Timeout aceptando conexión WebSocket")
         return
     
     print("✅ Nueva conexión WebSocket establecida")
+    handshake_started = time.perf_counter()
     
     # We don't need to load from file anymore, will use DB
     device_id = None
     device_code = None
     db_chat_id = None  # Variable to store chat_id from DB
+    turn_queue = None
+    locale = DEFAULT_LOCALE
     
     try:
         # Attempt to receive initial handshake data from client
         initial_data = None
         try:
-            initial_msg = await asyncio.wait_for(websocket.receive_text(), timeout=5.0)
-            data = json.loads(initial_msg)
+            data = await asyncio.wait_for(receive_frame(websocket), timeout=5.0)
             # Extract device info from initial message
-            if data.get("type") == "initial_data":
+            if data and data.get("type") == "initial_data":
                 initial_data = data.get("data", {})
                 device_id = initial_data.get("device_id")
                 device_code = initial_data.get("device_code")
+                # Optional client locale (e.g. "es-ES") for the fast-path phrase tables
+                if initial_data.get("locale"):
+                    locale = str(initial_data["locale"]).split("-")[0].lower()
                 print(f"📥 Datos iniciales recibidos - Device: {device_id} - Código: {device_code}")
-        except (asyncio.TimeoutError, json.JSONDecodeError, KeyError):
+        except (asyncio.TimeoutError, ProtocolError, KeyError):
             print("ℹ️ Cliente no envió datos iniciales")
         
-        # Generate new device code if not provided by client
-        if not device_id or not device_code:
-            # Check existing codes in database
-            async with async_session() as session:
-                result = await session.execute(select(DeviceData.device_code))
-                existing_codes = [r[0] for r in result if r[0] is not None]
-                
-            device_code = generate_unique_device_code(existing_codes)
-            device_id = f"device_{device_code}"
-            print(f"🆕 New device generated: {device_id} - Code: {device_code}")
-        else:
-            # Validate existing device code
-            async with async_session() as session:
-                stmt = select(DeviceData).where(DeviceData.device_id == device_id)
-                result = await session.execute(stmt)
-                device_data = result.scalar_one_or_none()
-                
-                if device_data:
-                    # Reconnecting device - verify code matches
-                    if device_data.device_code != device_code:
-                        print(f"⚠️ Code conflict detected - using existing code")
-                        device_code = device_data.device_code
-                    print(f"🔄 Existing device reconnected: {device_id} - Code: {device_code}")
-                else:
-                    # New device with client-provided ID
-                    print(f"✅ New device registered: {device_id} - Code: {device_code}")
-        
-        # --- BLOQUE CORREGIDO ---
-        # Register or update device in database
-        async with async_session() as session:
-            # 1. Look for the device by ID
-            stmt = select(DeviceData).where(DeviceData.device_id == device_id)
-            result = await session.execute(stmt)
-            device_data = result.scalar_one_or_none()
-
-            if not device_data:
-                # 2. If it doesn't exist, create it with device_id and device_code
-                print(f"🆕 Creating new DB entry for {device_id} with code {device_code}")
-                device_data = DeviceData(
-                    device_id=device_id,
-                    device_code=device_code,
-                    user_memory={},  # Set default values
-                    conversation_history=[]  # Set default values
-                )
-                session.add(device_data)
-                db_chat_id = None # New device, no chat ID
-            
-            else:
-                # 3. If it exists, update its device_code if needed
-                if device_data.device_code != device_code:
-                    print(f" Updating device_code in DB for {device_id}")
-                    # --- FIX FOR BUG 1 ---
-                    device_data.device_code = device_code # Correctly update to the code from the client
-                
-                # --- FIX FOR BUG 2 (CRASH) ---
-                # We must now query the UserConnections table to find an associated chat
-                stmt_conn = select(UserConnections.telegram_chat_id).where(
-                    UserConnections.device_id == device_id
-                ).limit(1)
-                result_conn = await session.execute(stmt_conn)
-                chat_id_tuple = result_conn.first()
-                db_chat_id = chat_id_tuple[0] if chat_id_tuple else None
-                # --- END FIX ---
-                
-            await session.commit()
-        # --- FIN BLOQUE CORREGIDO ---
-            
+        # Register the device (or mark the reconnection) and read its code and
+        # connected chat in a single upsert; a new code is generated if missing
+        with query_scope("ws.handshake"):
+            device_id, device_code, db_chat_id = await register_device(device_id, device_code)
         print(f"📱 Device {device_id} (code {device_code}) ready in DB.")
 
         # Initialize memory manager for this device
@@ -730,14 +989,16 @@ async def websocket_endpoint(websocket: WebSocket):
         print(f"🔌 WebSocket registered for device {device_id}")
         
         # Send device information immediately to client for identification
-        await websocket.send_text(json.dumps({
+        await send_frame(websocket, {
             "type": "device_info",
             "device_id": device_id,
             "device_code": device_code,
             "connected_chat": db_chat_id  # Use chat_id from DB
-        }, ensure_ascii=False))
+        })
 
         print(f"📤 Device information sent - Code available: {device_code}")
+        metrics.observe("ws.handshake", time.perf_counter() - handshake_started)
+        metrics.inc("ws.connections")
         
         # Send initial welcome greeting based on current time of day
         try:
@@ -754,71 +1015,68 @@ async def websocket_endpoint(websocket: WebSocket):
             # Compose and send welcome message
             welcome_text = f"{greeting} querida, soy Compa. Estoy aquí para acompañarte. ¿Cómo te sientes?"
             
-            await websocket.send_text(json.dumps({
+            await send_frame(websocket, {
                 "type": "message",
                 "text": welcome_text
-            }, ensure_ascii=False))
+            })
             
             print(f"👋 Mensaje de bienvenida enviado")
             
         except Exception as e:
             print(f"⚠️ Error enviando mensaje de bienvenida: {e}")
 
-        # Flags for conversation state management
-        awaiting_read_confirmation = False
-        pending_family_messages = []
+        # Per-device inbound queue: final fragments that arrive within the
+        # debounce window are merged into a single turn
+        turn_queue = TurnQueue(
+            functools.partial(prepare_turn, memory_manager, locale=locale),
+            functools.partial(commit_turn, websocket, memory_manager),
+            on_discard=functools.partial(message_dedup.discard, device_id)
+        )
 
         # Main message processing loop
         while True:
             try:
-                # Wait for incoming message from client (300 second timeout)
-                data = await asyncio.wait_for(websocket.receive_text(), timeout=300.0)
-                raw = data.strip()
+                # Wait for incoming frame from client (300 second timeout)
+                try:
+                    frame = await asyncio.wait_for(receive_frame(websocket), timeout=300.0)
+                except ProtocolError as e:
+                    print(f"⚠️ Frame inválido de {device_id}: {e}")
+                    continue
                 # Skip empty messages
-                if not raw:
+                if not frame:
                     continue
 
-                # ===============================================================
-                # INICIO: Bloque try/except para JSON (Keepalive/Respuestas)
-                # (Esto ya lo tenías bien, es para confirmar)
-                # ===============================================================
-                try:
-                    # Attempt to parse message as JSON
-                    maybe = json.loads(raw)
-                    
-                    # Handle connection response (user approving/denying Telegram link)
-                    if isinstance(maybe, dict) and maybe.get("type") == "connection_response":
-                        request_id = maybe.get("request_id")
-                        approved = maybe.get("approved", False)
-                        
-                        # Process connection approval through Telegram bot
-                        if telegram_bot:
-                            await telegram_bot.process_connection_response(
-                                request_id, 
-                                approved, 
-                                websocket
-                            )
-                        continue # Salta al siguiente ciclo del bucle
-                    
-                    # Handle keepalive ping-pong to maintain connection
-                    if isinstance(maybe, dict) and maybe.get("type") == "keepalive":
-                        try:
-                            await websocket.send_text(json.dumps({"type": "pong", "ts": datetime.now().timestamp()}, ensure_ascii=False))
-                        except:
-                            # Fallback simple pong if JSON fails
-                            try:
-                                await websocket.send_text("pong")
-                            except:
-                                pass
-                        print(f"📶 Keepalive recibido: {maybe.get('ts')}")
-                        continue # Salta al siguiente ciclo del bucle
-                        
-                except Exception:
-                    # If not JSON, treat as plain text user message
-                    pass
-                # ===============================================================
-                # FIN: Bloque try/except para JSON
-                # ===============================================================
+                frame_type = frame["type"]
+                message_id = None
+
+                # Client utterance, with an optional idempotency id
+                if frame_type == "utterance":
+                    message_id = str(frame.get("id") or "") or None
+                    raw = frame["text"].strip()
+
+                # Handle connection response (user approving/denying Telegram link)
+                elif frame_type == "connection_response":
+                    # Process connection approval through Telegram bot
+                    if telegram_bot:
+                        await telegram_bot.process_connection_response(
+                            frame["request_id"],
+                            frame.get("approved", False),
+                            websocket
+                        )
+                    continue
+
+                # Handle keepalive ping-pong to maintain connection
+                elif frame_type == "keepalive":
+                    try:
+                        await send_frame(websocket, {"type": "pong", "ts": datetime.now().timestamp()})
+                    except Exception:
+                        pass
+                    print(f"📶 Keepalive recibido: {frame.get('ts')}")
+                    continue
+
+                else:
+                    # initial_data again or other frames not handled mid-session
+                    continue
 
                 user_message = raw
                 # Skip if message is empty after parsing
@@ -827,267 +1085,37 @@ async def websocket_endpoint(websocket: WebSocket):
 
                 print(f"📥 Mensaje recibido: {user_message}")
                 
-                # Keywords that indicate user is asking about family messages
-                family_keywords = [
-                    "mensaje", "mensajes", "familiar", "familiares", "familia",
-                    "léeme", "lee", "leer", "dime", "cuéntame", "hay", "tienes", "tengo"
-                ]
-                
-                # Detect if message is about family messages
-                is_about_messages = any(word in user_message.lower() for word in ["mensaje", "familia", "familiar"])
-                is_family_request = is_about_messages and any(word in user_message.lower() for word in family_keywords)
-                
-                # Check if user is asking about today's messages
-                asking_today = any(word in user_message.lower() for word in ["hoy", "día de hoy", "del día", "de hoy"])
+                # Retried message: answer from the dedup window instead of recomputing
+                if message_id:
+                    state, entry = message_dedup.begin(device_id, message_id)
+                    if state in (DONE, PENDING):
+                        print(f"♻️ Mensaje {message_id} repetido ({state}), reenviando respuesta")
+
+                        def requeue(text=user_message, mid=message_id):
+                            message_dedup.begin(device_id, mid)
+                            turn_queue.put(text, mid)
+
+                        asyncio.create_task(replay_cached_reply(websocket, entry, requeue))
+                        continue
                 
-                print(f"🔍 is_family_request={is_family_request}, asking_today={asking_today}")
-
-                # Handle family message requests (if Telegram bot is configured)
-                if is_family_request and telegram_bot:
+                # Queue the fragment; a generation in flight is superseded
+                if not turn_queue.put(user_message, message_id):
+                    print(f"⚠️ Cola de turnos llena para {device_id}, fragmento descartado")
+                    message_dedup.discard(device_id, [message_id] if message_id else [])
+                    busy = {"type": "busy", "text": "Un momento, querida, todavía estoy pensando."}
+                    if message_id:
+                        # The client stops resending the dropped fragment
+                        busy["reply_to"] = [message_id]
                     try:
-                        print(f"🔍 Detectada solicitud de mensajes familiares: '{user_message}'")
-                        
-                        # Analyze user intent to determine which messages to fetch
-                        intent = detect_message_intent(user_message)
-                        
-                        # Fetch messages based on detected intent
-                        if intent["has_explicit_date"]:
-                            # Get messages from specific date requested
-                            messages = await telegram_bot.get_messages_by_date(intent["explicit_date"])
-                            message_type = f"del {intent['explicit_date']}"
-                        elif intent["wants_old_messages"] or any(word in user_message.lower() for word in ["antiguos", "todos", "historial"]):
-                            # Get all historical messages
-                            messages = await telegram_bot.get_all_messages()
-                            message_type = "guardados"
-                        else:
-                            # Get unread messages (default)
-                            messages = await telegram_bot.get_unread_messages()
-                            message_type = "nuevos"
-                        
-                        print(f"📬 Mensajes {message_type} encontrados: {len(messages)}")
-                        
-                        # If messages found, send them with AI confirmation
-                        if messages:
-                            # Generate brief confirmation message using AI
-                            prompt = FAMILY_MESSAGES_PROMPT.format(
-                                count=len(messages),
-                                user_message=user_message
-                            )
-                            
-                            try:
-                                # Query Gemini for brief acknowledgement
-                                if GEMINI_CLIENT:
-                                    generation_config = genai.types.GenerationConfig(
-                                        max_output_tokens=1000,
-                                        temperature=0.3
-                                    )
-                                    # Usa el cliente global
-                                    response = GEMINI_CLIENT.generate_content(prompt, generation_config=generation_config)
-                                else:
-                                    raise Exception("GEMINI_CLIENT no está configurado")
-                                ai_response = response.text.strip()
-                            except Exception as e:
-                                print("Error generando respuesta breve:", e)
-                                # Fallback simple message if AI fails
-                                ai_response = f"Tienes {len(messages)} mensajes {message_type}."
-                            
-                            # Send confirmation and messages to client
-                            await websocket.send_text(json.dumps({
-                                "type": "message",
-                                "text": ai_response,
-                                "has_family_messages": True,
-                                "messages": messages[:100]  # Limit to first 100
-                            }, ensure_ascii=False))
-                            
-                            print(f"✅ Enviados {len(messages)} mensajes {message_type} para lectura")
-                            
-                        else:
-                            # No messages found - compose appropriate response
-                            if intent["has_explicit_date"]:
-                                ai_response = f"No tienes mensajes del {intent['explicit_date']}, querida."
-                            elif intent["wants_old_messages"]:
-                                ai_response = "No tienes mensajes guardados todavía, querida."
-                            else:
-                                ai_response = "No tienes mensajes nuevos de tus familiares en este momento, querida."
-                            
-                            await websocket.send_text(json.dumps({
-                                "type": "message", 
-                                "text": ai_response
-                            }, ensure_ascii=False))
-                        
-                        continue # Importante: salta al siguiente ciclo
-                        
-                    except Exception as e:
-                        print(f"❌ Error leyendo mensajes familiares: {e}")
-                        traceback.print_exc()
-                        # Error handling response
-                        ai_response = "Lo siento querida, he tenido un problema al revisar tus mensajes. Intenta preguntarme de nuevo en un momento."
-                        try:
-                            await websocket.send_text(json.dumps({"type": "message", "text": ai_response}, ensure_ascii=False))
-                        except:
-                            pass
-                        continue # Importante: salta al siguiente ciclo
-
-                # Retrieve relevant memories for context in AI response
-                relevant_memories = await memory_manager.get_relevant_memories(user_message)
-                # Format memories for inclusion in AI prompt
-                memory_context = ""
-                if relevant_memories:
-                    memory_context = "\n".join([f"- {mem['content']}" for mem in relevant_memories])
-                        
-                # --- INICIO DE LA SOLUCIÓN DE BUG ---
-                # Inicializa las variables ANTES del 'if'.
-                # Esto soluciona el error de Pylance "new_memory is not defined",
-                # asegurando que la variable siempre exista.
-                memory_saved = False
-                new_memory = None 
-                # --- FIN DE LA SOLUCIÓN DE BUG ---
-
-                if memory_regex.search(user_message) and not is_question(user_message):
-                    memory_saved = True
-                    new_memory = await memory_manager.add_important_memory(user_message, "personal")
-                    print(f"✅ Recuerdo guardado: {new_memory['id']} - '{user_message[:50]}...'")
-                
-                    confirmation = "📝 He guardado este recuerdo especial en tu cofre."
-                    try:
-                        await websocket.send_text(json.dumps({
-                            "type": "memory_saved",
-                            "text": confirmation,
-                            "memory_id": new_memory['id']
-                        }, ensure_ascii=False))
-                    except Exception as e:
-                        print(f"Error enviando confirmación: {e}")
-                    
-                    updated_memory = await memory_manager.load_memory()
-                    conversation_history = await load_conversation_from_db(device_id)
-                    await send_data_update_to_client(websocket, updated_memory, conversation_history)
-
-                try:
-                    # Validate Gemini API is configured
-                    if not GEMINI_CLIENT:
-                        ai_response = "Error: El asistente de IA no está configurado."
-                    else:
-                        # Configure generation parameters for consistency
-                        generation_config = genai.types.GenerationConfig(
-                            max_output_tokens=250,
-                            temperature=0.4,
-                        )
-
-                        # Check if user is asking about memories/past
-                        is_memory_question = any(keyword in user_message.lower() for keyword in 
-                                                 ["recuerdo", "recuerdos", "acuerdo", "memoria", "pasado", "cuando", "antes"])
-
-                        # Customize prompt...
-                        if is_memory_question and memory_context:
-                            full_prompt = f"""
-Eres "Compa", un asistente especializado en Alzheimer. Responde con frases cortas y tono afectuoso.
-INFORMACIÓN CRÍTICA - ESTOS SON LOS RECUERDOS REALES DEL USUARIO:
-{memory_context}
-El usuario te pregunta: "{user_message}"
-RESPONDE mencionando específicamente los recuerdos de arriba. Si no encajan perfectamente, adapta tu respuesta afectivamente.
-Tu respuesta (1-2 frases, mencionando los recuerdos):
-"""
-                        elif is_memory_question and not memory_context:
-                            full_prompt = f"""
-Eres "Compa", un asistente especializado en Alzheimer.
-El usuario pregunta: "{user_message}"
-No tengo recuerdos específicos guardados sobre este tema. Responde con empatía.
-Tu respuesta (1-2 frases, ofreciendo ayuda):
-"""
-                        else:
-                            full_prompt = f"""
-Eres "Compa", un asistente especializado en Alzheimer.
-{f"CONTEXTO DEL USUARIO: {memory_context}" if memory_context else ""}
-Usuario: {user_message}
-Tu respuesta (1-2 frases, tono afectuoso):
-"""
-
-                        print(f"DEBUG: Prompt enviado: {full_prompt}")
-
-                        # Call Gemini API to generate response (using global client)
-                        response = GEMINI_CLIENT.generate_content(full_prompt)
-                        ai_response = response.text.strip()
-
-                        print(f"DEBUG: Respuesta cruda: {ai_response}")
-
-                        # Verify response mentions memories if relevant memories exist
-                        if is_memory_question and memory_context:
-                            response_uses_memories = any(
-                                any(word in mem["content"].lower() for word in ai_response.lower().split()[:100])
-                                for mem in relevant_memories
-                            )
-
-                            if not response_uses_memories:
-                                print("DEBUG: Forzando mención de recuerdos...")
-                                memory_summary = ". ".join([mem["content"] for mem in relevant_memories[:2]])
-                                ai_response = f"Recuerdo que me contaste: {memory_summary}. ¡Son momentos muy especiales!"
-
-                        # Limit response to maximum 2 sentences
-                        sentences = [s.strip() for s in ai_response.split('.') if s.strip()]
-                        if len(sentences) > 2:
-                            ai_response = '. '.join(sentences[:2]) + '.'
-
-                        # Add memory confirmation if a new memory was just saved
-                        if memory_saved and "recuerdo" not in ai_response.lower():
-                            ai_response += " ¡Qué bonito recuerdo! Lo guardaré en tu cofre especial."
-
-                except Exception as e:
-                    # Fallback responses if Gemini API fails
-                    print("Error Gemini API:", e)
-                    traceback.print_exc()
-
-                    if memory_saved:
-                        # Generate response confirming memory was saved
-                        memory_count = len((await memory_manager.load_memory())["important_memories"])
-                        ai_response = f"¡Qué bonito recuerdo! Lo he guardado en tu cofre. Ya tienes {memory_count} recuerdos especiales conmigo."
-                    elif memory_context and is_memory_question:
-                        # Present relevant memories if available
-                        memory_list = "\n".join([f"- {mem['content']}" for mem in relevant_memories])
-                        ai_response = f"Tus recuerdos especiales:\n{memory_list}\n\n¿Te gustaría que hablemos más de alguno?"
-                    else:
-                        # Default fallback message
-                        ai_response = "Estoy aquí para acompañarte. ¿Podrías contarme más sobre lo que necesitas?"
-
-                try:
-                    # Save conversation turn to persistent history
-                    await memory_manager.save_conversation(user_message, ai_response)
-                    
-                    # Load updated conversation history from DB
-                    try:
-                        # Mueve estas importaciones al inicio del archivo
-                        # from backend.database import async_session, DeviceData
-                        # from sqlalchemy import select
-                        
-                        async with async_session() as session:
-                            stmt = select(DeviceData).where(DeviceData.device_id == device_id)
-                            result = await session.execute(stmt)
-                            device_data = result.scalar_one_or_none()
-                            conversation_history = device_data.conversation_history if device_data else []
-                    except Exception as e:
-                        print(f"Error cargando historial: {e}")
-                        conversation_history = []
-                        
-                    updated_memory = await memory_manager.load_memory()
-                    await send_data_update_to_client(
-                        websocket, 
-                        updated_memory, 
-                        conversation_history
-                    )
-                except Exception as e:
-                    print("Warning: fallo guardando conversación:", e)
-
-                try:
-                    # Send AI response to client
-                    payload = {"type": "message", "text": ai_response}
-                    await websocket.send_text(json.dumps(payload, ensure_ascii=False))
-                except Exception as e:
-                    print("Error enviando respuesta por websocket:", e)
+                        await send_frame(websocket, busy)
+                    except Exception:
+                        pass
 
             except asyncio.TimeoutError as e:
                 # Send periodic ping to detect stale connections and log the timeout
                 print("asyncio.TimeoutError while waiting for client message:", e)
                 try:
-                    await websocket.send_text(json.dumps({"type":"ping","ts":datetime.now().timestamp()}, ensure_ascii=False))
+                    await send_frame(websocket, {"type": "ping", "ts": datetime.now().timestamp()})
                 except Exception as send_err:
                     print("Error sending ping to client:", send_err)
                 continue # Continúa el bucle while
@@ -1107,9 +1135,13 @@ Tu respuesta (1-2 frases, tono afectuoso):
         traceback.print_exc()
         try:
             # Attempt to send error message to client
-            await websocket.send_text(json.dumps({"type":"error","text":"Lo siento, ha ocurrido un error. Por favor inténtalo de nuevo."}, ensure_ascii=False))
+            await send_frame(websocket, {"type": "error", "text": "Lo siento, ha ocurrido un error. Por favor inténtalo de nuevo."})
         except:
             pass
+    finally:
+        # Stop the turn worker; a turn already committing finishes on its own
+        if turn_queue is not None:
+            await turn_queue.close()
 
 
 # ============================================
@@ -1122,7 +1154,8 @@ async def search_web(query: str):
     """Searches the web for given query and returns top 3 results"""
     try:
         results = []
-        # Use Google search library to find relevant results
+        # Use Google search library to find relevant results (imported on first use)
+        from googlesearch import search
         for result in search(query, num_results=3, lang="es"):
             results.append(result)
         return {"results": results}
@@ -1141,9 +1174,7 @@ async def get_memory_cofre(device_id: str):
     if not device_id:
         raise HTTPException(status_code=400, detail="device_id requerido")
     try:
-        from backend.database import async_session, Memory
-        from sqlalchemy import select
-        async with async_session() as session:
+        async with read_session(device_id) as session:
             # Consultar todas las memorias del dispositivo
             stmt = select(Memory).where(
                 Memory.device_id == device_id
@@ -1156,6 +1187,9 @@ async def get_memory_cofre(device_id: str):
                     "id": mem.id,
                     "content": mem.content,
                     "category": mem.category,
+                    "people": mem.people or [],
+                    "places": mem.places or [],
+                    "era": mem.era,
                     "timestamp": mem.timestamp.isoformat(),
                     "last_recalled": mem.last_recalled.isoformat() if mem.last_recalled else None
                 }
@@ -1187,6 +1221,8 @@ async def add_memory_cofre(memory_data: dict):
     if memory_text:
         # Save new memory with provided content and category
         new_memory = await memory_manager.add_important_memory(memory_text, category)
+        usage_rollups.record(device_id, "memories_saved")
+        memory_enrichment.submit(device_id, new_memory["id"])
         return {"message": "Recuerdo guardado exitosamente", "memory": new_memory}
     else:
         raise HTTPException(status_code=400, detail="El contenido del recuerdo no puede estar vacío")
@@ -1259,7 +1295,7 @@ async def get_family_messages(device_id: str = Query(...)):
         raise HTTPException(status_code=503, detail="Bot de Telegram no configurado")
     
     try:
-        async with async_session() as session:
+        async with read_session(device_id) as session:
             # 1. Obtener mensajes no leídos para este device_id
             stmt_unread = (
                 select(FamilyMessages)
@@ -1290,7 +1326,8 @@ async def get_family_messages(device_id: str = Query(...)):
                 "timestamp": msg.timestamp.isoformat(),
                 "date": msg.timestamp.strftime("%d/%m/%Y"), 
                 "time": msg.timestamp.strftime("%H:%M"),
-                "read": msg.read
+                "read": msg.read,
+                "media": media_info(msg)  # Nota de voz o foto (None si es solo texto)
             }
 
         unread_json = [format_msg(m) for m in unread_messages]
@@ -1307,6 +1344,12 @@ async def get_family_messages(device_id: str = Query(...)):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
+# Voice notes and photos of family messages, by content hash (see media_store.py)
+@app.get("/family/media/{filename}")
+async def get_family_media(filename: str, request: Request):
+    """Sirve un adjunto por trozos, con Range (206), ETag y caché de larga duración"""
+    return media_response(filename, request.headers)
+
 # --- mark_message_read (MODIFICADO) ---
 @app.post("/family/messages/{message_id}/read")
 async def mark_message_read(message_id: int):
@@ -1316,22 +1359,28 @@ async def mark_message_read(message_id: int):
     
     try:
         async with async_session() as session:
+            # Solo la primera lectura devuelve fila: así cada mensaje cuenta una vez en usage_daily
             stmt = (
                 update(FamilyMessages)
-                .where(FamilyMessages.id == message_id)
+                .where(FamilyMessages.id == message_id, FamilyMessages.read == False)
                 .values(read=True)
+                .returning(FamilyMessages.device_id)
             )
-            result = await session.execute(stmt)
+            device_id = (await session.execute(stmt)).scalar()
+            if device_id is None:
+                found = await session.get(FamilyMessages, message_id)
             await session.commit()
-            
-            if result.rowcount == 0:
-                raise HTTPException(status_code=404, detail="Mensaje no encontrado")
-            else:
-                return {"message": "Mensaje marcado como leído", "message_id": message_id}
     except Exception as e:
         print(f"❌ Error en /mark_message_read (DB): {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    if device_id is not None:
+        mark_written(device_id)
+        usage_rollups.record(device_id, "family_messages_read")
+    elif found is None:
+        raise HTTPException(status_code=404, detail="Mensaje no encontrado")
+    return {"message": "Mensaje marcado como leído", "message_id": message_id}
+
 # --- Endpoints /all, /today, /date (OBSOLETOS) ---
 # Los eliminamos para simplificar, ya que get_family_messages ahora devuelve ambos.
 
@@ -1353,103 +1402,156 @@ async def get_messages_by_date(date: str, device_id: str = Query(...)):
 # ADMIN ENDPOINTS
 # ============================================
 
+# Admin listings are aggregated in SQL and paginated by chat_id (see admin.py):
+# pass the "next_after" of a page as ?after= to get the next one
+
 # List all authorized Telegram users
 @app.get("/admin/authorized-users")
-async def get_authorized_users():
-    """Lista usuarios autorizados"""
-    if not telegram_bot:
-        raise HTTPException(status_code=503, detail="Bot no configurado")
-    
+async def get_authorized_users(after: int = Query(None), limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE)):
+    """Lista los chats autorizados (con algún dispositivo conectado)"""
     try:
-        # Retrieve list of authorized Telegram chat IDs
-        users = await telegram_bot.load_authorized_users()
-        return {
-            "authorized_users": users,
-            "total": len(users)
-        }
+        return await admin.list_authorized_chats(after, limit)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-# Authorize a new Telegram user
+# Authorize a Telegram user on a device
 @app.post("/admin/authorize-user")
 async def authorize_user(data: dict):
-    """Autoriza un nuevo usuario
-    Body: {"chat_id": 123456789}
+    """Autoriza un usuario en un dispositivo (como un /connect aprobado)
+    Body: {"chat_id": 123456789, "device_id": "device_123456", "alias": "Mama"}
     """
-    if not telegram_bot:
-        raise HTTPException(status_code=503, detail="Bot no configurado")
-    
     chat_id = data.get("chat_id")
-    if not chat_id:
-        raise HTTPException(status_code=400, detail="chat_id requerido")
+    device_id = data.get("device_id")
+    if not chat_id or not device_id:
+        raise HTTPException(status_code=400, detail="chat_id y device_id requeridos")
     
     try:
-        # Add chat ID to list of authorized users
-        success = await telegram_bot.add_authorized_user(int(chat_id))
-        if success:
-            return {"message": f"Usuario {chat_id} autorizado correctamente"}
-        else:
-            return {"message": f"Usuario {chat_id} ya estaba autorizado"}
+        created = await admin.authorize_chat(int(chat_id), device_id, data.get("alias"))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if created is None:
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    if created:
+        return {"message": f"Usuario {chat_id} autorizado correctamente"}
+    return {"message": f"Usuario {chat_id} ya estaba autorizado (o el alias ya está en uso)"}
 
 # Revoke Telegram user authorization
 @app.post("/admin/revoke-user")
 async def revoke_user(data: dict):
-    """Revoca autorización de un usuario
-    Body: {"chat_id": 123456789}
+    """Revoca la autorización de un usuario (en todos sus dispositivos o en uno)
+    Body: {"chat_id": 123456789, "device_id": "device_123456"}
     """
-    if not telegram_bot:
-        raise HTTPException(status_code=503, detail="Bot no configurado")
-    
     chat_id = data.get("chat_id")
     if not chat_id:
         raise HTTPException(status_code=400, detail="chat_id requerido")
     
     try:
-        # Remove chat ID from authorized users list
-        success = await telegram_bot.remove_authorized_user(int(chat_id))
-        if success:
-            return {"message": f"Usuario {chat_id} revocado correctamente"}
-        else:
-            return {"message": f"Usuario {chat_id} no estaba en la lista"}
+        revoked = await admin.revoke_chat(int(chat_id), data.get("device_id"))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if revoked:
+        return {"message": f"Usuario {chat_id} revocado correctamente", "connections": revoked}
+    return {"message": f"Usuario {chat_id} no estaba en la lista"}
 
-# Show unauthorized access attempts
+# Show who has sent family messages and whether they are authorized
 @app.get("/admin/pending-requests")
-async def get_pending_requests():
-    """Muestra usuarios que intentaron usar el bot sin autorización"""
-    if not telegram_bot:
-        raise HTTPException(status_code=503, detail="Bot no configurado")
-    
+async def get_pending_requests(
+    after: int = Query(None),
+    limit: int = Query(ADMIN_PAGE_SIZE, ge=1, le=ADMIN_MAX_PAGE_SIZE),
+    only_unauthorized: bool = Query(False),
+):
+    """Usuarios que han enviado mensajes, con su estado de autorización"""
     try:
-        # Collect all users who have sent messages and check authorization status
-        messages = await telegram_bot.load_messages()
-        authorized = await telegram_bot.load_authorized_users()
-        
-        # Build user list with authorization status
-        all_users = {}
-        for msg in messages:
-            cid = msg.get("chat_id")
-            sender = msg.get("sender_name")
-            if cid:
-                all_users[cid] = {
-                    "name": sender,
-                    "authorized": cid in authorized
-                }
-        
-        return {
-            "users": [
-                {"chat_id": cid, "name": info["name"], "authorized": info["authorized"]}
-                for cid, info in all_users.items()
-            ],
-            "total": len(all_users)
-        }
+        return await admin.list_message_senders(after, limit, only_unauthorized)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+
+# ============================================
+# USAGE ENDPOINTS
+# ============================================
+
+# Dashboards for caregivers (one device) and operators (all devices), read from
+# the usage_daily rollups: one row per day, never the raw history (see usage_rollups.py)
+
+def _usage_range(start, end):
+    end = end or datetime.utcnow().date()
+    start = start or end - timedelta(days=29)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start debe ser anterior a end")
+    if (end - start).days >= USAGE_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Máximo {USAGE_MAX_DAYS} días por consulta")
+    return start, end
+
+@app.get("/usage/daily")
+async def get_usage_daily(device_id: str = Query(...), start: date = Query(None), end: date = Query(None)):
+    """Turnos, recuerdos guardados y mensajes familiares recibidos/leídos por día de un dispositivo"""
+    start, end = _usage_range(start, end)
+    return await daily_usage(device_id, start, end)
+
+@app.get("/usage/summary")
+async def get_usage_summary(start: date = Query(None), end: date = Query(None)):
+    """Los mismos contadores sumando todos los dispositivos"""
+    start, end = _usage_range(start, end)
+    return await daily_usage(ALL_DEVICES, start, end)
+
+# ============================================
+# ARCHIVO DE CONVERSACIONES
+# ============================================
+
+ARCHIVE_MONTH_PATTERN = r"^\d{4}-\d{2}$"
+
+@app.get("/conversation/archive/months")
+async def get_conversation_archive_months(device_id: str = Query(...)):
+    """Meses archivados de un dispositivo y cuántos turnos tiene cada uno"""
+    months = await asyncio.to_thread(conversation_archive.months, device_id)
+    return {"device_id": device_id, "months": months, "total_entries": sum(m["entries"] for m in months)}
+
+@app.get("/conversation/archive")
+async def get_conversation_archive(
+    device_id: str = Query(...),
+    start: str = Query(None, pattern=ARCHIVE_MONTH_PATTERN),
+    end: str = Query(None, pattern=ARCHIVE_MONTH_PATTERN),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(None, ge=1),
+):
+    """Turnos archivados (meses AAAA-MM entre start y end) en NDJSON, una línea por turno"""
+    if start and end and start > end:
+        raise HTTPException(status_code=400, detail="start debe ser anterior a end")
+    entries = conversation_archive.iter_entries(device_id, start, end, offset, limit)
+    # Generador síncrono: Starlette lo recorre en el threadpool, sin bloquear el bucle
+    lines = (json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+# ============================================
+# EXPORTACIÓN E IMPORTACIÓN DE DISPOSITIVOS
+# ============================================
+
+@app.get("/device/export")
+async def export_device_data(device_id: str = Query(...)):
+    """Recuerdos, conversación (incluida la archivada) y mensajes familiares del dispositivo en NDJSON"""
+    lines = await export_device(device_id)
+    if lines is None:
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    filename = re.sub(r"[^A-Za-z0-9_.-]", "_", device_id)
+    return StreamingResponse(
+        lines,
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.ndjson"'},
+    )
+
+@app.post("/device/import")
+async def import_device_data(request: Request, device_id: str = Query(...)):
+    """Restaura en device_id un fichero de /device/export (el cuerpo se lee en streaming)"""
+    try:
+        counts = await import_device(device_id, request.stream())
+    except DeviceImportError as e:
+        # Se valida todo el fichero antes de escribir: no queda nada a medias
+        raise HTTPException(status_code=400, detail=str(e))
+    print(f"📦 Importación en {device_id}: {counts}")
+    return {"device_id": device_id, "imported": counts}
+
 # ... (en backend/main.py)
 
 # ============================================
@@ -1468,7 +1570,7 @@ async def auth_with_telegram(request: Request, token: str):
             
             # 1. Buscar el token en la tabla (que reutilizamos)
             stmt = select(PhoneVerification).where(
-                PhoneVerification.verification_code == token,
+                PhoneVerification.code_hash == hash_token(token),
                 PhoneVerification.expires_at > datetime.utcnow()
             )
             result = await session.execute(stmt)
@@ -1486,10 +1588,10 @@ async def auth_with_telegram(request: Request, token: str):
             )
             
             # 4. Crear la sesión de usuario (la que se usará para siempre)
-            session_token = secrets.token_urlsafe(32)
+            session_token = new_token()
             new_session = UserSession(
                 phone_number=chat_id_str, # Guardamos el chat_id como identificador
-                session_token=session_token,
+                token_hash=hash_token(session_token), # Solo el resumen; el token va en la cookie
                 verified=True,
                 expires_at = datetime.utcnow() + timedelta(days=365) # Sesión de 1 año
             )
@@ -1535,12 +1637,6 @@ script_dir = os.path.dirname(__file__)
 project_root = os.path.abspath(os.path.join(script_dir, '..'))
 frontend_path = os.path.join(project_root, 'frontend')
 
-print("FRONTEND_PATH =", frontend_path)
-try:
-    print("Files in frontend:", os.listdir(frontend_path))
-except Exception as ex:
-    print("No se encontró frontend folder:", ex)
-
 # Mount frontend static files if directory exists
 if os.path.isdir(frontend_path):
     app.mount("/static", StaticFiles(directory=frontend_path), name="static")
@@ -1592,6 +1688,20 @@ async def favicon():
     # Fallback to index.html if favicon not found
     return FileResponse(os.path.join(frontend_path, 'index.html'))
 
+# Jobs endpoint - scheduled jobs, their next run and lease owner
+@app.get("/jobs")
+async def get_jobs():
+    """Periodic jobs with their schedule, last run and lease owner (runtimes are in /metrics as jobs.<name>)"""
+    return {"jobs": await scheduler.status()}
+
+# Metrics endpoint - in-process counters, timings and cache effectiveness
+@app.get("/metrics")
+async def get_metrics():
+    """Returns in-process metrics, including the repeated-question cache hit rate"""
+    snapshot = metrics.snapshot()
+    snapshot["response_cache"] = response_cache.stats()
+    return snapshot
+
 # Health check endpoint - verify server status
 @app.get("/health")
 async def health_check():
@@ -1604,6 +1714,13 @@ async def health_check():
         "telegram_configured": telegram_bot is not None
     }
 
+# Readiness probe - 503 until the database and the heavy clients are warm
+@app.get("/ready")
+async def readiness_check():
+    """Returns 200 once the warm-up task has loaded every configured integration"""
+    body = {"ready": is_ready(), "components": READINESS}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
 
 
 
@@ -1620,6 +1737,7 @@ class SessionValidateRequest(BaseModel):
 @app.post("/auth/send-code")
 async def send_verification_code(request: PhoneRequest):
     """Envía código de verificación al número de teléfono"""
+    sms_service = get_sms_service()
     if not sms_service:
         raise HTTPException(status_code=503, detail="Servicio SMS no configurado")
     
@@ -1636,6 +1754,7 @@ async def send_verification_code(request: PhoneRequest):
 @app.post("/auth/verify-code")
 async def verify_code(request: VerifyRequest):
     """Verifica el código SMS y crea sesión"""
+    sms_service = get_sms_service()
     if not sms_service:
         raise HTTPException(status_code=503, detail="Servicio SMS no configurado")
     
@@ -1668,7 +1787,7 @@ async def logout(request: SessionValidateRequest):
     try:
         async with async_session() as session:
             stmt = select(UserSession).where(
-                UserSession.session_token == request.session_token
+                UserSession.token_hash == hash_token(request.session_token)
             )
             result = await session.execute(stmt)
             user_session = result.scalar_one_or_none()
@@ -1685,20 +1804,95 @@ async def logout(request: SessionValidateRequest):
 # LIFECYCLE EVENTS - Startup and Shutdown hooks
 # ============================================
 
-# Initialize Telegram bot on server startup
-@app.on_event("startup")
+async def warm_up_integrations():
+    """
+    Loads the heavy clients in the background after startup, so the server
+    accepts connections right away. Imports run in a thread to keep the event
+    loop free. Each step flips its READINESS flag.
+    """
+    global telegram_bot
+    started = time.perf_counter()
+
+    try:
+        if GEMINI_TOKEN:
+            await asyncio.to_thread(get_gemini_client)
+            READINESS["gemini"] = True
+            # Batched LLM extraction for the memory enrichment queue
+            memory_enrichment.set_extractor(GeminiExtractor(generate_enrichment))
+        else:
+            READINESS["gemini"] = "disabled"
+            # Without Gemini the rules are final: the backfill can start
+            memory_enrichment.set_extractor(RuleExtractor())
+    except Exception as e:
+        print(f"❌ Error cargando el cliente de Gemini: {e}")
+        READINESS["gemini"] = "failed"
+
+    try:
+        sms_configured = all(os.getenv(k) for k in ("TWILIO_ACCOUNT_SID", "TWILIO_AUTH_TOKEN", "TWILIO_VERIFY_SERVICE_SID"))
+        if sms_configured:
+            await asyncio.to_thread(get_sms_service)
+            READINESS["sms"] = True
+        else:
+            READINESS["sms"] = "disabled"
+    except Exception as e:
+        print(f"❌ Error cargando el servicio SMS: {e}")
+        READINESS["sms"] = "failed"
+
+    try:
+        if telegram_bot is None and TELEGRAM_TOKEN:
+            telegram_bot = await asyncio.to_thread(create_telegram_bot)
+        if telegram_bot and TELEGRAM_BOT_MODE == "worker":
+            print("🤖 Bot de Telegram en proceso aparte (backend.bot_worker)")
+            READINESS["telegram"] = True
+        elif telegram_bot:
+            print("🤖 Bot de Telegram iniciándose...")
+            # start_bot returns False on failure: /ready reports it and we retry
+            while not await telegram_bot.start_bot():
+                READINESS["telegram"] = "failed"
+                metrics.inc("startup.telegram_failures")
+                await telegram_bot.stop_bot()
+                print(f"🔁 Reintentando el bot de Telegram en {TELEGRAM_START_RETRY_SECONDS:.0f}s")
+                await asyncio.sleep(TELEGRAM_START_RETRY_SECONDS)
+            READINESS["telegram"] = True
+        else:
+            READINESS["telegram"] = "disabled"
+    except Exception as e:
+        print(f"❌ Error iniciando el bot de Telegram: {e}")
+        READINESS["telegram"] = "failed"
+
+    metrics.observe("startup.warm_up", time.perf_counter() - started)
+    print(f"✅ Integraciones cargadas en {time.perf_counter() - started:.2f}s (ready={is_ready()})")
+
+
+# Startup: database first, then the heavy clients in a background task
 async def startup_event():
-    """Starts the Telegram bot when the app starts up and loads the database"""
-    await init_db() 
-    
-    if telegram_bot:
-        asyncio.create_task(telegram_bot.start_bot())
-        print("🤖 Bot de Telegram iniciándose...")
+    """Checks the schema version and starts warming up Gemini, Twilio and Telegram"""
+    # Solo comprueba la versión; las migraciones se aplican con `python -m backend.migrations upgrade`
+    await verify_schema()
+    READINESS["database"] = True
+    app.state.warm_up_task = asyncio.create_task(warm_up_integrations())
+    # Frames queued by the Telegram bot for the devices connected here
+    app.state.outbox_task = asyncio.create_task(run_dispatcher(deliver_to_devices, ACTIVE_WEBSOCKETS))
+    # Periodic jobs: expired tokens/sessions cleanup, usage counter flushes... (see scheduler.py)
+    app.state.scheduler_task = asyncio.create_task(scheduler.run())
+    # People, places and era of the new memories, off the /ws turn
+    app.state.memory_enrichment_task = asyncio.create_task(memory_enrichment.run())
 
 # Cleanup Telegram bot on server shutdown
-@app.on_event("shutdown")
 async def shutdown_event():
     """Detiene el bot al cerrar la app"""
+    for name in ("warm_up_task", "scheduler_task", "outbox_task", "memory_enrichment_task"):
+        task = getattr(app.state, name, None)
+        if task and not task.done():
+            task.cancel()
+    await scheduler.stop()
+    # Last flush of the usage counters still in memory
+    try:
+        await usage_rollups.flush()
+    except Exception as e:
+        print(f"❌ Error guardando los contadores de uso: {e}")
+    # Semantic index snapshots not written yet
+    await memory_index.flush_snapshots()
     if telegram_bot:
         # Gracefully stop Telegram bot
         await telegram_bot.stop_bot()
@@ -1708,6 +1902,11 @@ async def shutdown_event():
 # SERVER EXECUTION - Main entry point
 # ============================================
 
-# if __name__ == "__main__":
-#     port = int(os.environ.get("PORT", 8080))
-#     uvicorn.run("backend.main:app", host="0.0.0.0", port=port, log_level="info")
\ No newline at end of file
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 8080))
+    # The "websockets" implementation negotiates permessage-deflate with the browser;
+    # with the uvicorn CLI use: --ws websockets --ws-per-message-deflate true
+    uvicorn.run(
+        "backend.main:app", host="0.0.0.0", port=port, log_level="info",
+        ws="websockets", ws_per_message_deflate=True
+    )
\ No newline at end of file
@@ -0,0 +1,182 @@
+"""
+Almacén local de las notas de voz y fotos de los mensajes familiares.
+
+Direccionado por contenido: cada fichero se guarda como MEDIA_DIR/<ab>/<sha256>
+y FamilyMessages solo guarda el resumen (media_hash). La misma foto enviada a
+varios dispositivos, o reenviada, se guarda una vez.
+
+- save_stream escribe los trozos de la descarga en un fichero temporal
+  mientras calcula el SHA-256 y luego lo mueve a su sitio (o lo descarta si ya
+  existía): el fichero nunca está entero en memoria.
+- media_response sirve GET /family/media/<sha256>.<ext> por trozos con
+  soporte de Range (206), ETag y Cache-Control immutable: el contenido de una
+  URL no cambia nunca, así que el navegador puede guardarlo en caché.
+
+El bot (que descarga) y el servidor web (que sirve) deben ver el mismo
+MEDIA_DIR: mismo equipo o volumen compartido si corren por separado.
+"""
+import os
+import re
+import uuid
+import hashlib
+
+import aiofiles
+from starlette.responses import Response, StreamingResponse
+
+from .metrics import metrics
+
+
+# Directorio del almacén
+script_dir = os.path.dirname(__file__)
+project_root = os.path.abspath(os.path.join(script_dir, '..'))
+MEDIA_DIR = os.getenv("MEDIA_DIR", os.path.join(project_root, "data", "media"))
+
+# Tamaño de los trozos al descargar y al servir
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(64 * 1024)))
+
+# Límite por fichero (la Bot API no deja descargar más de 20 MB)
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(20 * 1024 * 1024)))
+
+# Extensión de la URL de cada tipo y su Content-Type
+MEDIA_EXTENSIONS = {"voice": ".ogg", "photo": ".jpg"}
+MEDIA_CONTENT_TYPES = {".ogg": "audio/ogg", ".jpg": "image/jpeg"}
+
+MEDIA_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+_DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class MediaStore:
+    def __init__(self, directory=MEDIA_DIR):
+        self.directory = directory
+
+    def path_for(self, digest):
+        if not _DIGEST_RE.match(digest or ""):
+            raise ValueError(f"Resumen no válido: {digest!r}")
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def size(self, digest):
+        """Tamaño del fichero o None si no existe"""
+        try:
+            return os.path.getsize(self.path_for(digest))
+        except (ValueError, OSError):
+            return None
+
+    async def save_stream(self, chunks):
+        """Guarda un iterador async de bytes; devuelve (sha256, tamaño)"""
+        tmp_dir = os.path.join(self.directory, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > MEDIA_MAX_BYTES:
+                        raise MediaTooLarge(f"El fichero supera {MEDIA_MAX_BYTES} bytes")
+                    digest.update(chunk)
+                    await f.write(chunk)
+            final_path = self.path_for(digest.hexdigest())
+            if os.path.exists(final_path):
+                os.remove(tmp_path)
+                metrics.inc("media.deduplicated")
+            else:
+                os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                os.replace(tmp_path, final_path)
+                metrics.inc("media.stored_bytes", size)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest.hexdigest(), size
+
+    async def iter_range(self, digest, start, end, chunk_size=None):
+        """Bytes start..end (incluidos) del fichero, por trozos"""
+        chunk_size = chunk_size or MEDIA_CHUNK_SIZE
+        remaining = end - start + 1
+        async with aiofiles.open(self.path_for(digest), "rb") as f:
+            await f.seek(start)
+            while remaining > 0:
+                chunk = await f.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+
+media_store = MediaStore()
+
+
+def media_info(msg):
+    """Datos del adjunto de un FamilyMessages para la app (None si es solo texto)"""
+    if not msg.media_hash:
+        return None
+    return {
+        "type": msg.media_type,
+        "url": f"/family/media/{msg.media_hash}{MEDIA_EXTENSIONS.get(msg.media_type, '')}",
+        "size": msg.media_size,
+    }
+
+
+def parse_range(header, size):
+    """
+    Cabecera Range de un solo tramo -> (inicio, fin) incluidos, o None si no hay
+    (o pide varios tramos: se sirve entero). ValueError si no se puede servir.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # bytes=-N: los últimos N bytes
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        raise ValueError("Rango fuera del fichero")
+    return start, min(end, size - 1)
+
+
+def media_response(filename, request_headers, store=None):
+    """Respuesta de GET /family/media/<sha256>.<ext> con Range, ETag y caché"""
+    store = store or media_store
+    digest, extension = os.path.splitext(filename)
+    size = store.size(digest)
+    if size is None:
+        return Response(status_code=404)
+
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if request_headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        byte_range = parse_range(request_headers.get("range"), size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    start, end = byte_range or (0, size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    status_code = 200
+    if byte_range:
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    metrics.inc("media.served_bytes", end - start + 1)
+    return StreamingResponse(
+        store.iter_range(digest, start, end),
+        status_code=status_code,
+        media_type=MEDIA_CONTENT_TYPES.get(extension, "application/octet-stream"),
+        headers=headers,
+    )
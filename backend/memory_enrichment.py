@@ -0,0 +1,403 @@
+"""
+Enriquecimiento de los recuerdos fuera del turno de /ws.
+
+Al guardar un recuerdo el turno solo inserta el texto con categoría
+"personal" y llama a memory_enrichment.submit(), que no hace I/O. Una tarea de
+fondo agrupa los recuerdos pendientes por dispositivo (espera
+MEMORY_ENRICHMENT_DELAY segundos para juntar los de varios turnos seguidos) y
+extrae de cada lote, con una sola llamada:
+- personas (familiares y nombres propios), lugares, época y categoría,
+- con Gemini si está configurado (GeminiExtractor, una petición por lote de
+  hasta MEMORY_ENRICHMENT_BATCH_SIZE recuerdos de un dispositivo) o con las
+  reglas locales de RuleExtractor, que también cubren los fallos del LLM.
+
+El resultado se guarda en las columnas de Memory (enriched_at marca los ya
+procesados), se añade a user_memory (family_members y places) y se vuelve a
+codificar en el índice semántico con index_text(), así "Sevilla" o "los años
+60" encuentran recuerdos que no contenían esas palabras tal cual.
+
+Los recuerdos que quedaron sin enriquecer (reinicio, recuerdos anteriores a la
+migración 11) se recuperan con backfill(), una tarea compartida del
+planificador (una réplica a la vez, al crear su fila y cada
+MEMORY_ENRICHMENT_BACKFILL_SECONDS). Espera a que el arranque elija el
+extractor (set_extractor): si no, los recuerdos antiguos quedarían marcados
+con las reglas locales mientras Gemini aún se carga.
+"""
+import os
+import re
+import json
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select, update
+
+from .database import async_session, Memory, DeviceData
+from .memory_index import memory_index, tokenize
+from .unit_of_work import default_user_memory
+from .metrics import metrics
+from .scheduler import scheduler
+
+
+# Segundos que se esperan para juntar en un lote los recuerdos de varios turnos
+MEMORY_ENRICHMENT_DELAY = float(os.getenv("MEMORY_ENRICHMENT_DELAY", "5"))
+
+# Recuerdos por llamada al extractor (y por página del backfill)
+MEMORY_ENRICHMENT_BATCH_SIZE = int(os.getenv("MEMORY_ENRICHMENT_BATCH_SIZE", "20"))
+
+# Segundos entre pasadas del backfill
+MEMORY_ENRICHMENT_BACKFILL_SECONDS = float(os.getenv("MEMORY_ENRICHMENT_BACKFILL_SECONDS", "3600"))
+
+# Segundos que el backfill espera al extractor antes de dejar la pasada para la siguiente
+MEMORY_ENRICHMENT_READY_TIMEOUT = float(os.getenv("MEMORY_ENRICHMENT_READY_TIMEOUT", "120"))
+
+# Categorías que puede asignar el enriquecimiento
+MEMORY_CATEGORIES = ("familia", "lugares", "trabajo", "aficiones", "salud", "personal")
+
+# Categoría con la que se guardan los recuerdos antes de enriquecerlos
+DEFAULT_CATEGORY = "personal"
+
+# Elementos como máximo por lista (personas, lugares) y longitud de cada uno
+MAX_ITEMS = 10
+MAX_ITEM_LENGTH = 100
+
+
+# ============================================
+# REGLAS LOCALES
+# ============================================
+
+# Parentescos (ya normalizados por tokenize, que aplica los sinónimos)
+KINSHIP_WORDS = {
+    "madre", "padre", "esposo", "esposa", "abuela", "abuelo", "nieto", "nieta", "hijo", "hija",
+    "hermano", "hermana", "tio", "tia", "primo", "prima", "sobrino", "sobrina",
+    "suegro", "suegra", "cunado", "cunada", "amigo", "amiga", "vecino", "vecina",
+}
+
+CATEGORY_WORDS = {
+    "salud": {"medico", "medica", "hospital", "pastilla", "pastillas", "medicina", "enfermera", "operacion", "dolor"},
+    "trabajo": {"trabajo", "jefe", "empresa", "fabrica", "oficina", "jubilacion", "jubile", "taller", "tienda"},
+    "aficiones": {"musica", "futbol", "cocinar", "leer", "libro", "jardin", "huerto", "pintar", "pescar", "cine", "viaje", "viajes"},
+}
+
+# Etapas de la vida que sirven como época cuando no hay un año
+LIFE_STAGES = {
+    "ninez": "infancia", "niño": "infancia", "niña": "infancia", "colegio": "infancia", "escuela": "infancia",
+    "juventud": "juventud", "novio": "juventud", "novia": "juventud", "mili": "juventud",
+    "boda": "boda", "jubilacion": "jubilación",
+}
+
+# Palabras con mayúscula que no son nombres de personas ni de lugares
+CAPITALIZED_STOPWORDS = {
+    "Dios", "Navidad", "Nochebuena", "Semana", "Santa", "Reyes", "Pascua",
+    "Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo",
+    "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto",
+    "Septiembre", "Octubre", "Noviembre", "Diciembre",
+}
+
+_WORD_RE = re.compile(r"[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]+")
+_YEAR_RE = re.compile(r"\b(19[0-9]{2}|20[0-9]{2})\b")
+_DECADE_RE = re.compile(r"\baños\s+(?:19)?([2-9]0)\b", re.IGNORECASE)
+_SENTENCE_END = (".", "!", "?", "¡", "¿", ":", ";")
+_PLACE_PREPOSITIONS = {"en", "a", "desde", "hacia", "hasta"}
+_PLACE_NOUNS = {
+    "pueblo", "ciudad", "barrio", "provincia", "calle", "plaza", "playa", "isla", "puerto",
+    "fabrica", "colegio", "escuela", "iglesia", "mercado", "parque", "estacion",
+}
+
+
+def _proper_names(text):
+    """(personas, lugares) a partir de las palabras con mayúscula que no empiezan frase"""
+    people, places = [], []
+    previous, previous_end = None, 0
+    for match in _WORD_RE.finditer(text):
+        word = match.group()
+        gap = text[previous_end:match.start()]
+        starts_sentence = previous is None or any(mark in gap for mark in _SENTENCE_END)
+        if word[0].isupper() and not starts_sentence and word not in CAPITALIZED_STOPWORDS:
+            before = (previous or "").lower()
+            if before in _PLACE_PREPOSITIONS or (before == "de" and _after_place_noun(text, match.start())):
+                places.append(word)
+            else:
+                people.append(word)
+        previous, previous_end = word, match.end()
+    return people, places
+
+
+def _after_place_noun(text, position):
+    """True si el "de" anterior sigue a un sustantivo de lugar ("el pueblo de Teba")"""
+    words = tokenize(text[:position])
+    return len(words) >= 2 and words[-1] == "de" and words[-2] in _PLACE_NOUNS
+
+
+def _era(text, tokens):
+    year = _YEAR_RE.search(text)
+    if year:
+        value = int(year.group())
+        return f"años {value % 100 // 10 * 10:02d}" if value < 2000 else f"años {value // 10 * 10}"
+    decade = _DECADE_RE.search(text)
+    if decade:
+        return f"años {decade.group(1)}"
+    for token in tokens:
+        if token in LIFE_STAGES:
+            return LIFE_STAGES[token]
+    return None
+
+
+def _unique(items):
+    seen, result = set(), []
+    for item in items:
+        item = str(item).strip()[:MAX_ITEM_LENGTH]
+        if item and item.lower() not in seen:
+            seen.add(item.lower())
+            result.append(item)
+    return result[:MAX_ITEMS]
+
+
+def extract_with_rules(text):
+    """Personas, lugares, época y categoría de un recuerdo con reglas locales"""
+    tokens = tokenize(text)
+    token_set = set(tokens)
+    names, places = _proper_names(text)
+    people = _unique([tok for tok in tokens if tok in KINSHIP_WORDS] + names)
+    places = _unique(places)
+
+    category = DEFAULT_CATEGORY
+    for name in ("salud", "trabajo", "aficiones"):
+        if token_set & CATEGORY_WORDS[name]:
+            category = name
+            break
+    else:
+        if people:
+            category = "familia"
+        elif places:
+            category = "lugares"
+    return {"people": people, "places": places, "era": _era(text, tokens), "category": category}
+
+
+class RuleExtractor:
+    """Extractor sin red: reglas sobre el texto en español"""
+    name = "rules"
+
+    async def extract(self, memories):
+        """memories: [(id, texto)] -> {id: {people, places, era, category}}"""
+        return {memory_id: extract_with_rules(text) for memory_id, text in memories}
+
+
+# ============================================
+# LLM
+# ============================================
+
+ENRICHMENT_PROMPT = """
+Eres un asistente que organiza los recuerdos de una persona mayor con Alzheimer.
+Para cada recuerdo de la lista extrae:
+- "people": personas que aparecen (nombres propios o parentescos como "hija", "esposo"),
+- "places": lugares (ciudades, pueblos, países, sitios concretos),
+- "era": época o etapa de la vida ("años 60", "infancia", "juventud"...) o null,
+- "category": una de {categories}.
+
+Responde SOLO con un array JSON con un objeto por recuerdo:
+[{{"id": <id>, "people": [...], "places": [...], "era": ..., "category": ...}}]
+
+Recuerdos:
+{memories}
+"""
+
+
+def _clean(result, fallback):
+    """Valida la respuesta del LLM para un recuerdo; lo que falte sale de las reglas"""
+    era = result.get("era")
+    category = result.get("category")
+    return {
+        "people": _unique(result.get("people") or []) if isinstance(result.get("people"), list) else fallback["people"],
+        "places": _unique(result.get("places") or []) if isinstance(result.get("places"), list) else fallback["places"],
+        "era": str(era)[:50] if era else fallback["era"],
+        "category": category if category in MEMORY_CATEGORIES else fallback["category"],
+    }
+
+
+class GeminiExtractor:
+    """
+    Una petición al LLM por lote. generate es una corrutina prompt -> texto
+    (en main.py usa el cliente de Gemini compartido con JSON como respuesta).
+    """
+    name = "gemini"
+
+    def __init__(self, generate):
+        self.generate = generate
+
+    async def extract(self, memories):
+        rules = {memory_id: extract_with_rules(text) for memory_id, text in memories}
+        prompt = ENRICHMENT_PROMPT.format(
+            categories=", ".join(f'"{c}"' for c in MEMORY_CATEGORIES),
+            memories=json.dumps([{"id": memory_id, "text": text} for memory_id, text in memories], ensure_ascii=False),
+        )
+        metrics.inc("memory_enrichment.llm_calls")
+        try:
+            with metrics.timer("memory_enrichment.llm"):
+                raw = await self.generate(prompt)
+            parsed = json.loads(raw)
+            results = {int(item["id"]): item for item in parsed if isinstance(item, dict) and "id" in item}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"⚠️ Enriquecimiento con LLM fallido, se usan las reglas: {e}")
+            metrics.inc("memory_enrichment.llm_errors")
+            return rules
+        return {
+            memory_id: _clean(results[memory_id], rules[memory_id]) if memory_id in results else rules[memory_id]
+            for memory_id in rules
+        }
+
+
+# ============================================
+# COLA
+# ============================================
+
+def index_text(content, people=None, places=None, era=None):
+    """Texto que se codifica en el índice semántico: el recuerdo y lo extraído de él"""
+    extra = [*(people or []), *(places or []), era or ""]
+    return " ".join([content, *[item for item in extra if item]])
+
+
+class MemoryEnrichment:
+    def __init__(self, extractor=None):
+        self.extractor = extractor or RuleExtractor()
+        self._pending = defaultdict(set)
+        self._wake = asyncio.Event()
+        # Se activa cuando el arranque decide el extractor (Gemini o reglas)
+        self._extractor_ready = asyncio.Event()
+
+    def set_extractor(self, extractor):
+        self.extractor = extractor
+        self._extractor_ready.set()
+
+    def submit(self, device_id, memory_id):
+        """Encola un recuerdo recién guardado (sin I/O: se puede llamar desde el turno)"""
+        self._pending[device_id].add(memory_id)
+        self._wake.set()
+
+    async def enrich(self, device_id, memory_ids):
+        """Enriquece los recuerdos pendientes de un dispositivo; devuelve cuántos"""
+        async with async_session() as session:
+            stmt = (
+                select(Memory)
+                .where(Memory.device_id == device_id, Memory.id.in_(memory_ids), Memory.enriched_at.is_(None))
+                .order_by(Memory.id)
+            )
+            memories = (await session.execute(stmt)).scalars().all()
+        if not memories:
+            return 0
+
+        extracted = {}
+        for start in range(0, len(memories), MEMORY_ENRICHMENT_BATCH_SIZE):
+            batch = memories[start:start + MEMORY_ENRICHMENT_BATCH_SIZE]
+            extracted.update(await self.extractor.extract([(m.id, m.content) for m in batch]))
+
+        now = datetime.utcnow()
+        rows = []
+        for memory in memories:
+            fields = extracted.get(memory.id) or extract_with_rules(memory.content)
+            rows.append({
+                "id": memory.id,
+                "people": fields["people"],
+                "places": fields["places"],
+                "era": fields["era"],
+                # Una categoría elegida a mano (POST /memory/cofre) se respeta
+                "category": fields["category"] if memory.category in (None, DEFAULT_CATEGORY) else memory.category,
+                "enriched_at": now,
+            })
+
+        async with async_session() as session:
+            await session.execute(update(Memory), rows)
+            await self._merge_user_memory(session, device_id, rows)
+            await session.commit()
+
+        try:
+            memory_index.replace_memories(device_id, [
+                (row["id"], index_text(memory.content, row["people"], row["places"], row["era"]))
+                for row, memory in zip(rows, memories)
+            ])
+        except Exception as e:
+            print(f"⚠️ No se pudo reindexar los recuerdos enriquecidos de {device_id}: {e}")
+
+        metrics.inc("memory_enrichment.enriched", len(rows))
+        print(f"🧩 {len(rows)} recuerdo(s) enriquecidos para {device_id} ({self.extractor.name})")
+        return len(rows)
+
+    @staticmethod
+    async def _merge_user_memory(session, device_id, rows):
+        """Añade las personas y los lugares nuevos a user_memory"""
+        device_data = await session.get(DeviceData, device_id, with_for_update=True)
+        if device_data is None:
+            return
+        # Diccionario nuevo: la columna JSON solo detecta cambios por asignación
+        user_memory = dict(device_data.user_memory or default_user_memory())
+        for key, field in (("family_members", "people"), ("places", "places")):
+            current = list(user_memory.get(key) or [])
+            seen = {str(item).lower() for item in current}
+            for item in (item for row in rows for item in row[field]):
+                if item.lower() not in seen:
+                    seen.add(item.lower())
+                    current.append(item)
+            user_memory[key] = current
+        device_data.user_memory = user_memory
+
+    async def backfill(self):
+        """Enriquece por páginas los recuerdos que siguen pendientes en la DB"""
+        try:
+            await asyncio.wait_for(self._extractor_ready.wait(), MEMORY_ENRICHMENT_READY_TIMEOUT)
+        except asyncio.TimeoutError:
+            # Gemini no cargó: enriched_at no se marca con las reglas, se reintenta después
+            print("⏳ Backfill de recuerdos aplazado: el extractor no está listo")
+            metrics.inc("memory_enrichment.backfill_deferred")
+            return 0
+        total = 0
+        after_id = 0
+        while True:
+            async with async_session() as session:
+                stmt = (
+                    select(Memory.id, Memory.device_id)
+                    .where(Memory.enriched_at.is_(None), Memory.id > after_id)
+                    .order_by(Memory.id)
+                    .limit(MEMORY_ENRICHMENT_BATCH_SIZE * 10)
+                )
+                page = (await session.execute(stmt)).all()
+            if not page:
+                break
+            by_device = defaultdict(list)
+            for memory_id, device_id in page:
+                by_device[device_id].append(memory_id)
+            for device_id, memory_ids in by_device.items():
+                total += await self.enrich(device_id, memory_ids)
+            after_id = page[-1][0]
+        if total:
+            print(f"🧩 Backfill: {total} recuerdo(s) pendientes enriquecidos")
+        return total
+
+    async def drain(self):
+        """Procesa lo encolado hasta ahora, un lote por dispositivo"""
+        pending, self._pending = self._pending, defaultdict(set)
+        for device_id, memory_ids in pending.items():
+            try:
+                with metrics.timer("memory_enrichment.batch"):
+                    await self.enrich(device_id, list(memory_ids))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Error enriqueciendo recuerdos de {device_id}: {e}")
+                metrics.inc("memory_enrichment.errors")
+
+    async def run(self, delay=None):
+        """Bucle de fondo para el lifespan de la app (se cancela al cerrar)"""
+        delay = MEMORY_ENRICHMENT_DELAY if delay is None else delay
+        while True:
+            await self._wake.wait()
+            # Da tiempo a que lleguen más recuerdos del mismo dispositivo
+            await asyncio.sleep(delay)
+            self._wake.clear()
+            await self.drain()
+
+
+memory_enrichment = MemoryEnrichment()
+
+scheduler.add_job("memory_enrichment_backfill", memory_enrichment.backfill, every=MEMORY_ENRICHMENT_BACKFILL_SECONDS, run_at_start=True)
@@ -0,0 +1,357 @@
+"""
+Índice vectorial local para la recuperación semántica de recuerdos.
+
+Cada dispositivo tiene una matriz float32 (un vector normalizado por recuerdo)
+que se busca con similitud coseno vectorizada en NumPy. Los embeddings salen de
+un codificador intercambiable; por defecto es un vectorizador de hashing que
+funciona sin red. El índice se guarda en disco y se carga con memory-map; las
+instantáneas modificadas se escriben en un hilo cada
+MEMORY_INDEX_SNAPSHOT_SECONDS (tarea local del planificador), no en cada
+recuerdo nuevo.
+"""
+import os
+import re
+import time
+import asyncio
+import hashlib
+import unicodedata
+
+import numpy as np
+
+from .scheduler import scheduler
+
+
+# Directorio donde se guardan las instantáneas del índice
+script_dir = os.path.dirname(__file__)
+project_root = os.path.abspath(os.path.join(script_dir, '..'))
+MEMORY_INDEX_DIR = os.getenv("MEMORY_INDEX_DIR", os.path.join(project_root, "data", "memory_index"))
+
+# Dimensión por defecto de los vectores del codificador de hashing
+MEMORY_INDEX_DIM = int(os.getenv("MEMORY_INDEX_DIM", "512"))
+
+# Segundos tras los que un índice sincronizado se vuelve a comparar con la DB
+# (recoge los recuerdos que guardan otras réplicas)
+MEMORY_INDEX_RESYNC_SECONDS = float(os.getenv("MEMORY_INDEX_RESYNC_SECONDS", "60"))
+
+# Segundos entre escrituras de las instantáneas modificadas
+MEMORY_INDEX_SNAPSHOT_SECONDS = float(os.getenv("MEMORY_INDEX_SNAPSHOT_SECONDS", "5"))
+
+# Similitud mínima para considerar un recuerdo como candidato semántico
+MIN_SEMANTIC_SCORE = float(os.getenv("MEMORY_INDEX_MIN_SCORE", "0.12"))
+
+# Formas equivalentes que la búsqueda por palabras clave no relaciona
+# (ej. "mi madre" vs "mamá"). Se reducen todas a la misma forma canónica.
+SPANISH_SYNONYMS = {
+    "mama": "madre", "mami": "madre", "mamita": "madre", "madre": "madre",
+    "papa": "padre", "papi": "padre", "papito": "padre", "padre": "padre",
+    "marido": "esposo", "esposo": "esposo",
+    "mujer": "esposa", "esposa": "esposa",
+    "abuelita": "abuela", "yaya": "abuela", "abuela": "abuela",
+    "abuelito": "abuelo", "yayo": "abuelo", "abuelo": "abuelo",
+    "nieto": "nieto", "nietos": "nieto", "nieta": "nieta", "nietas": "nieta",
+    "hijo": "hijo", "hijos": "hijo", "hija": "hija", "hijas": "hija",
+    "crio": "ninez", "crios": "ninez", "nino": "ninez", "nina": "ninez", "infancia": "ninez", "ninez": "ninez",
+    "chaval": "juventud", "joven": "juventud", "juventud": "juventud",
+    "casamiento": "boda", "casarse": "boda", "case": "boda", "boda": "boda",
+    "faena": "trabajo", "oficio": "trabajo", "trabajaba": "trabajo", "trabajo": "trabajo",
+    "pueblo": "pueblo", "aldea": "pueblo",
+    "cancion": "musica", "canciones": "musica", "bailar": "musica", "baile": "musica", "musica": "musica",
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9ñ]+")
+
+
+def normalize_text(text):
+    """Minúsculas y sin tildes (conserva la ñ)"""
+    text = text.lower().replace("ñ", "\x00")
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return text.replace("\x00", "ñ")
+
+
+def tokenize(text):
+    """Divide el texto en palabras normalizadas y aplica los sinónimos"""
+    return [SPANISH_SYNONYMS.get(tok, tok) for tok in _TOKEN_RE.findall(normalize_text(text))]
+
+
+class HashingEncoder:
+    """
+    Codificador por defecto: hashing de palabras y trigramas de caracteres.
+    No necesita entrenamiento ni red y siempre produce la misma dimensión,
+    así que los recuerdos se pueden añadir de uno en uno.
+    """
+    name = "hashing"
+
+    def __init__(self, dim=MEMORY_INDEX_DIM):
+        self.dim = dim
+
+    def _bucket(self, feature):
+        digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        # El bit más alto decide el signo para reducir colisiones
+        return value % self.dim, (1.0 if value >> 63 else -1.0)
+
+    def _features(self, text):
+        for tok in tokenize(text):
+            if len(tok) < 3:
+                continue
+            yield "w:" + tok, 1.0
+            padded = f"<{tok}>"
+            for i in range(len(padded) - 2):
+                yield "c:" + padded[i:i + 3], 0.35
+
+    def encode(self, texts):
+        """Devuelve una matriz float32 (len(texts), dim) con filas normalizadas"""
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                col, sign = self._bucket(feature)
+                matrix[row, col] += sign * weight
+        # TF sublineal y normalización L2 para que el producto escalar sea el coseno
+        np.copysign(np.log1p(np.abs(matrix)), matrix, out=matrix)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        matrix /= norms
+        return matrix
+
+
+class DeviceMemoryIndex:
+    """Matriz de embeddings de los recuerdos de un dispositivo"""
+
+    def __init__(self, dim, ids=None, vectors=None):
+        self.dim = dim
+        self._size = 0
+        self._ids = np.empty(0, dtype=np.int64)
+        self._vectors = np.empty((0, dim), dtype=np.float32)
+        if ids is not None and vectors is not None:
+            # Puede ser un memmap de solo lectura; se copia al primer append
+            self._ids = ids
+            self._vectors = vectors
+            self._size = len(ids)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def ids(self):
+        return self._ids[:self._size]
+
+    @property
+    def vectors(self):
+        return self._vectors[:self._size]
+
+    @property
+    def max_id(self):
+        return int(self.ids.max()) if self._size else 0
+
+    def _reserve(self, extra):
+        needed = self._size + extra
+        capacity = self._vectors.shape[0]
+        if needed <= capacity and isinstance(self._vectors, np.ndarray) and not isinstance(self._vectors, np.memmap):
+            return
+        new_capacity = max(needed, capacity * 2, 16)
+        vectors = np.empty((new_capacity, self.dim), dtype=np.float32)
+        ids = np.empty(new_capacity, dtype=np.int64)
+        vectors[:self._size] = self._vectors[:self._size]
+        ids[:self._size] = self._ids[:self._size]
+        self._vectors, self._ids = vectors, ids
+
+    def add(self, memory_ids, vectors):
+        """Añade recuerdos al final de la matriz (crecimiento amortizado)"""
+        if len(memory_ids) == 0:
+            return
+        self._reserve(len(memory_ids))
+        end = self._size + len(memory_ids)
+        self._vectors[self._size:end] = vectors
+        self._ids[self._size:end] = memory_ids
+        self._size = end
+
+    def remove(self, memory_ids):
+        """Elimina recuerdos del índice"""
+        keep = ~np.isin(self.ids, np.asarray(memory_ids, dtype=np.int64))
+        ids = np.ascontiguousarray(self.ids[keep])
+        vectors = np.ascontiguousarray(self.vectors[keep])
+        self._ids, self._vectors, self._size = ids, vectors, len(ids)
+
+    def search(self, query_vector, k=3, min_score=MIN_SEMANTIC_SCORE):
+        """Top-k por similitud coseno; devuelve [(memory_id, score)]"""
+        if self._size == 0:
+            return []
+        scores = self.vectors @ query_vector
+        k = min(k, self._size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (int(self.ids[i]), float(scores[i]))
+            for i in top
+            if scores[i] >= min_score
+        ]
+
+
+class MemoryIndexStore:
+    """
+    Registro de índices por dispositivo, con instantáneas en disco.
+    Las instantáneas se escriben de forma atómica y se leen con mmap_mode="r".
+
+    Un índice solo recibe appends incrementales mientras está sincronizado con
+    la DB en este proceso (ver sync). Si no, la instantánea del disco puede
+    estar desfasada (recuerdos de otra réplica o de antes de un reinicio) y se
+    deja que la próxima búsqueda lo ponga al día por los ids que le faltan.
+    """
+
+    def __init__(self, directory=MEMORY_INDEX_DIR, encoder=None):
+        self.directory = directory
+        self.encoder = encoder or HashingEncoder()
+        self._indexes = {}
+        self._synced = {}  # device_id -> instante (monotonic) de la última sincronización
+        self._dirty = set()
+
+    def set_encoder(self, encoder):
+        """Cambia el codificador (los índices se reconstruyen al volver a usarse)"""
+        self.encoder = encoder
+        self._indexes.clear()
+        self._synced.clear()
+        self._dirty.clear()
+
+    def is_synced(self, device_id):
+        """True si el índice se ha comparado con la DB hace menos de MEMORY_INDEX_RESYNC_SECONDS"""
+        synced_at = self._synced.get(device_id)
+        return synced_at is not None and time.monotonic() - synced_at < MEMORY_INDEX_RESYNC_SECONDS
+
+    def _paths(self, device_id):
+        # sha256 del id: nombre único por dispositivo y sin separadores de ruta
+        safe_id = hashlib.sha256(device_id.encode("utf-8")).hexdigest()
+        base = os.path.join(self.directory, f"{safe_id}.{self.encoder.name}{self.encoder.dim}")
+        return base + ".ids.npy", base + ".vec.npy"
+
+    def get(self, device_id):
+        """Índice cargado en memoria o None si hay que construirlo"""
+        index = self._indexes.get(device_id)
+        if index is None:
+            index = self._load_snapshot(device_id)
+            if index is not None:
+                self._indexes[device_id] = index
+        return index
+
+    def _load_snapshot(self, device_id):
+        ids_path, vec_path = self._paths(device_id)
+        if not (os.path.exists(ids_path) and os.path.exists(vec_path)):
+            return None
+        try:
+            ids = np.load(ids_path, mmap_mode="r")
+            vectors = np.load(vec_path, mmap_mode="r")
+            if vectors.ndim != 2 or vectors.shape[1] != self.encoder.dim or len(ids) != len(vectors):
+                return None
+            return DeviceMemoryIndex(self.encoder.dim, ids, vectors)
+        except Exception as e:
+            print(f"⚠️ Instantánea de índice ilegible para {device_id}: {e}")
+            return None
+
+    def snapshot(self, device_id):
+        """Marca el índice para guardarlo en la próxima pasada de flush_snapshots"""
+        if device_id in self._indexes:
+            self._dirty.add(device_id)
+
+    def _write_snapshot(self, device_id, ids, vectors):
+        os.makedirs(self.directory, exist_ok=True)
+        for path, array in zip(self._paths(device_id), (ids, vectors)):
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+
+    async def flush_snapshots(self):
+        """Guarda en disco los índices modificados, fuera del bucle de eventos"""
+        dirty, self._dirty = self._dirty, set()
+        for device_id in dirty:
+            index = self._indexes.get(device_id)
+            if index is None:
+                continue
+            # Copia en el bucle (barata) para que los appends no cambien lo que se escribe
+            ids, vectors = np.array(index.ids), np.array(index.vectors)
+            try:
+                await asyncio.to_thread(self._write_snapshot, device_id, ids, vectors)
+            except Exception as e:
+                print(f"⚠️ No se pudo guardar el índice de {device_id}: {e}")
+                self._dirty.add(device_id)
+        return len(dirty)
+
+    def missing_ids(self, device_id, db_ids):
+        """
+        Compara el índice con los ids de recuerdos de la DB: quita los que ya
+        no existen y devuelve los que faltan (se añaden después con build).
+        """
+        index = self.get(device_id)
+        if index is None:
+            index = DeviceMemoryIndex(self.encoder.dim)
+            self._indexes[device_id] = index
+        db_ids = np.fromiter(db_ids, dtype=np.int64)
+        # Los posteriores al último id leído pueden no haber llegado aún a la réplica
+        newest = db_ids.max() if len(db_ids) else 0
+        stale = index.ids[~np.isin(index.ids, db_ids) & (index.ids <= newest)]
+        if len(stale):
+            index.remove(stale)
+            self.snapshot(device_id)
+        return [int(memory_id) for memory_id in db_ids[~np.isin(db_ids, index.ids)]]
+
+    def build(self, device_id, rows):
+        """Construye (o amplía) el índice a partir de filas (id, contenido)"""
+        index = self._indexes.get(device_id)
+        if index is None:
+            index = DeviceMemoryIndex(self.encoder.dim)
+            self._indexes[device_id] = index
+        self._synced[device_id] = time.monotonic()
+        if rows:
+            ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+            index.add(ids, self.encoder.encode([r[1] for r in rows]))
+            self.snapshot(device_id)
+        return index
+
+    def _synced_index(self, device_id):
+        """Índice al que se puede hacer append, o None (y se descarta) si no está sincronizado"""
+        if device_id in self._synced:
+            return self._indexes.get(device_id)
+        # Sin sincronizar: un append movería su contenido por delante de la DB
+        self._indexes.pop(device_id, None)
+        return None
+
+    def add_memory(self, device_id, memory_id, content):
+        """Append incremental de un recuerdo nuevo"""
+        self.add_memories(device_id, [(memory_id, content)])
+
+    def add_memories(self, device_id, rows):
+        """Append incremental de varios recuerdos con una sola instantánea"""
+        index = self._synced_index(device_id)
+        if index is None:
+            # Se añadirán al sincronizar en la próxima búsqueda
+            return
+        ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        # Evita duplicados si la sincronización ya los había traído
+        new = ~np.isin(ids, index.ids)
+        if not new.any():
+            return
+        index.add(ids[new], self.encoder.encode([r[1] for r, keep in zip(rows, new) if keep]))
+        self.snapshot(device_id)
+
+    def replace_memories(self, device_id, rows):
+        """Vuelve a codificar recuerdos (id, texto) ya indexados, p. ej. tras enriquecerlos"""
+        index = self._synced_index(device_id)
+        if index is None:
+            return
+        ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        index.remove(ids)
+        index.add(ids, self.encoder.encode([r[1] for r in rows]))
+        self.snapshot(device_id)
+
+    def search(self, device_id, query, k=3):
+        index = self._indexes.get(device_id)
+        if index is None or not query.strip():
+            return []
+        return index.search(self.encoder.encode([query])[0], k)
+
+
+# Instancia global del índice
+memory_index = MemoryIndexStore()
+
+# Instantáneas agrupadas y fuera del turno: cada proceso guarda las suyas
+scheduler.add_job("memory_index_snapshots", memory_index.flush_snapshots, every=MEMORY_INDEX_SNAPSHOT_SECONDS, local=True)
@@ -0,0 +1,123 @@
+"""
+Ventana de deduplicación de mensajes del cliente.
+
+El frontend asigna un id a cada mensaje de voz y lo reenvía tras una
+reconexión si no ha recibido respuesta. El servidor guarda, por dispositivo,
+un LRU acotado con los ids recientes y las respuestas que generaron, de modo
+que un reintento devuelve la respuesta cacheada en lugar de repetir la llamada
+al LLM y las escrituras en la base de datos.
+"""
+import os
+import time
+import asyncio
+from collections import OrderedDict
+
+
+# Ids recordados por dispositivo y tiempo que se conserva cada uno
+DEDUP_WINDOW_SIZE = int(os.getenv("DEDUP_WINDOW_SIZE", "64"))
+DEDUP_TTL_SECONDS = float(os.getenv("DEDUP_TTL_SECONDS", "900"))
+
+# Dispositivos con ventana en memoria (LRU)
+DEDUP_MAX_DEVICES = int(os.getenv("DEDUP_MAX_DEVICES", "10000"))
+
+# Estados de un id
+NEW = "new"
+PENDING = "pending"
+DONE = "done"
+
+
+class DedupEntry:
+    __slots__ = ("created", "future")
+
+    def __init__(self):
+        self.created = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class MessageDedupWindow:
+    """LRU de ids recientes de un dispositivo con sus respuestas"""
+
+    def __init__(self, max_entries=DEDUP_WINDOW_SIZE, ttl=DEDUP_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._entries:
+            message_id, entry = next(iter(self._entries.items()))
+            if now - entry.created <= self.ttl and len(self._entries) < self.max_entries:
+                break
+            # Un id en curso que se expulsa se cancela; su reintento se procesará de nuevo
+            if not entry.future.done():
+                entry.future.cancel()
+            del self._entries[message_id]
+
+    def begin(self, message_id):
+        """
+        Registra un id. Devuelve (estado, entrada):
+        NEW si hay que procesarlo, PENDING si ya está en curso,
+        DONE si ya tiene respuesta (entrada.future.result()).
+        """
+        self._expire()
+        entry = self._entries.get(message_id)
+        if entry is None:
+            entry = DedupEntry()
+            self._entries[message_id] = entry
+            return NEW, entry
+        self._entries.move_to_end(message_id)
+        if entry.future.done() and not entry.future.cancelled():
+            return DONE, entry
+        return PENDING, entry
+
+    def complete(self, message_ids, frames):
+        """Guarda la respuesta enviada para los ids de un turno"""
+        for message_id in message_ids:
+            entry = self._entries.get(message_id)
+            if entry is not None and not entry.future.done():
+                entry.future.set_result(frames)
+
+    def discard(self, message_ids):
+        """Olvida ids que no llegaron a completarse (un reintento los procesará)"""
+        for message_id in message_ids:
+            entry = self._entries.pop(message_id, None)
+            if entry is not None and not entry.future.done():
+                entry.future.cancel()
+
+
+class MessageDedupRegistry:
+    """Ventanas de deduplicación por dispositivo (sobreviven a las reconexiones)"""
+
+    def __init__(self, max_devices=DEDUP_MAX_DEVICES):
+        self.max_devices = max_devices
+        self._windows = OrderedDict()
+        self.stats = {"new": 0, "retried_done": 0, "retried_pending": 0}
+
+    def window(self, device_id):
+        window = self._windows.get(device_id)
+        if window is None:
+            window = MessageDedupWindow()
+            self._windows[device_id] = window
+            while len(self._windows) > self.max_devices:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(device_id)
+        return window
+
+    def begin(self, device_id, message_id):
+        state, entry = self.window(device_id).begin(message_id)
+        key = {NEW: "new", DONE: "retried_done", PENDING: "retried_pending"}[state]
+        self.stats[key] += 1
+        return state, entry
+
+    def complete(self, device_id, message_ids, frames):
+        if message_ids:
+            self.window(device_id).complete(message_ids, frames)
+
+    def discard(self, device_id, message_ids):
+        if message_ids:
+            self.window(device_id).discard(message_ids)
+
+
+# Instancia global compartida por todas las conexiones /ws
+message_dedup = MessageDedupRegistry()
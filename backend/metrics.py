@@ -0,0 +1,73 @@
+"""
+Métricas en proceso (contadores y tiempos) expuestas en /metrics.
+
+Los tiempos guardan una muestra acotada de las últimas observaciones para
+calcular percentiles sin crecer en memoria.
+"""
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+
+# Observaciones que se conservan por cada métrica de tiempo
+TIMING_SAMPLE_SIZE = 2048
+
+
+class Metrics:
+    """Registro sencillo de contadores y tiempos"""
+
+    def __init__(self, sample_size=TIMING_SAMPLE_SIZE):
+        self.sample_size = sample_size
+        self.counters = defaultdict(int)
+        self._timings = {}
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def observe(self, name, seconds):
+        timing = self._timings.get(name)
+        if timing is None:
+            timing = {"count": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=self.sample_size)}
+            self._timings[name] = timing
+        timing["count"] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+        timing["samples"].append(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Mide el bloque (también sirve alrededor de awaits)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    @staticmethod
+    def _percentile(sorted_samples, pct):
+        if not sorted_samples:
+            return 0.0
+        index = min(len(sorted_samples) - 1, int(round(pct / 100.0 * (len(sorted_samples) - 1))))
+        return sorted_samples[index]
+
+    def snapshot(self):
+        timings = {}
+        for name, timing in self._timings.items():
+            samples = sorted(timing["samples"])
+            timings[name] = {
+                "count": timing["count"],
+                "avg_ms": round(timing["total"] / timing["count"] * 1000, 3) if timing["count"] else 0.0,
+                "p50_ms": round(self._percentile(samples, 50) * 1000, 3),
+                "p95_ms": round(self._percentile(samples, 95) * 1000, 3),
+                "p99_ms": round(self._percentile(samples, 99) * 1000, 3),
+                "max_ms": round(timing["max"] * 1000, 3),
+            }
+        return {"counters": dict(self.counters), "timings": timings}
+
+    def reset(self):
+        self.counters.clear()
+        self._timings.clear()
+
+
+# Instancia global de métricas
+metrics = Metrics()
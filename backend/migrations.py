@@ -0,0 +1,548 @@
+"""
+Migraciones versionadas del esquema.
+
+Sustituyen al create_all que se ejecutaba en cada arranque. Cada migración
+tiene un número de versión y se aplica una sola vez; la versión actual se
+guarda en la tabla schema_version. Al arrancar la app solo se comprueba la
+versión (verify_schema), que es una consulta, y si está desactualizada falla
+con instrucciones: las migraciones se aplican con el comando upgrade, antes de
+desplegar (DB_AUTO_MIGRATE=true las aplica al arrancar, p. ej. en desarrollo).
+
+Una migración publicada no se modifica. Las que crean tablas usan su propia
+copia congelada de la definición (V1, V5... más abajo), nunca los modelos
+de database.py, para que "versión N" sea siempre el mismo esquema aunque los
+modelos cambien después. Las migraciones son idempotentes (IF NOT EXISTS,
+comprobar columnas...) porque las bases anteriores a las migraciones ya tenían
+las tablas de create_all. Los índices se crean en línea con CREATE INDEX
+CONCURRENTLY en PostgreSQL, fuera de transacción, para no bloquear escrituras
+en tablas grandes.
+
+Uso:
+    python -m backend.migrations upgrade     # aplica las pendientes
+    python -m backend.migrations current     # muestra la versión
+    python -m backend.migrations history     # migraciones aplicadas
+"""
+import os
+import sys
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import (
+    inspect, text, MetaData, Table, Column, Index, UniqueConstraint, ForeignKey,
+    Integer, Float, String, Text, Date, DateTime, JSON, BigInteger, Boolean,
+)
+
+from .database import get_engine
+
+
+# Si el esquema está desactualizado al arrancar, aplicar las migraciones en vez de fallar
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "false").lower() in ("1", "true", "yes")
+
+# Clave del advisory lock de PostgreSQL para que solo migre una instancia a la vez
+MIGRATION_LOCK_KEY = 7310352
+
+MIGRATIONS = []
+
+
+class Migration:
+    def __init__(self, version, description, upgrade, transactional=True):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        # Las no transaccionales se ejecutan en autocommit (CREATE INDEX CONCURRENTLY)
+        self.transactional = transactional
+
+
+def migration(version, description, transactional=True):
+    """Registra una función async upgrade(conn) como migración"""
+    def decorator(func):
+        MIGRATIONS.append(Migration(version, description, func, transactional))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return func
+    return decorator
+
+
+def latest_version():
+    return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+
+# ============================================
+# HELPERS - Operaciones idempotentes para las migraciones
+# ============================================
+
+def is_postgres(conn):
+    return conn.dialect.name == "postgresql"
+
+
+async def has_table(conn, table):
+    return await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table(table))
+
+
+async def has_column(conn, table, column):
+    columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns(table))
+    return any(c["name"] == column for c in columns)
+
+
+async def add_column(conn, table, column, ddl_type):
+    """ALTER TABLE ... ADD COLUMN si no existe"""
+    if not await has_column(conn, table, column):
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+
+async def drop_column(conn, table, column):
+    """ALTER TABLE ... DROP COLUMN si existe"""
+    if await has_column(conn, table, column):
+        await conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+
+
+async def create_index(conn, name, table, columns, unique=False):
+    """
+    Crea un índice si no existe. En PostgreSQL usa CONCURRENTLY (la migración
+    debe ser transactional=False) y rehace los índices inválidos que deja un
+    CREATE INDEX CONCURRENTLY interrumpido.
+    """
+    unique_sql = "UNIQUE " if unique else ""
+    column_sql = ", ".join(columns)
+    if is_postgres(conn):
+        invalid = await conn.execute(text(
+            "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = :name AND NOT i.indisvalid"
+        ), {"name": name})
+        if invalid.first():
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        await conn.execute(text(
+            f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({column_sql})"
+        ))
+    else:
+        await conn.execute(text(f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({column_sql})"))
+
+
+async def drop_index(conn, name):
+    if is_postgres(conn):
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    else:
+        await conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+
+async def rebuild_sqlite_table(conn, table):
+    """
+    SQLite: recrea la tabla con la definición (congelada) que recibe y copia
+    las columnas comunes (para borrar columnas UNIQUE o cambiar restricciones).
+    """
+    old_name = f"{table.name}__old"
+    old_columns = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_columns(table.name))
+    indexes = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_indexes(table.name))
+    # Los índices se llevan su nombre con la tabla renombrada: se borran antes
+    for index in indexes:
+        await conn.execute(text(f"DROP INDEX IF EXISTS {index['name']}"))
+    await conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {old_name}"))
+    await conn.run_sync(lambda sync_conn: table.create(sync_conn))
+    columns = ", ".join(c.name for c in table.columns if c.name in {col["name"] for col in old_columns})
+    await conn.execute(text(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM {old_name}"))
+    await conn.execute(text(f"DROP TABLE {old_name}"))
+
+
+async def create_frozen_tables(conn, metadata, names):
+    """CREATE TABLE (si no existe) de tablas congeladas, con sus índices"""
+    tables = [metadata.tables[name] for name in names]
+    await conn.run_sync(lambda sync_conn: metadata.create_all(sync_conn, tables=tables))
+
+
+# ============================================
+# ESQUEMA CONGELADO - Definiciones de cada migración que crea tablas
+# ============================================
+# Copias de los modelos tal como eran al publicarse cada migración (solo lo que
+# afecta al DDL: los default de Python viven en los modelos). No se editan: un
+# cambio de esquema es una migración nueva (y su cambio en el modelo).
+
+# Migración 1: el esquema del antiguo create_all, anterior a las migraciones
+V1 = MetaData()
+
+Table(
+    "memories", V1,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("device_id", String(100), index=True, nullable=False),
+    Column("content", Text, nullable=False),
+    Column("category", String(50)),
+    Column("timestamp", DateTime),
+    Column("last_recalled", DateTime, nullable=True),
+)
+
+Table(
+    "device_data", V1,
+    Column("device_id", String(100), primary_key=True),
+    Column("device_code", String(6), unique=True, nullable=True),
+    Column("user_memory", JSON),
+    Column("conversation_history", JSON),
+    Column("last_updated", DateTime),
+    Column("last_connected", DateTime, nullable=True),
+)
+
+Table(
+    "user_sessions", V1,
+    Column("id", String(100), primary_key=True),
+    Column("phone_number", String(20), index=True, nullable=False),
+    Column("device_id", String(100), index=True, nullable=True),
+    Column("session_token", String(200), unique=True, nullable=False),
+    Column("verified", Boolean),
+    Column("created_at", DateTime),
+    Column("expires_at", DateTime),
+    Column("last_activity", DateTime),
+)
+
+Table(
+    "phone_verifications", V1,
+    Column("id", String(100), primary_key=True),
+    Column("phone_number", String(20), index=True, nullable=False),
+    Column("verification_code", String(200), nullable=False),
+    Column("created_at", DateTime),
+    Column("expires_at", DateTime),
+    Column("attempts", Integer),
+    Column("verified", Boolean),
+)
+
+Table(
+    "user_connections", V1,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("telegram_chat_id", BigInteger, index=True, nullable=False),
+    Column("device_id", String(100), ForeignKey("device_data.device_id", ondelete="CASCADE"), nullable=False),
+    Column("alias", String(50), index=True),
+    Column("created_at", DateTime),
+    UniqueConstraint("telegram_chat_id", "device_id", name="uq_chat_device"),
+    UniqueConstraint("telegram_chat_id", "alias", name="uq_chat_alias"),
+)
+
+Table(
+    "family_messages", V1,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("device_id", String(100), ForeignKey("device_data.device_id", ondelete="CASCADE"), index=True, nullable=False),
+    Column("telegram_chat_id", BigInteger, nullable=False),
+    Column("sender_name", String(100)),
+    Column("message", Text, nullable=False),
+    Column("timestamp", DateTime),
+    Column("read", Boolean),
+)
+
+# Migración 5: tablas de tokens tras pasar a SHA-256 (reconstrucción en SQLite)
+V5 = MetaData()
+
+Table(
+    "user_sessions", V5,
+    Column("id", String(100), primary_key=True),
+    Column("phone_number", String(20), index=True, nullable=False),
+    Column("device_id", String(100), index=True, nullable=True),
+    Column("token_hash", String(64), unique=True, index=True, nullable=False),
+    Column("verified", Boolean),
+    Column("created_at", DateTime),
+    Column("expires_at", DateTime, index=True),
+    Column("last_activity", DateTime),
+)
+
+Table(
+    "phone_verifications", V5,
+    Column("id", String(100), primary_key=True),
+    Column("phone_number", String(20), index=True, nullable=False),
+    Column("code_hash", String(64), unique=True, index=True, nullable=False),
+    Column("created_at", DateTime),
+    Column("expires_at", DateTime, index=True),
+    Column("attempts", Integer),
+    Column("verified", Boolean),
+)
+
+# Migración 7: outbox del bot y solicitudes de conexión
+V7 = MetaData()
+
+# Solo para resolver las ForeignKey; la tabla ya existe y no se crea aquí
+Table("device_data", V7, Column("device_id", String(100), primary_key=True))
+
+Table(
+    "connection_requests", V7,
+    Column("id", String(32), primary_key=True),
+    Column("telegram_chat_id", BigInteger, nullable=False),
+    Column("device_id", String(100), ForeignKey("device_data.device_id", ondelete="CASCADE"), index=True, nullable=False),
+    Column("device_code", String(6)),
+    Column("user_info", JSON),
+    Column("created_at", DateTime),
+    Column("expires_at", DateTime, index=True),
+)
+
+Table(
+    "bot_outbox", V7,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("channel", String(16), nullable=False),
+    Column("recipient", String(100), nullable=False),
+    Column("payload", JSON, nullable=False),
+    Column("created_at", DateTime),
+    Column("delivered_at", DateTime, nullable=True),
+    Column("expires_at", DateTime, index=True),
+    Index("ix_bot_outbox_pending", "channel", "delivered_at", "recipient"),
+)
+
+# Migración 10: contadores de uso por día
+V10 = MetaData()
+
+Table(
+    "usage_daily", V10,
+    Column("device_id", String(100), primary_key=True),
+    Column("day", Date, primary_key=True),
+    Column("turns", Integer, nullable=False),
+    Column("memories_saved", Integer, nullable=False),
+    Column("family_messages_received", Integer, nullable=False),
+    Column("family_messages_read", Integer, nullable=False),
+)
+
+# Migración 13: tareas del planificador
+V13 = MetaData()
+
+Table(
+    "scheduled_jobs", V13,
+    Column("name", String(100), primary_key=True),
+    Column("schedule", String(100), nullable=False),
+    Column("enabled", Boolean, nullable=False),
+    Column("next_run_at", DateTime, nullable=False),
+    Column("last_run_at", DateTime, nullable=True),
+    Column("last_duration", Float, nullable=True),
+    Column("last_error", Text, nullable=True),
+    Column("runs", Integer, nullable=False),
+    Column("lease_owner", String(100), nullable=True),
+    Column("lease_expires_at", DateTime, nullable=True),
+)
+
+
+# ============================================
+# MIGRACIONES
+# ============================================
+
+@migration(1, "Tablas base (equivalente al antiguo create_all)")
+async def create_base_tables(conn):
+    await create_frozen_tables(conn, V1, V1.tables)
+
+
+@migration(2, "Índices de las consultas calientes", transactional=False)
+async def add_hot_path_indexes(conn):
+    await create_index(conn, "ix_memories_device_timestamp", "memories", ["device_id", "timestamp"])
+    await create_index(conn, "ix_family_messages_device_read_timestamp", "family_messages", ["device_id", "read", "timestamp"])
+    await create_index(conn, "ix_user_connections_device_id", "user_connections", ["device_id"])
+    await create_index(conn, "ix_phone_verifications_verification_code", "phone_verifications", ["verification_code"])
+
+
+@migration(3, "Elimina device_data.telegram_chat_id (sustituida por user_connections)")
+async def drop_legacy_telegram_chat_id(conn):
+    if is_postgres(conn):
+        await conn.execute(text("ALTER TABLE device_data DROP COLUMN IF EXISTS telegram_chat_id"))
+    else:
+        await drop_column(conn, "device_data", "telegram_chat_id")
+
+
+@migration(4, "Índices de expires_at para la limpieza de caducados", transactional=False)
+async def add_expires_at_indexes(conn):
+    await create_index(conn, "ix_phone_verifications_expires_at", "phone_verifications", ["expires_at"])
+    await create_index(conn, "ix_user_sessions_expires_at", "user_sessions", ["expires_at"])
+
+
+# Tokens en claro -> resumen SHA-256: (tabla, columna antigua, columna nueva)
+HASHED_TOKEN_COLUMNS = [
+    ("user_sessions", "session_token", "token_hash"),
+    ("phone_verifications", "verification_code", "code_hash"),
+]
+
+
+@migration(5, "Tokens de sesión y de login guardados como SHA-256")
+async def hash_stored_tokens(conn):
+    from .auth_tokens import hash_token
+
+    for table, raw_column, hash_column in HASHED_TOKEN_COLUMNS:
+        if not await has_column(conn, table, raw_column):
+            continue
+        await add_column(conn, table, hash_column, "VARCHAR(64)")
+        rows = (await conn.execute(text(
+            f"SELECT id, {raw_column} FROM {table} WHERE {hash_column} IS NULL"
+        ))).all()
+        if rows:
+            await conn.execute(
+                text(f"UPDATE {table} SET {hash_column} = :digest WHERE id = :id"),
+                [{"digest": hash_token(raw), "id": row_id} for row_id, raw in rows],
+            )
+        print(f"🔐 {len(rows)} tokens de {table} convertidos a SHA-256")
+
+        if is_postgres(conn):
+            await conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {hash_column} SET NOT NULL"))
+            await conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {raw_column}"))
+        else:
+            # SQLite no borra columnas UNIQUE/indexadas: se reconstruye la tabla
+            await rebuild_sqlite_table(conn, V5.tables[table])
+
+
+@migration(6, "Índices únicos de los resúmenes de tokens", transactional=False)
+async def add_token_hash_indexes(conn):
+    await drop_index(conn, "ix_phone_verifications_verification_code")
+    await create_index(conn, "ix_user_sessions_token_hash", "user_sessions", ["token_hash"], unique=True)
+    await create_index(conn, "ix_phone_verifications_code_hash", "phone_verifications", ["code_hash"], unique=True)
+
+
+@migration(7, "Tablas del outbox del bot y de solicitudes de conexión")
+async def create_bot_outbox_tables(conn):
+    await create_frozen_tables(conn, V7, ["connection_requests", "bot_outbox"])
+
+
+@migration(8, "Notas de voz y fotos en family_messages")
+async def add_family_message_media(conn):
+    await add_column(conn, "family_messages", "media_hash", "VARCHAR(64)")
+    await add_column(conn, "family_messages", "media_type", "VARCHAR(16)")
+    await add_column(conn, "family_messages", "media_size", "INTEGER")
+
+
+@migration(9, "Índice de family_messages por chat para los listados de /admin", transactional=False)
+async def add_family_messages_chat_index(conn):
+    await create_index(conn, "ix_family_messages_chat_timestamp", "family_messages", ["telegram_chat_id", "timestamp"])
+
+
+@migration(10, "Tabla usage_daily con los contadores de uso por día")
+async def create_usage_daily(conn):
+    await create_frozen_tables(conn, V10, ["usage_daily"])
+
+
+@migration(11, "Personas, lugares y época de los recuerdos")
+async def add_memory_enrichment(conn):
+    await add_column(conn, "memories", "people", "JSON")
+    await add_column(conn, "memories", "places", "JSON")
+    await add_column(conn, "memories", "era", "VARCHAR(50)")
+    await add_column(conn, "memories", "enriched_at", "TIMESTAMP")
+
+
+@migration(12, "Índice de los recuerdos pendientes de enriquecer", transactional=False)
+async def add_memories_enriched_at_index(conn):
+    await create_index(conn, "ix_memories_enriched_at", "memories", ["enriched_at"])
+
+
+@migration(13, "Tabla scheduled_jobs del planificador de tareas")
+async def create_scheduled_jobs(conn):
+    await create_frozen_tables(conn, V13, ["scheduled_jobs"])
+
+
+@migration(14, "Reclamo con caducidad de los eventos de bot_outbox")
+async def add_bot_outbox_claimed_until(conn):
+    await add_column(conn, "bot_outbox", "claimed_until", "TIMESTAMP")
+
+
+# ============================================
+# RUNNER
+# ============================================
+
+async def _ensure_version_table(conn):
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR(200) NOT NULL, "
+        "applied_at TIMESTAMP NOT NULL)"
+    ))
+
+
+async def current_version(conn=None):
+    """Versión aplicada del esquema (0 si nunca se migró)"""
+    if conn is None:
+        async with get_engine().connect() as conn:
+            return await current_version(conn)
+    if not await has_table(conn, "schema_version"):
+        return 0
+    result = await conn.execute(text("SELECT MAX(version) FROM schema_version"))
+    return result.scalar() or 0
+
+
+async def _run_migration(engine, item):
+    if item.transactional:
+        async with engine.begin() as conn:
+            await item.upgrade(conn)
+            await _record(conn, item)
+    else:
+        async with engine.connect() as conn:
+            conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+            await item.upgrade(conn)
+            await _record(conn, item)
+
+
+async def _record(conn, item):
+    await conn.execute(
+        text("INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)"),
+        {"v": item.version, "d": item.description, "t": datetime.utcnow()},
+    )
+
+
+async def upgrade(target=None):
+    """Aplica en orden las migraciones pendientes hasta target (por defecto, la última)"""
+    engine = get_engine()
+    target = latest_version() if target is None else target
+
+    async with engine.connect() as lock_conn:
+        lock_conn = await lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        postgres = is_postgres(lock_conn)
+        if postgres:
+            await lock_conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": MIGRATION_LOCK_KEY})
+        try:
+            await _ensure_version_table(lock_conn)
+            version = await current_version(lock_conn)
+            pending = [m for m in MIGRATIONS if version < m.version <= target]
+            for item in pending:
+                print(f"🛠️ Aplicando migración {item.version}: {item.description}")
+                await _run_migration(engine, item)
+            if pending:
+                print(f"✅ Esquema actualizado a la versión {pending[-1].version}")
+            return pending[-1].version if pending else version
+        finally:
+            if postgres:
+                await lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_KEY})
+
+
+async def verify_schema():
+    """
+    Comprobación de arranque: solo lee la versión del esquema.
+    Si está desactualizado falla con instrucciones (o migra con DB_AUTO_MIGRATE=true).
+    """
+    version = await current_version()
+    latest = latest_version()
+    if version >= latest:
+        print(f"✅ Esquema de base de datos en la versión {version}")
+        return version
+    if not DB_AUTO_MIGRATE:
+        raise RuntimeError(
+            f"Esquema en la versión {version}, se necesita la {latest}. "
+            f"Ejecuta: python -m backend.migrations upgrade"
+        )
+    print(f"⚠️ Esquema en la versión {version} (última {latest}), aplicando migraciones...")
+    return await upgrade()
+
+
+async def history():
+    async with get_engine().connect() as conn:
+        if not await has_table(conn, "schema_version"):
+            return []
+        result = await conn.execute(text(
+            "SELECT version, description, applied_at FROM schema_version ORDER BY version"
+        ))
+        return result.all()
+
+
+async def _main(argv):
+    from dotenv import load_dotenv
+    load_dotenv()
+    command = argv[0] if argv else "upgrade"
+    try:
+        if command == "upgrade":
+            target = int(argv[1]) if len(argv) > 1 else None
+            version = await upgrade(target)
+            print(f"Versión del esquema: {version}")
+        elif command == "current":
+            print(f"Versión del esquema: {await current_version()} (última disponible: {latest_version()})")
+        elif command == "history":
+            for version, description, applied_at in await history():
+                print(f"{version:>4}  {applied_at}  {description}")
+        else:
+            print("Uso: python -m backend.migrations [upgrade [versión] | current | history]")
+            return 2
+    finally:
+        await get_engine().dispose()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv[1:])))
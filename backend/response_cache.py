@@ -0,0 +1,145 @@
+"""
+Caché de respuestas para preguntas repetidas.
+
+Las personas con pérdida de memoria repiten mucho las mismas preguntas. Esta
+caché guarda, por dispositivo, las respuestas del LLM indexadas por la frase
+normalizada y un hash del contexto de recuerdos usado en el prompt. Se guardan
+varias variantes por pregunta y se van rotando para que no suene repetitivo.
+Las preguntas que dependen del momento (día, hora, tiempo...) nunca se cachean.
+"""
+import os
+import re
+import time
+import hashlib
+from collections import OrderedDict
+
+from .memory_index import normalize_text
+from .metrics import metrics
+
+
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "3"))
+RESPONSE_CACHE_MAX_PER_DEVICE = int(os.getenv("RESPONSE_CACHE_MAX_PER_DEVICE", "256"))
+RESPONSE_CACHE_MAX_DEVICES = int(os.getenv("RESPONSE_CACHE_MAX_DEVICES", "10000"))
+
+# Intenciones cuya respuesta cambia con el tiempo: siempre van al LLM
+TIME_SENSITIVE_REGEX = re.compile(
+    r"\b(hoy|mañana|ayer|ahora|hora|horas|dia|fecha|semana|mes|año|"
+    r"tiempo|clima|llueve|lloviendo|temperatura|noticias|cumpleaños|"
+    r"mensaje|mensajes|cita|medicina|medicacion|pastilla|pastillas)\b"
+)
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_utterance(text):
+    """Minúsculas, sin tildes, sin puntuación y con espacios simples"""
+    text = _PUNCTUATION_RE.sub(" ", normalize_text(text))
+    return _SPACES_RE.sub(" ", text).strip()
+
+
+class CachedResponse:
+    __slots__ = ("created", "variants", "generated", "next_variant")
+
+    def __init__(self):
+        self.created = time.monotonic()
+        self.variants = []
+        self.generated = 0
+        self.next_variant = 0
+
+
+class ResponseCache:
+    """Caché por dispositivo con TTL y rotación de variantes"""
+
+    def __init__(self, ttl=RESPONSE_CACHE_TTL_SECONDS, variants=RESPONSE_CACHE_VARIANTS,
+                 max_per_device=RESPONSE_CACHE_MAX_PER_DEVICE, max_devices=RESPONSE_CACHE_MAX_DEVICES):
+        self.ttl = ttl
+        self.variants = variants
+        self.max_per_device = max_per_device
+        self.max_devices = max_devices
+        self._devices = OrderedDict()
+
+    def is_time_sensitive(self, text):
+        return bool(TIME_SENSITIVE_REGEX.search(normalize_utterance(text)))
+
+    @staticmethod
+    def make_key(text, memory_context):
+        context_hash = hashlib.sha1((memory_context or "").encode("utf-8")).hexdigest()[:16]
+        return normalize_utterance(text), context_hash
+
+    def _device_entries(self, device_id, create=False):
+        entries = self._devices.get(device_id)
+        if entries is None and create:
+            entries = OrderedDict()
+            self._devices[device_id] = entries
+            while len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+        elif entries is not None:
+            self._devices.move_to_end(device_id)
+        return entries
+
+    def get(self, device_id, text, memory_context):
+        """
+        Devuelve una respuesta cacheada o None.
+        Hasta que no se han generado todas las variantes se devuelve None,
+        así las primeras repeticiones producen respuestas distintas.
+        """
+        if self.is_time_sensitive(text):
+            metrics.inc("response_cache.bypass")
+            return None
+
+        entries = self._device_entries(device_id)
+        key = self.make_key(text, memory_context)
+        entry = entries.get(key) if entries is not None else None
+        if entry is not None and time.monotonic() - entry.created > self.ttl:
+            del entries[key]
+            entry = None
+
+        if entry is None or entry.generated < self.variants:
+            metrics.inc("response_cache.misses")
+            return None
+
+        entries.move_to_end(key)
+        response = entry.variants[entry.next_variant % len(entry.variants)]
+        entry.next_variant += 1
+        metrics.inc("response_cache.hits")
+        return response
+
+    def put(self, device_id, text, memory_context, response):
+        """Añade una variante de respuesta para la pregunta"""
+        if not response or self.is_time_sensitive(text):
+            return
+        entries = self._device_entries(device_id, create=True)
+        key = self.make_key(text, memory_context)
+        entry = entries.get(key)
+        if entry is None or time.monotonic() - entry.created > self.ttl:
+            entry = CachedResponse()
+            entries[key] = entry
+        entries.move_to_end(key)
+        entry.generated += 1
+        if response not in entry.variants and len(entry.variants) < self.variants:
+            entry.variants.append(response)
+        while len(entries) > self.max_per_device:
+            entries.popitem(last=False)
+
+    def invalidate(self, device_id):
+        """Olvida las respuestas de un dispositivo"""
+        self._devices.pop(device_id, None)
+
+    def stats(self):
+        hits = metrics.counters["response_cache.hits"]
+        misses = metrics.counters["response_cache.misses"]
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "bypassed": metrics.counters["response_cache.bypass"],
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "devices": len(self._devices),
+            "entries": sum(len(e) for e in self._devices.values()),
+        }
+
+
+# Instancia global de la caché
+response_cache = ResponseCache()
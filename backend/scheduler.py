@@ -0,0 +1,359 @@
+"""
+Planificador de tareas periódicas dentro del proceso (lo arranca el lifespan).
+
+Los módulos registran sus tareas al importarse, como las migraciones:
+
+    @scheduler.job("session_gc", every=3600)
+    async def collect_expired(): ...
+
+    @scheduler.job("informe", cron="30 3 * * *")   # cron de 5 campos, en UTC
+
+- Una tarea nunca se solapa consigo misma: la siguiente ejecución se calcula
+  cuando termina la anterior.
+- Las tareas compartidas (por defecto) tienen una fila en scheduled_jobs con
+  su programación, la próxima ejecución y un lease: antes de ejecutarla, cada
+  réplica intenta quedarse el lease con un UPDATE condicional y solo la que lo
+  consigue la ejecuta. La fila se renueva mientras dura la tarea y, si el
+  proceso muere, el lease caduca y otra réplica la retoma. Con enabled=False en
+  la fila una tarea queda en pausa sin desplegar nada.
+- Las tareas local=True (p. ej. volcar un búfer en memoria) se ejecutan en
+  todas las réplicas y no usan la base de datos.
+
+Métricas: jobs.<nombre> (duración), jobs.<nombre>.runs / .errors.
+"""
+import os
+import time
+import uuid
+import socket
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, or_
+from sqlalchemy.exc import IntegrityError
+
+from .database import async_session, ScheduledJob
+from .metrics import metrics
+
+
+# Espera máxima entre comprobaciones (recoge cambios hechos en la tabla)
+SCHEDULER_MAX_SLEEP_SECONDS = float(os.getenv("SCHEDULER_MAX_SLEEP_SECONDS", "30"))
+
+# Duración del lease de una tarea compartida (se renueva a un tercio)
+SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", "60"))
+
+
+# ============================================
+# CRON
+# ============================================
+
+# El día de la semana admite 0-7 (0 y 7 son domingo)
+CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+
+def _cron_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        part, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(v) for v in part.split("-", 1))
+        else:
+            start = end = int(part)
+            if step > 1:
+                end = high
+        if not (low <= start <= end <= high) or step < 1:
+            raise ValueError(f"Campo cron fuera de rango: {field!r}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Cron:
+    """Expresión cron de 5 campos: minuto hora día-del-mes mes día-de-la-semana (0 = domingo)"""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Se esperaban 5 campos en la expresión cron: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            _cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_RANGES)
+        )
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def _day_matches(self, moment):
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        # Como en cron: si se restringen los dos campos basta con que coincida uno
+        if self._any_day or self._any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, moment):
+        """Primer instante programado estrictamente posterior a moment"""
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"La expresión cron nunca se cumple: {self.expression!r}")
+
+
+# ============================================
+# TAREAS
+# ============================================
+
+class Job:
+    def __init__(self, name, func, every=None, cron=None, local=False, run_at_start=False):
+        if (every is None) == (cron is None):
+            raise ValueError(f"La tarea {name} necesita every o cron (uno de los dos)")
+        self.name = name
+        self.func = func
+        self.every = every
+        self.cron = Cron(cron) if cron else None
+        self.local = local
+        self.run_at_start = run_at_start
+        self.next_run_at = None
+        self.task = None
+
+    @property
+    def schedule(self):
+        return self.cron.expression if self.cron else f"every {self.every:g}s"
+
+    def next_after(self, moment):
+        if self.cron:
+            return self.cron.next_after(moment)
+        return moment + timedelta(seconds=self.every)
+
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wake = asyncio.Event()
+
+    def job(self, name, every=None, cron=None, local=False, run_at_start=False):
+        """Registra una corrutina sin argumentos como tarea periódica"""
+        def decorator(func):
+            self.add_job(name, func, every=every, cron=cron, local=local, run_at_start=run_at_start)
+            return func
+        return decorator
+
+    def add_job(self, name, func, every=None, cron=None, local=False, run_at_start=False):
+        self.jobs[name] = Job(name, func, every, cron, local, run_at_start)
+        self._wake.set()
+
+    def trigger(self, name):
+        """Adelanta la próxima ejecución de una tarea local a ahora mismo"""
+        job = self.jobs.get(name)
+        if job is not None and job.local:
+            job.next_run_at = datetime.utcnow()
+            self._wake.set()
+
+    async def _sync_rows(self, now):
+        """Crea o actualiza la fila de cada tarea compartida y lee su próxima ejecución"""
+        shared = [job for job in self.jobs.values() if not job.local]
+        if not shared:
+            return
+        async with async_session() as session:
+            rows = {
+                row.name: row
+                for row in (await session.execute(
+                    select(ScheduledJob).where(ScheduledJob.name.in_([job.name for job in shared]))
+                )).scalars()
+            }
+            for job in shared:
+                row = rows.get(job.name)
+                running = job.task is not None and not job.task.done()
+                if row is None:
+                    first_run = now if job.run_at_start else job.next_after(now)
+                    session.add(ScheduledJob(name=job.name, schedule=job.schedule, next_run_at=first_run))
+                    job.next_run_at = first_run
+                else:
+                    if row.schedule != job.schedule:
+                        # La programación cambió en el código: se recalcula la siguiente
+                        row.schedule = job.schedule
+                        row.next_run_at = job.next_after(now)
+                    if not running:
+                        job.next_run_at = row.next_run_at if row.enabled else None
+            try:
+                await session.commit()
+            except IntegrityError:
+                # Otra réplica creó las filas a la vez: se leerán en la próxima vuelta
+                await session.rollback()
+
+    async def _refresh(self, job, now):
+        async with async_session() as session:
+            row = await session.get(ScheduledJob, job.name)
+        if row is None or not row.enabled:
+            job.next_run_at = None
+        elif row.next_run_at <= now:
+            # Otra réplica la está ejecutando: se vuelve a mirar cuando caduque su lease
+            job.next_run_at = row.lease_expires_at or now + timedelta(seconds=SCHEDULER_LEASE_SECONDS)
+        else:
+            job.next_run_at = row.next_run_at
+
+    async def _acquire(self, job, now):
+        """True si esta réplica se queda el lease de la ejecución que toca"""
+        async with async_session() as session:
+            result = await session.execute(
+                update(ScheduledJob)
+                .where(
+                    ScheduledJob.name == job.name,
+                    ScheduledJob.enabled == True,
+                    ScheduledJob.next_run_at <= now,
+                    or_(ScheduledJob.lease_expires_at.is_(None), ScheduledJob.lease_expires_at < now),
+                )
+                .values(lease_owner=self.owner, lease_expires_at=now + timedelta(seconds=SCHEDULER_LEASE_SECONDS))
+            )
+            await session.commit()
+        return result.rowcount == 1
+
+    async def _renew(self, job):
+        """Mantiene el lease mientras la tarea sigue en marcha"""
+        while True:
+            await asyncio.sleep(SCHEDULER_LEASE_SECONDS / 3)
+            async with async_session() as session:
+                await session.execute(
+                    update(ScheduledJob)
+                    .where(ScheduledJob.name == job.name, ScheduledJob.lease_owner == self.owner)
+                    .values(lease_expires_at=datetime.utcnow() + timedelta(seconds=SCHEDULER_LEASE_SECONDS))
+                )
+                await session.commit()
+
+    async def _release(self, job, started_at, duration, error):
+        next_run_at = job.next_after(datetime.utcnow())
+        async with async_session() as session:
+            await session.execute(
+                update(ScheduledJob)
+                .where(ScheduledJob.name == job.name, ScheduledJob.lease_owner == self.owner)
+                .values(
+                    next_run_at=next_run_at,
+                    last_run_at=started_at,
+                    last_duration=duration,
+                    last_error=error,
+                    runs=ScheduledJob.runs + 1,
+                    lease_owner=None,
+                    lease_expires_at=None,
+                )
+            )
+            await session.commit()
+        job.next_run_at = next_run_at
+
+    async def _execute(self, job):
+        started_at = datetime.utcnow()
+        started = time.perf_counter()
+        renewer = None if job.local else asyncio.create_task(self._renew(job))
+        error = None
+        try:
+            await job.func()
+            metrics.inc(f"jobs.{job.name}.runs")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"[:1000]
+            print(f"❌ Error en la tarea {job.name}: {error}")
+            metrics.inc(f"jobs.{job.name}.errors")
+        finally:
+            duration = time.perf_counter() - started
+            metrics.observe(f"jobs.{job.name}", duration)
+            if renewer:
+                renewer.cancel()
+        if job.local:
+            job.next_run_at = job.next_after(datetime.utcnow())
+        else:
+            await self._release(job, started_at, duration, error)
+        self._wake.set()
+
+    async def _start_due(self, job, now):
+        if job.task is not None and not job.task.done():
+            job.next_run_at = None
+            return
+        if not job.local:
+            try:
+                acquired = await self._acquire(job, now)
+            except Exception as e:
+                print(f"❌ Error tomando el lease de {job.name}: {e}")
+                return
+            if not acquired:
+                # La ejecutó (o la está ejecutando) otra réplica
+                await self._refresh(job, now)
+                return
+        # No vuelve a tocar hasta que termine
+        job.next_run_at = None
+        job.task = asyncio.create_task(self._execute(job))
+
+    async def run(self):
+        """Bucle del planificador para el lifespan (se cancela al cerrar)"""
+        now = datetime.utcnow()
+        for job in self.jobs.values():
+            if job.local:
+                job.next_run_at = now if job.run_at_start else job.next_after(now)
+        last_sync = 0.0
+        try:
+            while True:
+                now = datetime.utcnow()
+                if time.monotonic() - last_sync >= SCHEDULER_MAX_SLEEP_SECONDS:
+                    try:
+                        await self._sync_rows(now)
+                        last_sync = time.monotonic()
+                    except Exception as e:
+                        print(f"❌ Error leyendo las tareas programadas: {e}")
+                for job in list(self.jobs.values()):
+                    if job.next_run_at is not None and job.next_run_at <= now:
+                        await self._start_due(job, now)
+
+                pending = [job.next_run_at for job in self.jobs.values() if job.next_run_at is not None]
+                sleep = SCHEDULER_MAX_SLEEP_SECONDS
+                if pending:
+                    sleep = min(sleep, max((min(pending) - datetime.utcnow()).total_seconds(), 0.0))
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), sleep)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """Cancela las tareas en marcha (su lease caduca solo)"""
+        running = [job.task for job in self.jobs.values() if job.task is not None and not job.task.done()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    async def status(self):
+        """Filas de las tareas compartidas y estado de las locales (para /jobs)"""
+        async with async_session() as session:
+            rows = {row.name: row for row in (await session.execute(select(ScheduledJob))).scalars()}
+        result = []
+        for job in self.jobs.values():
+            row = rows.get(job.name)
+            next_run_at = row.next_run_at if row else job.next_run_at
+            result.append({
+                "name": job.name,
+                "schedule": job.schedule,
+                "local": job.local,
+                "running": job.task is not None and not job.task.done(),
+                "enabled": row.enabled if row else True,
+                "next_run_at": next_run_at.isoformat() if next_run_at else None,
+                "last_run_at": row.last_run_at.isoformat() if row and row.last_run_at else None,
+                "last_duration": row.last_duration if row else None,
+                "last_error": row.last_error if row else None,
+                "lease_owner": row.lease_owner if row else None,
+            })
+        return result
+
+
+scheduler = Scheduler()
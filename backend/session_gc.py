@@ -0,0 +1,83 @@
+"""
+Limpieza periódica de sesiones, tokens de login y eventos del bot caducados.
+
+Los tokens de /login (PhoneVerification, 5-10 minutos) y las sesiones
+(UserSession, 30 días o 1 año) nunca se borraban, y validate_session_token y
+auth_with_telegram consultan esas tablas. Esta tarea (session_gc en
+backend/scheduler.py, una sola réplica a la vez) borra las filas con expires_at
+vencido en lotes pequeños
+(DELETE ... WHERE id IN (SELECT id ... LIMIT n)), cada uno en su propia
+transacción, para no mantener bloqueos largos. Las búsquedas por expires_at
+usan los índices de la migración 4. También caducan las solicitudes de
+/connect sin responder y los eventos de bot_outbox (ver bot_outbox.py).
+
+Métricas: gc.<tabla>.reclaimed (filas borradas) y el tiempo de cada pasada en gc.run.
+"""
+import os
+import time
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import select, delete
+
+from .database import async_session, PhoneVerification, UserSession, ConnectionRequest, BotOutbox
+from .metrics import metrics
+from .scheduler import scheduler
+
+
+# Segundos entre pasadas de limpieza
+GC_INTERVAL_SECONDS = float(os.getenv("GC_INTERVAL_SECONDS", "3600"))
+
+# Filas borradas por transacción
+GC_BATCH_SIZE = int(os.getenv("GC_BATCH_SIZE", "500"))
+
+# Pausa entre lotes para dejar paso al tráfico normal
+GC_BATCH_PAUSE_SECONDS = float(os.getenv("GC_BATCH_PAUSE_SECONDS", "0.05"))
+
+# Tablas con caducidad: (modelo, clave primaria)
+EXPIRING_TABLES = [
+    (PhoneVerification, PhoneVerification.id),
+    (UserSession, UserSession.id),
+    (ConnectionRequest, ConnectionRequest.id),
+    (BotOutbox, BotOutbox.id),
+]
+
+
+async def delete_expired(model, key, now=None, batch_size=None):
+    """Borra en lotes las filas caducadas de un modelo; devuelve cuántas borró"""
+    now = now or datetime.utcnow()
+    batch_size = batch_size or GC_BATCH_SIZE
+    reclaimed = 0
+    while True:
+        batch = select(key).where(model.expires_at < now).limit(batch_size).scalar_subquery()
+        async with async_session() as session:
+            result = await session.execute(
+                delete(model).where(key.in_(batch)).execution_options(synchronize_session=False)
+            )
+            await session.commit()
+        deleted = result.rowcount or 0
+        reclaimed += deleted
+        if deleted < batch_size:
+            return reclaimed
+        await asyncio.sleep(GC_BATCH_PAUSE_SECONDS)
+
+
+@scheduler.job("session_gc", every=GC_INTERVAL_SECONDS, run_at_start=True)
+async def collect_expired():
+    """Una pasada de limpieza sobre todas las tablas con caducidad"""
+    started = time.perf_counter()
+    now = datetime.utcnow()
+    reclaimed = {}
+    for model, key in EXPIRING_TABLES:
+        table = model.__tablename__
+        try:
+            reclaimed[table] = await delete_expired(model, key, now)
+            metrics.inc(f"gc.{table}.reclaimed", reclaimed[table])
+        except Exception as e:
+            print(f"❌ Error limpiando {table}: {e}")
+            metrics.inc(f"gc.{table}.errors")
+    metrics.observe("gc.run", time.perf_counter() - started)
+    if any(reclaimed.values()):
+        print(f"🧹 Limpieza de caducados: {reclaimed}")
+    return reclaimed
+
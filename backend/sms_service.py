@@ -1,9 +1,9 @@
 import os
-import secrets
 from datetime import datetime, timedelta
 from twilio.rest import Client
 from sqlalchemy import select
 from .database import async_session, PhoneVerification, UserSession
+from .auth_tokens import new_token, hash_token, find_active_session
 
 class SMSVerificationService:
     """Servicio para enviar y verificar códigos SMS"""
@@ -60,12 +60,12 @@ class SMSVerificationService:
             
             if verification_check.status == 'approved':
                 # Crear sesión en la base de datos
-                session_token = secrets.token_urlsafe(32)
+                session_token = new_token()
                 
                 async with async_session() as session:
                     new_session = UserSession(
                         phone_number=phone_number,
-                        session_token=session_token,
+                        token_hash=hash_token(session_token),
                         verified=True
                     )
                     session.add(new_session)
@@ -99,29 +99,15 @@ class SMSVerificationService:
     async def validate_session(self, session_token: str) -> dict:
         """Valida si una sesión es válida y activa"""
         try:
-            async with async_session() as db_session:
-                stmt = select(UserSession).where(
-                    UserSession.session_token == session_token,
-                    UserSession.verified == True,
-                    UserSession.expires_at > datetime.utcnow()
-                )
-                result = await db_session.execute(stmt)
-                session = result.scalar_one_or_none()
-                
-                if session:
-                    # Actualizar última actividad
-                    session.last_activity = datetime.utcnow()
-                    await db_session.commit()
-                    
-                    return {
-                        "valid": True,
-                        "session_id": session.id,
-                        "phone_number": session.phone_number,
-                        "device_id": session.device_id
-                    }
-                else:
-                    return {"valid": False}
-                    
+            session = await find_active_session(session_token)
+            if session is None:
+                return {"valid": False}
+            return {
+                "valid": True,
+                "session_id": session.id,
+                "phone_number": session.phone_number,
+                "device_id": session.device_id
+            }
         except Exception as e:
             print(f"❌ Error validando sesión: {e}")
             return {"valid": False, "error": str(e)}
@@ -131,7 +117,7 @@ class SMSVerificationService:
         try:
             async with async_session() as db_session:
                 stmt = select(UserSession).where(
-                    UserSession.session_token == session_token
+                    UserSession.token_hash == hash_token(session_token)
                 )
                 result = await db_session.execute(stmt)
                 session = result.scalar_one_or_none()
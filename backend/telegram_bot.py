@@ -1,29 +1,50 @@
 import os
 import json
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta
 from telegram import Update, BotCommand 
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import aiofiles
+import httpx
 import traceback
 import secrets
-from sqlalchemy import select, delete, update as sqlalchemy_update
-from .database import async_session, PhoneVerification, DeviceData, UserConnections, FamilyMessages
+from sqlalchemy import select, delete, insert, update as sqlalchemy_update
+from .database import async_session, read_session, mark_written, PhoneVerification, DeviceData, UserConnections, FamilyMessages, ConnectionRequest
+from .ws_protocol import send_frame
+from .db_instrumentation import counted
+from .auth_tokens import hash_token
+from . import bot_outbox
+from .usage_rollups import usage_rollups
+from .media_store import media_store, MediaTooLarge, MEDIA_MAX_BYTES, MEDIA_CHUNK_SIZE
 
-# --- Variables Globales ---
-ACTIVE_WEBSOCKETS = {}
-PENDING_REQUESTS = {}
+# --- Comunicación con el servidor web ---
+# El bot puede correr en otro proceso (backend/bot_worker.py): los frames para
+# los dispositivos y los mensajes para Telegram pasan por la tabla bot_outbox,
+# y las solicitudes de /connect pendientes por la tabla connection_requests.
 
-def set_shared_state(active_ws: dict, pending_req: dict):
-    global ACTIVE_WEBSOCKETS, PENDING_REQUESTS
-    ACTIVE_WEBSOCKETS = active_ws
-    print("✅ Global state received in telegram_bot")
+# /m todos <mensaje>: envía a todos los dispositivos conectados del chat
+BROADCAST_ALL_KEYWORDS = ("todos", "all")
+
+# Texto de los mensajes con adjunto y sin pie (la app lo lee en voz alta)
+MEDIA_PLACEHOLDERS = {"voice": "🎤 Nota de voz", "photo": "📷 Foto"}
+
+# Validez del destino que fija `/m <alias>` para la siguiente nota de voz o foto
+MEDIA_TARGET_SECONDS = int(os.getenv("MEDIA_TARGET_SECONDS", "600"))
+
+# Tiempo máximo de descarga de un adjunto
+MEDIA_DOWNLOAD_TIMEOUT = float(os.getenv("MEDIA_DOWNLOAD_TIMEOUT", "60"))
+
+# Servidor de la Bot API (p. ej. uno propio o el falso de scripts/e2e_bot_worker.py)
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
+TELEGRAM_API_BASE_FILE_URL = os.getenv("TELEGRAM_API_BASE_FILE_URL")
 
 
 class FamilyMessagesBot:
     def __init__(self, token):
         self.token = token
         self.application = None
+        # chat_id -> (destino, caducidad) fijado con `/m <alias>` para el próximo adjunto
+        self.media_targets = {}
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_name = update.effective_user.first_name
@@ -38,7 +59,7 @@ class FamilyMessagesBot:
     async def get_unread_messages(self):
         """Get all unread messages sorted chronologically by timestamp from database"""
         try:
-            async with async_session() as session:
+            async with read_session() as session:
                 # Query unread messages from database
                 stmt = select(FamilyMessages).where(
                     FamilyMessages.read == False
@@ -80,7 +101,7 @@ class FamilyMessagesBot:
             target_date = datetime(int(year), int(month), int(day))
             next_date = target_date + timedelta(days=1)
             
-            async with async_session() as session:
+            async with read_session() as session:
                 # Query messages from that specific date
                 stmt = select(FamilyMessages).where(
                     FamilyMessages.timestamp >= target_date,
@@ -117,7 +138,7 @@ class FamilyMessagesBot:
     async def get_all_messages(self):
         """Get ALL messages from database (for old/historical messages)"""
         try:
-            async with async_session() as session:
+            async with read_session() as session:
                 # Query all messages
                 stmt = select(FamilyMessages).order_by(FamilyMessages.timestamp.desc())
                 
@@ -170,6 +191,15 @@ class FamilyMessagesBot:
 • `/m <nombre> <mensaje>`
   Envía un mensaje al dispositivo que especifiques por su alias.
   Ej: `/m Mama ¿Has tomado ya la medicación?`
+
+• `/m <nombre1>,<nombre2> <mensaje>` o `/m todos <mensaje>`
+  Envía el mismo mensaje a varios dispositivos (o a todos los tuyos).
+  Ej: `/m Mama,Papa ¡Feliz domingo!`
+
+*NOTAS DE VOZ Y FOTOS:*
+• Envíalas directamente si solo tienes un dispositivo.
+• Con varios, escribe el alias al principio del pie de foto (ej: `Mama ¡mira!`)
+  o envía antes `/m <nombre>` y después la nota de voz.
 """
         await update.message.reply_text(help_text, parse_mode="Markdown")
 
@@ -207,84 +237,73 @@ class FamilyMessagesBot:
                 await update.message.reply_text(f"✅ Ya estabas conectado a este dispositivo (Alias: {existing_conn.alias or 'ninguno'}).")
                 return
             
-            websocket = ACTIVE_WEBSOCKETS.get(device_id)
-            if not websocket:
-                await update.message.reply_text("❌ Dispositivo no conectado. Asegúrate de que la app esté abierta en el dispositivo antes de conectar.")
-                return
-            
+            # Solicitud durable: si la app no está abierta, la recibe al abrirla
             request_id = secrets.token_urlsafe(16)
-            PENDING_REQUESTS[request_id] = {
-                "chat_id": chat_id,
-                "user_info": user_info,
-                "device_id": device_id,
-                "device_code": device_code,
-                "timestamp": datetime.utcnow()
-            }
-            
-            try:
-                await websocket.send_text(json.dumps({
-                    "type": "connection_request",
-                    "request_id": request_id,
-                    "user_info": user_info
-                }))
-                await update.message.reply_text(f"⏳ Solicitud enviada al dispositivo {device_code}. Por favor, pide al usuario de la app que apruebe la conexión.")
-                print(f"🔔 Solicitud de conexión {request_id} enviada a {device_id} para chat {chat_id}")
-            except Exception as e:
-                print(f"❌ Error enviando solicitud por WebSocket: {e}")
-                await update.message.reply_text("❌ Error al contactar con el dispositivo. Inténtalo de nuevo.")
-                if request_id in PENDING_REQUESTS:
-                    del PENDING_REQUESTS[request_id]
+            session.add(ConnectionRequest(
+                id=request_id,
+                telegram_chat_id=chat_id,
+                device_id=device_id,
+                device_code=device_code,
+                user_info=user_info
+            ))
+            bot_outbox.enqueue(session, bot_outbox.DEVICE, device_id, {
+                "type": "connection_request",
+                "request_id": request_id,
+                "user_info": user_info
+            })
+            await session.commit()
+
+        await update.message.reply_text(
+            f"⏳ Solicitud enviada al dispositivo {device_code}. Por favor, pide al usuario de la app que apruebe la conexión.\n"
+            f"Si la app está cerrada, la verá al abrirla (válida 10 minutos)."
+        )
+        print(f"🔔 Solicitud de conexión {request_id} encolada para {device_id} (chat {chat_id})")
 
     async def process_connection_response(self, request_id: str, approved: bool, websocket):
-        """Procesa la respuesta (aprobación/rechazo) del frontend"""
+        """Procesa la respuesta (aprobación/rechazo) del frontend. Corre en el servidor web."""
         print(f"Processing connection response for {request_id}, approved: {approved}")
-        
-        request_data = PENDING_REQUESTS.get(request_id)
-        if not request_data:
-            print(f"⚠️ Solicitud {request_id} no encontrada o ya procesada.")
-            try:
-                await websocket.send_text(json.dumps({"type": "error", "text": "Solicitud no encontrada."}))
-            except: pass
-            return
 
-        chat_id = request_data["chat_id"]
-        user_name = request_data["user_info"]["user_full_name"]
-        device_id = request_data["device_id"]
-        device_code = request_data["device_code"]
+        try:
+            async with async_session() as session:
+                request_data = await session.get(ConnectionRequest, request_id)
+                if not request_data or request_data.expires_at < datetime.utcnow():
+                    print(f"⚠️ Solicitud {request_id} no encontrada, caducada o ya procesada.")
+                    try:
+                        await send_frame(websocket, {"type": "error", "text": "Solicitud no encontrada."})
+                    except: pass
+                    return
 
-        del PENDING_REQUESTS[request_id]
+                chat_id = request_data.telegram_chat_id
+                user_name = request_data.user_info.get("user_full_name")
+                device_code = request_data.device_code
+                await session.delete(request_data)
 
-        try:
-            if approved:
-                async with async_session() as session:
-                    new_connection = UserConnections(
+                if approved:
+                    session.add(UserConnections(
                         telegram_chat_id=chat_id,
-                        device_id=device_id,
-                        alias=None 
-                    )
-                    session.add(new_connection)
-                    await session.commit()
-                
-                await self.application.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"✅ ¡Conexión Aprobada!\n\n"
-                         f"Ahora estás conectado al dispositivo {device_code}.\n"
-                         f"Usa `/alias {device_code} <nombre>` para ponerle un nombre fácil (ej: `/alias {device_code} Mama`).",
-                    parse_mode="Markdown"
-                )
-                
-                await websocket.send_text(json.dumps({
+                        device_id=request_data.device_id,
+                        alias=None
+                    ))
+                    # El proceso del bot envía la respuesta al chat
+                    bot_outbox.enqueue(session, bot_outbox.TELEGRAM, chat_id, {
+                        "text": f"✅ ¡Conexión Aprobada!\n\n"
+                                f"Ahora estás conectado al dispositivo {device_code}.\n"
+                                f"Usa `/alias {device_code} <nombre>` para ponerle un nombre fácil (ej: `/alias {device_code} Mama`).",
+                        "parse_mode": "Markdown"
+                    })
+                else:
+                    bot_outbox.enqueue(session, bot_outbox.TELEGRAM, chat_id, {
+                        "text": f"❌ Conexión Rechazada.\n\nEl usuario del dispositivo {device_code} ha rechazado tu solicitud."
+                    })
+                await session.commit()
+
+            if approved:
+                await send_frame(websocket, {
                     "type": "connection_approved",
                     "user_name": user_name,
                     "chat_id": chat_id
-                }))
-                
-            else:
-                await self.application.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"❌ Conexión Rechazada.\n\nEl usuario del dispositivo {device_code} ha rechazado tu solicitud."
-                )
-                
+                })
+
         except Exception as e:
             print(f"❌ Error al procesar la respuesta de conexión: {e}")
             traceback.print_exc()
@@ -366,50 +385,159 @@ class FamilyMessagesBot:
             else:
                 await update.message.reply_text(f"✅ Desconectado del dispositivo '{alias}'.")
 
+    async def _chat_connections(self, session, chat_id):
+        """Dispositivos conectados a un chat (una sola consulta)"""
+        stmt = select(UserConnections).where(UserConnections.telegram_chat_id == chat_id)
+        return (await session.execute(stmt)).scalars().all()
+
+    @staticmethod
+    def _select_targets(connections, targets):
+        """Destinos de un alias, una lista 'Mama,Papa' o 'todos'; devuelve (conexiones, alias no encontrados)"""
+        if targets.lower() in BROADCAST_ALL_KEYWORDS:
+            return list(connections), []
+        aliases = list(dict.fromkeys(a for a in targets.split(",") if a))
+        selected = [c for c in connections if c.alias in aliases]
+        found = {c.alias for c in selected}
+        return selected, [a for a in aliases if a not in found]
+
+    async def _send_family_message(self, session, chat_id, sender_name, connections, text, media=None):
+        """Guarda el mensaje para cada dispositivo y encola sus avisos (dos INSERT de varias filas)"""
+        # Un dispositivo recibe el mensaje una vez aunque se repita el alias
+        device_ids = list(dict.fromkeys(c.device_id for c in connections))
+        now = datetime.utcnow()
+        await session.execute(insert(FamilyMessages).values([
+            {
+                "device_id": device_id,
+                "telegram_chat_id": chat_id,
+                "sender_name": sender_name,
+                "message": text,
+                "timestamp": now,
+                "read": False,
+                **(media or {})
+            }
+            for device_id in device_ids
+        ]))
+        # El servidor web avisa a cada dispositivo cuando esté conectado
+        await bot_outbox.enqueue_many(session, bot_outbox.DEVICE, device_ids, {
+            "type": "new_message_notification"
+        })
+        await session.commit()
+        # Solo vale en este proceso; con el bot aparte lo marca deliver_to_devices al avisar
+        mark_written(*device_ids)
+        for device_id in device_ids:
+            usage_rollups.record(device_id, "family_messages_received")
+        print(f"📨 Notificación de mensaje nuevo encolada para {len(device_ids)} dispositivo(s)")
+        return device_ids
+
+    @staticmethod
+    def _sent_reply(what, connections, missing):
+        reply = f"✅ {what} a {', '.join(repr(c.alias or c.device_id) for c in connections)}."
+        if missing:
+            reply += f"\n⚠️ No encuentro: {', '.join(repr(a) for a in missing)}."
+        return reply
+
     async def message_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
         sender_name = update.effective_user.first_name
         
-        if not context.args or len(context.args) < 2:
-            await update.message.reply_text("Uso: `/m <alias> <mensaje>`\nEj: `/m Mama ¡Hola!`", parse_mode="Markdown")
+        if not context.args:
+            await update.message.reply_text(
+                "Uso: `/m <alias> <mensaje>`\nEj: `/m Mama ¡Hola!`\n"
+                "Varios dispositivos: `/m Mama,Papa <mensaje>` o `/m todos <mensaje>`",
+                parse_mode="Markdown"
+            )
             return
 
-        alias = context.args[0]
+        targets = context.args[0]
         message_text = " ".join(context.args[1:])
         
         async with async_session() as session:
-            stmt_conn = select(UserConnections).where(
-                UserConnections.telegram_chat_id == chat_id,
-                UserConnections.alias == alias
-            )
-            connection = (await session.execute(stmt_conn)).scalar_one_or_none()
+            # Todos los destinos en una sola consulta
+            connections, missing = self._select_targets(await self._chat_connections(session, chat_id), targets)
             
-            if not connection:
-                await update.message.reply_text(f"❌ No tienes ningún dispositivo con el alias '{alias}'.\nUsa `/connect` y `/alias` primero.", parse_mode="Markdown")
+            if not connections:
+                await update.message.reply_text(f"❌ No tienes ningún dispositivo con el alias '{targets}'.\nUsa `/connect` y `/alias` primero.", parse_mode="Markdown")
+                return
+
+            if not message_text:
+                # `/m <alias>` sin texto: la próxima nota de voz o foto va a ese destino
+                self.media_targets[chat_id] = (targets, datetime.utcnow() + timedelta(seconds=MEDIA_TARGET_SECONDS))
+                await update.message.reply_text(f"🎤 Envía ahora la nota de voz o la foto para {', '.join(repr(c.alias) for c in connections)}.")
                 return
             
-            new_message = FamilyMessages(
-                device_id=connection.device_id,
-                telegram_chat_id=chat_id,
-                sender_name=sender_name,
-                message=message_text,
-                timestamp=datetime.utcnow(),
-                read=False
-            )
-            session.add(new_message)
-            await session.commit()
-            
-            await update.message.reply_text(f"✅ Mensaje enviado a '{alias}'.")
+            await self._send_family_message(session, chat_id, sender_name, connections, message_text)
             
-            websocket = ACTIVE_WEBSOCKETS.get(connection.device_id)
-            if websocket:
-                try:
-                    await websocket.send_text(json.dumps({
-                        "type": "new_message_notification"
-                    }))
-                    print(f"📨 Notificación de mensaje nuevo enviada a {connection.device_id}")
-                except Exception as e:
-                    print(f"❌ Error notificando a WebSocket {connection.device_id}: {e}")
+        await update.message.reply_text(self._sent_reply("Mensaje enviado", connections, missing))
+
+    async def _download_media(self, bot, file_id):
+        """Descarga un fichero de Telegram por trozos al media_store; devuelve (sha256, tamaño)"""
+        tg_file = await bot.get_file(file_id)
+        if tg_file.file_size and tg_file.file_size > MEDIA_MAX_BYTES:
+            raise MediaTooLarge(f"{tg_file.file_size} bytes")
+        async with httpx.AsyncClient(timeout=MEDIA_DOWNLOAD_TIMEOUT) as client:
+            async with client.stream("GET", tg_file.file_path) as response:
+                response.raise_for_status()
+                return await media_store.save_stream(response.aiter_bytes(MEDIA_CHUNK_SIZE))
+
+    async def media_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Nota de voz o foto para uno o varios dispositivos. El destino es el alias
+        al principio del pie ("Mama ¡mira!", "Mama,Papa ...", "todos ..."), el de
+        un `/m <alias>` previo o el único dispositivo conectado del chat.
+        """
+        chat_id = update.effective_chat.id
+        sender_name = update.effective_user.first_name
+        message = update.message
+        if message.voice:
+            media_type, attachment = "voice", message.voice
+        else:
+            # La última foto es la de mayor resolución
+            media_type, attachment = "photo", message.photo[-1]
+
+        caption = (message.caption or "").strip()
+        first_word, _, rest = caption.partition(" ")
+        pending = self.media_targets.pop(chat_id, None)
+
+        async with async_session() as session:
+            chat_connections = await self._chat_connections(session, chat_id)
+        connections, missing = self._select_targets(chat_connections, first_word) if first_word else ([], [])
+        text = rest.strip()
+        if not connections:
+            # El pie no empieza por un alias: es todo texto
+            text, missing = caption, []
+            if pending and pending[1] > datetime.utcnow():
+                connections, missing = self._select_targets(chat_connections, pending[0])
+            elif len(chat_connections) == 1:
+                connections = list(chat_connections)
+
+        if not connections:
+            if not chat_connections:
+                await message.reply_text("❌ No tienes ningún dispositivo conectado.\nUsa `/connect` primero.", parse_mode="Markdown")
+            else:
+                await message.reply_text(
+                    "ℹ️ Tienes varios dispositivos. Escribe el alias al principio del pie de foto "
+                    "(ej: `Mama ¡mira!`) o envía antes `/m <alias>` y después la nota de voz.",
+                    parse_mode="Markdown"
+                )
+            return
+
+        try:
+            media_hash, media_size = await self._download_media(context.bot, attachment.file_id)
+        except MediaTooLarge:
+            await message.reply_text("❌ El archivo es demasiado grande (máximo 20 MB).")
+            return
+        except Exception as e:
+            print(f"❌ Error descargando {media_type} de Telegram: {e}")
+            await message.reply_text("❌ No he podido descargar el archivo. Inténtalo de nuevo.")
+            return
+
+        async with async_session() as session:
+            await self._send_family_message(
+                session, chat_id, sender_name, connections, text or MEDIA_PLACEHOLDERS[media_type],
+                media={"media_hash": media_hash, "media_type": media_type, "media_size": media_size}
+            )
+        what = "Nota de voz enviada" if media_type == "voice" else "Foto enviada"
+        await message.reply_text(self._sent_reply(what, connections, missing))
 
     async def login_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = update.effective_chat.id
@@ -424,7 +552,7 @@ class FamilyMessagesBot:
                 new_token = PhoneVerification(
                     id=secrets.token_urlsafe(16),
                     phone_number=str(chat_id),
-                    verification_code=token,
+                    code_hash=hash_token(token), # El token solo viaja en el enlace
                     expires_at=datetime.utcnow() + timedelta(minutes=5)
                 )
                 session.add(new_token)
@@ -457,11 +585,16 @@ class FamilyMessagesBot:
     async def start_bot(self):
         if not self.token:
             print("❌ Token de Telegram no configurado")
-            return        
+            return False
         
         try:
             print(f"🔄 Intentando iniciar bot de Telegram...")
-            self.application = Application.builder().token(self.token).build()
+            builder = Application.builder().token(self.token)
+            if TELEGRAM_API_BASE_URL:
+                builder = builder.base_url(TELEGRAM_API_BASE_URL)
+            if TELEGRAM_API_BASE_FILE_URL:
+                builder = builder.base_file_url(TELEGRAM_API_BASE_FILE_URL)
+            self.application = builder.build()
 
             commands = [
                 BotCommand("start", "👋 Bienvenida e info"),
@@ -478,29 +611,39 @@ class FamilyMessagesBot:
             self.application.add_handler(CommandHandler("start", self.start_command))
             self.application.add_handler(CommandHandler("help", self.help_command))
             self.application.add_handler(CommandHandler("ayuda", self.help_command))
-            self.application.add_handler(CommandHandler("login", self.login_command))
-            self.application.add_handler(CommandHandler("connect", self.connect_command))
-            self.application.add_handler(CommandHandler("alias", self.alias_command))
-            self.application.add_handler(CommandHandler("disconnect", self.disconnect_command))
-            self.application.add_handler(CommandHandler("m", self.message_command))
+            # Los comandos con acceso a DB cuentan sus consultas SQL (ámbitos bot.<comando>)
+            self.application.add_handler(CommandHandler("login", counted("bot.login")(self.login_command)))
+            self.application.add_handler(CommandHandler("connect", counted("bot.connect")(self.connect_command)))
+            self.application.add_handler(CommandHandler("alias", counted("bot.alias")(self.alias_command)))
+            self.application.add_handler(CommandHandler("disconnect", counted("bot.disconnect")(self.disconnect_command)))
+            self.application.add_handler(CommandHandler("m", counted("bot.m")(self.message_command)))
             
+            self.application.add_handler(MessageHandler(filters.VOICE | filters.PHOTO, counted("bot.media")(self.media_message)))
             self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))                
             
             await self.application.initialize()
             await self.application.start()
             self._polling_task = asyncio.create_task(self.application.updater.start_polling())
+            # Mensajes para Telegram que encola el servidor web (bot_outbox)
+            self._outbox_task = asyncio.create_task(
+                bot_outbox.run_dispatcher(bot_outbox.deliver_to_telegram, self.application.bot)
+            )
             
             print("✅ Bot de Telegram (Multidispositivo) iniciado correctamente")
+            return True
             
         except Exception as e:
             print(f"❌ Error iniciando bot de Telegram: {e}")
             traceback.print_exc()
+            return False
 
     async def stop_bot(self):
         print("🛑 Iniciando parada del bot de Telegram...")
         try:
-            if hasattr(self, "_polling_task") and self._polling_task and not self._polling_task.done():
-                self._polling_task.cancel()
+            for name in ("_polling_task", "_outbox_task"):
+                task = getattr(self, name, None)
+                if task and not task.done():
+                    task.cancel()
             if self.application:
                 await self.application.stop()
                 await self.application.shutdown()
@@ -0,0 +1,220 @@
+"""
+Funciones de texto puras que se ejecutan en cada mensaje del usuario.
+
+Detección de preguntas, de recuerdos y de intenciones sobre mensajes
+familiares, parseo de fechas en español y recorte de respuestas. No dependen
+de la base de datos ni del LLM, así que se pueden medir por separado
+(benchmarks/bench_text_processing.py).
+"""
+import re
+from datetime import datetime
+
+
+# Dictionary mapping Spanish month names to month numbers for date parsing
+SPANISH_MONTHS = {
+    "enero": 1, "ene": 1,
+    "febrero": 2, "feb": 2,
+    "marzo": 3, "mar": 3,
+    "abril": 4, "abr": 4,
+    "mayo": 5, "may": 5,
+    "junio": 6, "jun": 6,
+    "julio": 7, "jul": 7,
+    "agosto": 8, "ago": 8,
+    "septiembre": 9, "sep": 9, "setiembre": 9, "sept": 9,
+    "octubre": 10, "oct": 10,
+    "noviembre": 11, "nov": 11,
+    "diciembre": 12, "dic": 12
+}
+
+# Regex patterns for memory detection
+memory_patterns = [
+    r'\b(me\s+)?acuerdo\s+(de|que|cuando)\b',  
+    r'\brecuerdo\s+(que|cuando|a|el|la)\b',     
+    r'\bmi\s+(hijo|hija|esposo|esposa|mamá|papá|familia|nieto|nieta)\b',
+    r'\bcuando\s+(era|vivía|trabajaba|estaba)\b',
+    r'\b(extraño|añoro)\s+(a|mucho)\b',
+    r'\b(me\s+gustaba|disfrutaba|me\s+encantaba)\b',
+    r'\ben\s+mi\s+(infancia|juventud)\b',
+    r'\bqué\s+ilusión\b',
+    r'\baquella\s+vez\b',
+    r'\bsiempre\s+(he|me)\b',
+]
+memory_regex = re.compile('|'.join(memory_patterns), re.IGNORECASE)
+
+
+def is_question(text):
+    """Detecta si el mensaje es una pregunta"""
+    text_lower = text.lower().strip()
+    
+    if text_lower.startswith('¿') or text_lower.endswith('?'):
+        return True
+    
+    question_words = [
+        'qué', 'quién', 'cómo', 'cuándo', 'dónde', 'por qué', 'cuál', 
+        'tienes', 'hay', 'sabes', 'conoces', 'puedes', 'podrías'
+    ]
+
+    first_words = text_lower.split()[:2]
+    if any(qw in first_words for qw in question_words):
+        return True
+    
+    return False
+
+
+# Function to detect user intent regarding family messages
+# Identifies whether user wants to read, query, or access old/specific date messages
+def detect_message_intent(user_message):
+    """Detección más inteligente de intenciones sobre mensajes"""
+    lower_msg = user_message.lower()
+    
+    # Keywords that indicate user wants to immediately read messages
+    immediate_read_keywords = [
+        "léeme", "lee", "leer", "dime", "cuéntame", "escucha", 
+        "ponme", "reproduce", "escuchar", "oír", "qué dice",
+        "qué escribió", "contenido", "mensaje", "recibir", "lee el"
+    ]
+    
+    # Keywords that indicate user is querying message availability
+    query_keywords = [
+        "tengo", "hay", "mensajes", "familiares", "familiar",
+        "alguno", "algún", "recibí", "llegó", "tienes"
+    ]
+    
+    # Keywords indicating user wants to access historical/old messages
+    old_messages_keywords = [
+        "antiguos", "antiguo", "leídos", "pasados", "anteriores", 
+        "historial", "todos", "todos los", "todos mis"
+    ]
+    
+    # Keywords indicating a date specification might follow
+    date_keywords = ["del", "de fecha", "de"]
+    
+    # Check for presence of each keyword category
+    has_immediate = any(keyword in lower_msg for keyword in immediate_read_keywords)
+    has_query = any(keyword in lower_msg for keyword in query_keywords)
+    has_old = any(keyword in lower_msg for keyword in old_messages_keywords)
+    has_date = any(keyword in lower_msg for keyword in date_keywords)
+    
+    # Attempt to extract explicit date from message if date-related keywords present
+    explicit_date = parse_spanish_date_fragment(lower_msg) if any(word in lower_msg for word in ["del", "de"]) else None
+    
+    # Return detection results as dictionary
+    return {
+        "is_read_intent": has_immediate,
+        "is_query_intent": has_query,
+        "wants_old_messages": has_old,
+        "has_explicit_date": explicit_date is not None,
+        "explicit_date": explicit_date
+    }
+
+# Simpler general intent detection (used for non-message related requests)
+def detect_intent(user_message):
+    """Detecta la intención del usuario de manera más robusta"""
+    lower_msg = user_message.lower()
+    
+    # Keywords indicating read intent
+    read_keywords = [
+        "léeme", "lee", "leer", "dime", "cuéntame", "escucha", 
+        "qué dice", "qué escribió", "contenido", "mensaje", "recibir",
+        "ponme", "reproduce", "escuchar", "oír"
+    ]
+    
+    # Keywords indicating query intent
+    query_keywords = ["tengo", "hay", "mensajes", "nuevos", "familiares"]
+    
+    # Check for keyword matches
+    is_read_intent = any(keyword in lower_msg for keyword in read_keywords)
+    is_query_intent = any(keyword in lower_msg for keyword in query_keywords)
+    
+    # Return detection results
+    return {
+        "is_read_intent": is_read_intent,
+        "is_query_intent": is_query_intent,
+        "wants_immediate_reading": is_read_intent
+    }
+
+# Robust date parser for Spanish date formats
+# Handles formats like: "20 de octubre", "20 octubre 2025", "5/10", "05-10-2025"
+def parse_spanish_date_fragment(text):
+    """
+    Intenta extraer una fecha en formato dd/mm[/yyyy] desde textos tipo:
+    "20 de octubre", "20 octubre 2025", "el 3 de mayo", "5/10", "05-10-2025".
+    Devuelve 'dd/mm/yyyy' o None si no la encuentra.
+    """
+    text = text.lower().strip()
+
+    # Try to match numeric date formats (dd/mm or dd/mm/yyyy)
+    m = re.search(r'\b(\d{1,2})[\/\-](\d{1,2})(?:[\/\-](\d{2,4}))?\b', text)
+    if m:
+        d = int(m.group(1)); mo = int(m.group(2))
+        y = m.group(3)
+        if y:
+            y = int(y)
+            # Convert 2-digit years to 4-digit years (assume 2000s)
+            if y < 100:  
+                y += 2000
+        else:
+            # Default to current year if not specified
+            y = datetime.now().year
+        try:
+            return f"{d:02d}/{mo:02d}/{int(y)}"
+        except Exception:
+            return None
+
+    # Try to match text-based date formats (e.g., "3 de mayo")
+    m2 = re.search(r'\b(\d{1,2})\s*(?:de\s+)?([a-záéíóúñ]+)(?:\s+(\d{2,4}))?\b', text, flags=re.IGNORECASE)
+    if m2:
+        d = int(m2.group(1))
+        month_word = m2.group(2).lower()
+        y = m2.group(3)
+        # Look up month number from Spanish month dictionary
+        month_num = SPANISH_MONTHS.get(month_word)
+        if month_num:
+            if y:
+                y = int(y)
+                # Convert 2-digit years to 4-digit years
+                if y < 100:
+                    y += 2000
+            else:
+                # Default to current year if not specified
+                y = datetime.now().year
+            try:
+                return f"{d:02d}/{month_num:02d}/{int(y)}"
+            except Exception:
+                return None
+    return None
+
+
+# Keywords that indicate user is asking about family messages
+FAMILY_TOPIC_KEYWORDS = ("mensaje", "familia", "familiar")
+FAMILY_REQUEST_KEYWORDS = (
+    "mensaje", "mensajes", "familiar", "familiares", "familia",
+    "léeme", "lee", "leer", "dime", "cuéntame", "hay", "tienes", "tengo"
+)
+TODAY_KEYWORDS = ("hoy", "día de hoy", "del día", "de hoy")
+
+# Keywords that indicate user is asking about memories/past
+MEMORY_QUESTION_KEYWORDS = ("recuerdo", "recuerdos", "acuerdo", "memoria", "pasado", "cuando", "antes")
+
+
+def analyze_utterance(user_message):
+    """
+    Pre-procesado de un mensaje antes de generar la respuesta.
+    Devuelve las banderas que usa prepare_turn().
+    """
+    lower_msg = user_message.lower()
+    is_about_messages = any(word in lower_msg for word in FAMILY_TOPIC_KEYWORDS)
+    return {
+        "is_family_request": is_about_messages and any(word in lower_msg for word in FAMILY_REQUEST_KEYWORDS),
+        "asking_today": any(word in lower_msg for word in TODAY_KEYWORDS),
+        "saves_memory": bool(memory_regex.search(user_message)) and not is_question(user_message),
+        "is_memory_question": any(keyword in lower_msg for keyword in MEMORY_QUESTION_KEYWORDS),
+    }
+
+
+def limit_sentences(text, max_sentences=2):
+    """Recorta la respuesta a un máximo de frases"""
+    sentences = [s.strip() for s in text.split('.') if s.strip()]
+    if len(sentences) > max_sentences:
+        return '. '.join(sentences[:max_sentences]) + '.'
+    return text
@@ -0,0 +1,161 @@
+"""
+Cola de turnos por dispositivo para el bucle de /ws.
+
+El reconocimiento de voz del navegador envía a veces varios fragmentos finales
+seguidos. En lugar de procesar cada fragmento como un turno completo, la cola
+espera una breve ventana de silencio y los une en un solo turno. Si el usuario
+sigue hablando mientras se genera la respuesta, la generación en curso se
+cancela y su texto se vuelve a unir con los fragmentos nuevos.
+
+Cada turno tiene dos fases:
+- prepare(text): recuperación de recuerdos y llamada al LLM. Se puede cancelar.
+- commit(result, message_ids): escrituras en DB y envíos al cliente. Nunca se cancela.
+
+Los ids de mensaje del cliente viajan con sus fragmentos; los de fragmentos que
+nunca llegan a guardarse se entregan a on_discard para que un reintento los procese.
+"""
+import os
+import time
+import asyncio
+
+from .metrics import metrics
+from .db_instrumentation import QueryStats, track, record
+
+
+# Ventana de silencio (segundos) para unir fragmentos en un turno
+TURN_COALESCE_SECONDS = float(os.getenv("TURN_COALESCE_SECONDS", "0.8"))
+
+# Máximo de fragmentos pendientes por dispositivo antes de rechazar más
+TURN_QUEUE_MAX_DEPTH = int(os.getenv("TURN_QUEUE_MAX_DEPTH", "8"))
+
+# Longitud máxima de un turno unido (caracteres)
+TURN_MAX_CHARS = int(os.getenv("TURN_MAX_CHARS", "2000"))
+
+
+class TurnQueue:
+    """Agrupa fragmentos de un dispositivo y los procesa de uno en uno"""
+
+    def __init__(self, prepare, commit, on_discard=None, debounce=TURN_COALESCE_SECONDS, max_depth=TURN_QUEUE_MAX_DEPTH):
+        self._prepare = prepare
+        self._commit = commit
+        self._on_discard = on_discard
+        self.debounce = debounce
+        self.max_depth = max_depth
+        self._fragments = []
+        self._arrived = asyncio.Event()
+        self._preparing = None
+        self._preparing_ids = []
+        self._superseded = False
+        # Consultas SQL del turno en curso (prepare + commit, incluidos los intentos reemplazados)
+        self._queries = None
+        self._worker = asyncio.create_task(self._run())
+        self.stats = {"fragments": 0, "turns": 0, "superseded": 0, "rejected": 0}
+
+    @property
+    def depth(self):
+        return len(self._fragments)
+
+    def put(self, text, message_id=None):
+        """
+        Encola un fragmento. Devuelve False si se rechaza por backpressure.
+        Si hay una generación en curso, se cancela para unirla con este fragmento.
+        """
+        pending_chars = sum(len(f[0]) for f in self._fragments)
+        if len(self._fragments) >= self.max_depth or pending_chars + len(text) > TURN_MAX_CHARS:
+            self.stats["rejected"] += 1
+            metrics.inc("turn.rejected")
+            return False
+
+        self._fragments.append((text, [message_id] if message_id else []))
+        self.stats["fragments"] += 1
+
+        if self._preparing is not None and not self._preparing.done():
+            self._superseded = True
+            self._preparing.cancel()
+
+        self._arrived.set()
+        return True
+
+    async def _wait_for_silence(self):
+        """Espera hasta que no lleguen fragmentos durante la ventana de debounce"""
+        while True:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout=self.debounce)
+            except asyncio.TimeoutError:
+                return
+
+    async def _run(self):
+        while True:
+            await self._arrived.wait()
+            await self._wait_for_silence()
+            if not self._fragments:
+                continue
+
+            text = " ".join(f[0] for f in self._fragments)
+            message_ids = [mid for f in self._fragments for mid in f[1]]
+            self._fragments.clear()
+
+            self._superseded = False
+            self._preparing_ids = message_ids
+            if self._queries is None:
+                self._queries = QueryStats("ws.turn")
+            with track(self._queries):
+                self._preparing = asyncio.create_task(self._prepare(text))
+            started = time.perf_counter()
+            try:
+                result = await self._preparing
+                metrics.observe("turn.prepare", time.perf_counter() - started)
+            except asyncio.CancelledError:
+                if not self._superseded:
+                    # Cancelación real (cierre de la cola)
+                    raise
+                # El usuario siguió hablando: se une con lo nuevo y se reintenta
+                print(f"⏭️ Turno reemplazado por nuevos fragmentos: '{text[:50]}'")
+                self.stats["superseded"] += 1
+                metrics.inc("turn.superseded")
+                self._fragments.insert(0, (text, message_ids))
+                self._arrived.set()
+                continue
+            except Exception as e:
+                print(f"❌ Error preparando turno: {e}")
+                self._discard(message_ids)
+                self._queries = None
+                continue
+            finally:
+                self._preparing = None
+                self._preparing_ids = []
+
+            try:
+                # La fase de escritura no se cancela aunque lleguen fragmentos
+                started = time.perf_counter()
+                with track(self._queries):
+                    commit = asyncio.shield(self._commit(result, message_ids))
+                await commit
+                metrics.observe("turn.commit", time.perf_counter() - started)
+                self.stats["turns"] += 1
+                metrics.inc("turn.completed")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Error guardando turno: {e}")
+            finally:
+                record(self._queries)
+                self._queries = None
+
+    def _discard(self, message_ids):
+        if self._on_discard and message_ids:
+            self._on_discard(message_ids)
+
+    async def close(self):
+        """Detiene el worker y cancela la generación en curso"""
+        if self._preparing is not None and not self._preparing.done():
+            self._preparing.cancel()
+            self._discard(self._preparing_ids)
+        self._discard([mid for f in self._fragments for mid in f[1]])
+        self._fragments.clear()
+        self._worker.cancel()
+        try:
+            await self._worker
+        except (asyncio.CancelledError, Exception):
+            pass
@@ -0,0 +1,121 @@
+"""
+Unidad de trabajo de un turno de /ws.
+
+Antes cada turno abría varias sesiones (recuerdo nuevo, last_recalled, guardar
+la conversación, recargar historial y memoria), cada una con su BEGIN/COMMIT y
+volviendo a leer la fila de DeviceData. Ahora commit_turn acumula los cambios
+del turno y los escribe en una sola transacción:
+
+- lee DeviceData una vez (FOR UPDATE en PostgreSQL, para no pisar el historial
+  si el mismo dispositivo tiene dos conexiones),
+- inserta el recuerdo nuevo dentro de un SAVEPOINT: si falla, se deshace solo
+  el recuerdo y la conversación se guarda igualmente,
+- actualiza last_recalled de los recuerdos usados con un único UPDATE,
+- añade la entrada al historial y hace un solo COMMIT.
+
+Después del commit, user_memory y conversation_history quedan en el objeto
+para el data_update, sin volver a consultar la base de datos.
+"""
+from datetime import datetime
+
+from sqlalchemy import select, update
+
+from .database import async_session, DeviceData, Memory
+from .memory_index import memory_index
+
+
+# Entradas de conversación que se guardan por dispositivo
+CONVERSATION_HISTORY_LIMIT = 1000
+
+
+def default_user_memory():
+    return {
+        "user_preferences": {},
+        "important_memories": [],
+        "family_members": [],
+        "daily_routine": {},
+        "emotional_state": "calm"
+    }
+
+
+class TurnUnitOfWork:
+    """Acumula las escrituras de un turno y las confirma en una transacción"""
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self._new_memory = None
+        self._recalled_ids = []
+        self._conversation_entry = None
+        # Resultados tras commit()
+        self.saved_memory = None
+        self.memory_error = None
+        self.user_memory = None
+        self.conversation_history = None
+
+    def add_memory(self, content, category="personal"):
+        self._new_memory = (content, category)
+
+    def mark_recalled(self, memory_ids):
+        self._recalled_ids.extend(memory_ids)
+
+    def append_conversation(self, user_message, assistant_response):
+        self._conversation_entry = {
+            "timestamp": datetime.now().isoformat(),
+            "user": user_message,
+            "assistant": assistant_response
+        }
+
+    async def commit(self):
+        async with async_session() as session:
+            stmt = select(DeviceData).where(DeviceData.device_id == self.device_id).with_for_update()
+            device_data = (await session.execute(stmt)).scalar_one_or_none()
+            if not device_data:
+                device_data = DeviceData(device_id=self.device_id, conversation_history=[])
+                session.add(device_data)
+            if not device_data.user_memory:
+                device_data.user_memory = default_user_memory()
+
+            new_memory = None
+            if self._new_memory:
+                content, category = self._new_memory
+                try:
+                    # El fallo del recuerdo no debe perder la conversación
+                    async with session.begin_nested():
+                        new_memory = Memory(device_id=self.device_id, content=content, category=category)
+                        session.add(new_memory)
+                except Exception as e:
+                    print(f"❌ Error guardando recuerdo en el turno: {e}")
+                    self.memory_error = e
+                    new_memory = None
+
+            if self._recalled_ids:
+                await session.execute(
+                    update(Memory)
+                    .where(Memory.device_id == self.device_id, Memory.id.in_(self._recalled_ids))
+                    .values(last_recalled=datetime.now())
+                )
+
+            if self._conversation_entry:
+                # Lista nueva: la columna JSON solo detecta cambios por asignación
+                history = device_data.conversation_history if isinstance(device_data.conversation_history, list) else []
+                device_data.conversation_history = (history + [self._conversation_entry])[-CONVERSATION_HISTORY_LIMIT:]
+
+            await session.commit()
+
+            self.user_memory = device_data.user_memory
+            self.conversation_history = device_data.conversation_history
+
+        if new_memory is not None:
+            self.saved_memory = {
+                "id": new_memory.id,
+                "content": new_memory.content,
+                "category": new_memory.category,
+                "timestamp": new_memory.timestamp.isoformat(),
+                "last_recalled": None
+            }
+            # Append incremental al índice semántico del dispositivo
+            try:
+                memory_index.add_memory(self.device_id, new_memory.id, new_memory.content)
+            except Exception as e:
+                print(f"⚠️ No se pudo indexar el recuerdo {new_memory.id}: {e}")
+        return self
@@ -0,0 +1,143 @@
+"""
+Contadores de uso por dispositivo y día (rollups) para cuidadores y operadores.
+
+Responder "cuántos turnos, recuerdos guardados y mensajes familiares leídos
+por dispositivo y día" a partir de conversation_history (JSON) y
+family_messages obligaría a recorrer ambas tablas. En su lugar, el turno de
+/ws, los endpoints y el bot llaman a usage_rollups.record(), que solo suma en
+memoria; la tarea local usage_rollups del planificador (scheduler.py) vuelca
+el búfer de cada proceso cada ROLLUP_FLUSH_SECONDS (o al llenarse) con un
+único INSERT ... ON CONFLICT DO UPDATE de varias filas que incrementa los
+contadores de usage_daily.
+
+Cada volcado suma también en la fila ALL_DEVICES (device_id "*"), así los
+totales de operador se leen igual que los de un dispositivo: las consultas de
+daily_usage leen una fila por día (O(días)) por la clave primaria.
+
+Los incrementos son sumas, así que varios procesos (réplicas web, bot worker)
+pueden volcar a la vez. Al cerrar, el lifespan y el bot worker hacen un
+último volcado; si un proceso muere se pierden como mucho los contadores del
+último intervalo.
+"""
+import os
+import importlib
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from .database import async_session, read_session, UsageDaily
+from .metrics import metrics
+from .scheduler import scheduler
+
+
+# Contadores de usage_daily
+USAGE_METRICS = ("turns", "memories_saved", "family_messages_received", "family_messages_read")
+
+# Fila con los totales de todos los dispositivos
+ALL_DEVICES = "*"
+
+# Tarea del planificador que vuelca el búfer
+ROLLUP_JOB = "usage_rollups"
+
+# Segundos entre volcados del búfer
+ROLLUP_FLUSH_SECONDS = float(os.getenv("ROLLUP_FLUSH_SECONDS", "10"))
+
+# Claves (dispositivo, día) en el búfer que fuerzan un volcado inmediato
+ROLLUP_MAX_PENDING = int(os.getenv("ROLLUP_MAX_PENDING", "1000"))
+
+# Backends con INSERT ... ON CONFLICT DO UPDATE
+UPSERT_DIALECTS = ("postgresql", "sqlite")
+
+# Días como máximo por consulta de los endpoints
+USAGE_MAX_DAYS = 366
+
+
+class UsageRollups:
+    def __init__(self):
+        self._pending = defaultdict(Counter)
+
+    def record(self, device_id, metric, amount=1, day=None):
+        """Suma en memoria; se escribe en el siguiente volcado"""
+        if metric not in USAGE_METRICS:
+            raise ValueError(f"Métrica de uso desconocida: {metric}")
+        if not device_id or not amount:
+            return
+        day = day or datetime.utcnow().date()
+        self._pending[(device_id, day)][metric] += amount
+        self._pending[(ALL_DEVICES, day)][metric] += amount
+        if len(self._pending) >= ROLLUP_MAX_PENDING:
+            scheduler.trigger(ROLLUP_JOB)
+
+    async def flush(self):
+        """Vuelca el búfer en usage_daily; devuelve cuántas filas tocó"""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, defaultdict(Counter)
+        rows = [
+            {"device_id": device_id, "day": day, **{m: counts.get(m, 0) for m in USAGE_METRICS}}
+            for (device_id, day), counts in pending.items()
+        ]
+        try:
+            async with async_session() as session:
+                dialect = session.bind.dialect.name
+                if dialect in UPSERT_DIALECTS:
+                    await self._upsert(session, dialect, rows)
+                else:
+                    await self._merge(session, rows)
+                await session.commit()
+        except Exception:
+            # Se devuelven al búfer para el siguiente intento
+            for row in rows:
+                self._pending[(row["device_id"], row["day"])].update({m: row[m] for m in USAGE_METRICS})
+            metrics.inc("rollups.flush_errors")
+            raise
+        metrics.inc("rollups.rows_flushed", len(rows))
+        return len(rows)
+
+    async def _upsert(self, session, dialect, rows):
+        # El módulo del dialecto se importa aquí para no cargarlo al arrancar
+        insert = importlib.import_module(f"sqlalchemy.dialects.{dialect}").insert
+        table = UsageDaily.__table__
+        stmt = insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[table.c.device_id, table.c.day],
+            set_={m: table.c[m] + stmt.excluded[m] for m in USAGE_METRICS},
+        )
+        await session.execute(stmt)
+
+    async def _merge(self, session, rows):
+        for row in rows:
+            current = await session.get(UsageDaily, (row["device_id"], row["day"]), with_for_update=True)
+            if current is None:
+                session.add(UsageDaily(**row))
+            else:
+                for m in USAGE_METRICS:
+                    setattr(current, m, getattr(current, m) + row[m])
+
+usage_rollups = UsageRollups()
+
+# Volcado periódico en todas las réplicas: cada proceso tiene su propio búfer
+scheduler.add_job(ROLLUP_JOB, usage_rollups.flush, every=ROLLUP_FLUSH_SECONDS, local=True)
+
+
+async def daily_usage(device_id, start, end):
+    """Contadores de un dispositivo (o ALL_DEVICES) por día entre start y end, con ceros en los días sin uso"""
+    async with read_session() as session:
+        stmt = (
+            select(UsageDaily)
+            .where(UsageDaily.device_id == device_id, UsageDaily.day >= start, UsageDaily.day <= end)
+            .order_by(UsageDaily.day)
+        )
+        found = {row.day: row for row in (await session.execute(stmt)).scalars()}
+
+    days = []
+    totals = Counter()
+    day = start
+    while day <= end:
+        row = found.get(day)
+        counts = {m: (getattr(row, m) if row else 0) for m in USAGE_METRICS}
+        totals.update(counts)
+        days.append({"day": day.isoformat(), **counts})
+        day += timedelta(days=1)
+    return {"device_id": device_id, "days": days, "totals": {m: totals[m] for m in USAGE_METRICS}}
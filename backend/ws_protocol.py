@@ -0,0 +1,272 @@
+"""
+Protocolo de mensajes de /ws: esquema tipado y codecs negociables.
+
+Todos los frames son objetos con un campo "type". Los tipos conocidos están
+descritos abajo como TypedDict y se validan al recibirlos. La codificación se
+negocia al conectar, por subprotocolo (Sec-WebSocket-Protocol) o con el
+parámetro ?codec= de la URL:
+
+- compa.json     JSON en frames de texto (orjson si está instalado). Por defecto.
+- compa.msgpack  MessagePack en frames binarios (requiere msgpack).
+
+La compresión permessage-deflate la negocia el servidor ASGI (uvicorn con la
+implementación "websockets", ver el arranque al final de main.py).
+"""
+import os
+import json
+from typing import Any, Dict, List, Literal, Optional, TypedDict, Union
+
+from starlette.websockets import WebSocketDisconnect
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dependencia opcional
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - dependencia opcional
+    msgpack = None
+
+
+# Codec usado cuando el cliente no pide ninguno
+WS_DEFAULT_CODEC = os.getenv("WS_DEFAULT_CODEC", "json")
+
+
+# ============================================
+# ESQUEMA - Cliente -> servidor
+# ============================================
+
+class InitialDataFrame(TypedDict):
+    type: Literal["initial_data"]
+    data: Dict[str, Any]  # device_id, device_code, locale, user_memory...
+
+
+class KeepaliveFrame(TypedDict, total=False):
+    type: Literal["keepalive"]
+    ts: float
+
+
+class UtteranceFrame(TypedDict, total=False):
+    type: Literal["utterance"]
+    id: str
+    text: str
+
+
+class ConnectionResponseFrame(TypedDict, total=False):
+    type: Literal["connection_response"]
+    request_id: str
+    approved: bool
+
+
+# ============================================
+# ESQUEMA - Servidor -> cliente
+# ============================================
+
+class DeviceInfoFrame(TypedDict):
+    type: Literal["device_info"]
+    device_id: str
+    device_code: str
+    connected_chat: Optional[int]
+
+
+class MessageFrame(TypedDict, total=False):
+    type: Literal["message"]
+    text: str
+    reply_to: List[str]
+
+
+class DataUpdateFrame(TypedDict):
+    type: Literal["data_update"]
+    user_memory: Dict[str, Any]
+    conversation_history: List[Dict[str, Any]]
+
+
+class MemorySavedFrame(TypedDict):
+    type: Literal["memory_saved"]
+    text: str
+    memory_id: int
+
+
+class PingFrame(TypedDict):
+    type: Literal["ping", "pong"]
+    ts: float
+
+
+class BusyFrame(TypedDict, total=False):
+    type: Literal["busy"]
+    text: str
+    reply_to: List[str]
+
+
+class ErrorFrame(TypedDict):
+    type: Literal["error"]
+    text: str
+
+
+class ConnectionRequestFrame(TypedDict):
+    type: Literal["connection_request"]
+    request_id: str
+    user_info: Dict[str, Any]
+
+
+class ConnectionApprovedFrame(TypedDict):
+    type: Literal["connection_approved"]
+    user_name: str
+    chat_id: int
+
+
+class NewMessageNotificationFrame(TypedDict):
+    type: Literal["new_message_notification"]
+
+
+ClientFrame = Union[InitialDataFrame, KeepaliveFrame, UtteranceFrame, ConnectionResponseFrame]
+
+ServerFrame = Union[
+    DeviceInfoFrame, MessageFrame, DataUpdateFrame, MemorySavedFrame, PingFrame,
+    BusyFrame, ErrorFrame, ConnectionRequestFrame, ConnectionApprovedFrame,
+    NewMessageNotificationFrame,
+]
+
+# Campos obligatorios de cada frame que envía el cliente
+CLIENT_FRAME_FIELDS = {
+    "initial_data": {"data": dict},
+    "keepalive": {},
+    "utterance": {"text": str},
+    "connection_response": {"request_id": str},
+}
+
+
+class ProtocolError(ValueError):
+    """Frame de cliente que no cumple el esquema"""
+
+
+def validate_client_frame(frame):
+    """Comprueba el tipo y los campos obligatorios de un frame del cliente"""
+    if not isinstance(frame, dict):
+        raise ProtocolError("el frame no es un objeto")
+    frame_type = frame.get("type")
+    fields = CLIENT_FRAME_FIELDS.get(frame_type)
+    if fields is None:
+        raise ProtocolError(f"tipo de frame desconocido: {frame_type!r}")
+    for name, expected in fields.items():
+        if not isinstance(frame.get(name), expected):
+            raise ProtocolError(f"campo '{name}' inválido en frame {frame_type}")
+    return frame
+
+
+# ============================================
+# CODECS
+# ============================================
+
+class JsonCodec:
+    """JSON en frames de texto; usa orjson si está disponible"""
+    name = "json"
+    subprotocol = "compa.json"
+    binary = False
+
+    if orjson is not None:
+        @staticmethod
+        def encode(frame):
+            return orjson.dumps(frame, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+        @staticmethod
+        def decode(data):
+            return orjson.loads(data)
+    else:
+        @staticmethod
+        def encode(frame):
+            return json.dumps(frame, ensure_ascii=False, separators=(",", ":"))
+
+        @staticmethod
+        def decode(data):
+            return json.loads(data)
+
+
+class MsgpackCodec:
+    """MessagePack en frames binarios"""
+    name = "msgpack"
+    subprotocol = "compa.msgpack"
+    binary = True
+
+    @staticmethod
+    def encode(frame):
+        return msgpack.packb(frame, use_bin_type=True, datetime=False, default=str)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS = {JsonCodec.name: JsonCodec}
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec
+
+SUBPROTOCOLS = {codec.subprotocol: codec for codec in CODECS.values()}
+
+
+def negotiate_codec(websocket):
+    """
+    Elige el codec de la conexión antes de aceptarla.
+    Devuelve (codec, subprotocolo a confirmar o None).
+    """
+    for requested in websocket.scope.get("subprotocols") or []:
+        codec = SUBPROTOCOLS.get(requested)
+        if codec is not None:
+            return codec, requested
+    codec = CODECS.get(websocket.query_params.get("codec", ""))
+    if codec is not None:
+        return codec, None
+    return CODECS.get(WS_DEFAULT_CODEC, JsonCodec), None
+
+
+async def accept(websocket):
+    """Negocia el codec, acepta la conexión y lo guarda en websocket.state"""
+    codec, subprotocol = negotiate_codec(websocket)
+    websocket.state.codec = codec
+    await websocket.accept(subprotocol=subprotocol)
+    return codec
+
+
+def get_codec(websocket):
+    return getattr(websocket.state, "codec", None) or JsonCodec
+
+
+async def send_frame(websocket, frame):
+    """Codifica y envía un frame con el codec negociado de la conexión"""
+    codec = get_codec(websocket)
+    data = codec.encode(frame)
+    if codec.binary:
+        await websocket.send_bytes(data)
+    else:
+        await websocket.send_text(data)
+
+
+async def receive_frame(websocket):
+    """
+    Recibe y decodifica el siguiente frame.
+    El texto que no es JSON se trata como un mensaje de voz sin id
+    (clientes antiguos). Lanza ProtocolError si el frame no cumple el esquema.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+
+    data = message.get("bytes")
+    if data is not None:
+        try:
+            frame = MsgpackCodec.decode(data) if msgpack is not None else JsonCodec.decode(data)
+        except Exception as e:
+            raise ProtocolError(f"frame binario ilegible: {e}")
+        return validate_client_frame(frame)
+
+    text = (message.get("text") or "").strip()
+    if not text:
+        return None
+    if text[0] != "{":
+        return {"type": "utterance", "text": text}
+    try:
+        frame = JsonCodec.decode(text)
+    except ValueError:
+        return {"type": "utterance", "text": text}
+    return validate_client_frame(frame)
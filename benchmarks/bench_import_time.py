@@ -0,0 +1,99 @@
+"""
+Presupuesto de tiempo de importación de backend.main (arranque en frío).
+
+Ejecuta `python -X importtime -c "import backend.main"` varias veces en
+procesos nuevos y usa el mejor resultado. Informa del tiempo total y de los
+módulos más pesados, y falla (código 1) si:
+- el tiempo supera el presupuesto (--budget-ms), o
+- se importa al arrancar alguna integración que debe cargarse de forma perezosa
+  (Gemini, googlesearch, Twilio, python-telegram-bot, asyncpg).
+
+Uso:
+    python -m benchmarks.bench_import_time [--runs 5] [--budget-ms 900] [--top 15]
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Módulos que no deben cargarse al importar backend.main
+LAZY_MODULES = ["google.generativeai", "googlesearch", "twilio", "telegram", "asyncpg"]
+
+IMPORT_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def run_importtime(module):
+    """Devuelve [(módulo, self_us, cumulative_us, profundidad)] de un proceso nuevo"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = PROJECT_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    # Sin credenciales: la importación no debe depender de ellas
+    for key in ("GEMINI_TOKEN", "TELEGRAM_BOT_TOKEN", "DATABASE_URL"):
+        env.pop(key, None)
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PROJECT_ROOT, env=env, capture_output=True, text=True,
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"la importación de {module} falló:\n{process.stderr[-2000:]}")
+    rows = []
+    for line in process.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Presupuesto de importación de backend.main")
+    parser.add_argument("--module", default="backend.main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=900.0)
+    parser.add_argument("--top", type=int, default=15, help="módulos más pesados a mostrar")
+    args = parser.parse_args(argv)
+
+    totals = []
+    best_rows = None
+    for _ in range(args.runs):
+        rows = run_importtime(args.module)
+        total = next(cumulative for name, _, cumulative, _ in rows if name == args.module)
+        if not totals or total < min(totals):
+            best_rows = rows
+        totals.append(total)
+
+    best_ms = min(totals) / 1000
+    print(f"⏱️ import {args.module}: mejor {best_ms:.1f} ms, mediana {statistics.median(totals) / 1000:.1f} ms"
+          f" ({args.runs} ejecuciones, presupuesto {args.budget_ms:.0f} ms)")
+
+    # Paquetes de primer nivel importados por primera vez, ordenados por coste acumulado
+    top_level = {}
+    for name, _, cumulative, depth in best_rows:
+        root = name.split(".")[0]
+        if name == root and name != args.module:
+            top_level[root] = max(top_level.get(root, 0), cumulative)
+    print(f"\n{'módulo':<32} {'acumulado ms':>13}")
+    for name, cumulative in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<32} {cumulative / 1000:>13.1f}")
+
+    imported = {name for name, _, _, _ in best_rows}
+    eager = [m for m in LAZY_MODULES if m in imported]
+
+    failed = False
+    if eager:
+        print(f"\n❌ Integraciones importadas al arrancar (deben ser perezosas): {', '.join(eager)}")
+        failed = True
+    if best_ms > args.budget_ms:
+        print(f"\n❌ La importación supera el presupuesto: {best_ms:.1f} ms > {args.budget_ms:.0f} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("\n✅ Dentro del presupuesto")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+Presupuesto de consultas SQL por turno de /ws, endpoint HTTP y comando del bot.
+
+Crea una base de datos SQLite temporal con las migraciones, siembra un
+dispositivo con recuerdos, mensajes familiares y un chat conectado, y ejecuta:
+- turnos de /ws reales (TurnQueue + prepare_turn/commit_turn, LLM simulado):
+  una frase normal, una pregunta por recuerdos y un recuerdo nuevo,
+- GET /family/messages, GET /memory/cofre, POST /family/messages/<id>/read, los
+  endpoints /admin y los de /usage a través de la app ASGI,
+- los comandos /connect, /alias, /m (a uno, a varios y a todos), /disconnect y /login del bot.
+
+Cada ámbito se cuenta con backend/db_instrumentation.py y se compara con
+QUERY_BUDGETS; falla (código 1) si alguno se pasa del presupuesto. Con
+--explain pide el plan de cada SELECT y falla también si alguno recorre una
+tabla entera (Seq Scan / SCAN sin índice).
+
+Uso:
+    python -m benchmarks.bench_query_budget [--explain] [--memories 300] [--messages 200] [--verbose]
+    python -m benchmarks.bench_query_budget --database-url postgresql://...   # base de datos desechable
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+
+DEVICE_ID = "device_424242"
+DEVICE_CODE = "424242"
+CHAT_ID = 777000
+ALIAS = "Mama"
+
+TURN_UTTERANCES = [
+    ("ws.turn (frase normal)", "Esta mañana he paseado por el parque con mi vecina"),
+    ("ws.turn (pregunta por recuerdos)", "¿Te acuerdas de mis recuerdos de Sevilla?"),
+    ("ws.turn (recuerdo nuevo)", "Recuerdo que mi boda fue en la iglesia de San Lorenzo"),
+]
+
+SAMPLE_MEMORIES = [
+    "Mi marido se llamaba Antonio y le gustaba mucho bailar",
+    "Vivíamos en Sevilla, cerca del río",
+    "Mi hija Lucía nació un martes de primavera",
+    "Los domingos hacíamos paella para toda la familia",
+]
+
+
+class FakeWebSocket:
+    """Recoge los frames que envía commit_turn"""
+
+    def __init__(self):
+        self.state = SimpleNamespace()
+        self.sent = 0
+
+    async def send_text(self, data):
+        self.sent += 1
+
+    async def send_bytes(self, data):
+        self.sent += 1
+
+
+class FakeMessage:
+    async def reply_text(self, text, **kwargs):
+        return None
+
+
+def fake_update(chat_id=CHAT_ID, name="Lucía"):
+    user = SimpleNamespace(first_name=name, name=f"@{name.lower()}", full_name=f"{name} García")
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id), effective_user=user, message=FakeMessage())
+
+
+def fake_context(*args):
+    return SimpleNamespace(args=list(args))
+
+
+async def seed(memories, messages):
+    from backend.database import async_session, DeviceData, Memory, FamilyMessages, UserConnections, UsageDaily
+
+    start = datetime.utcnow() - timedelta(days=365)
+    async with async_session() as session:
+        session.add(DeviceData(device_id=DEVICE_ID, device_code=DEVICE_CODE, user_memory={}, conversation_history=[]))
+        # Otros dispositivos para que las tablas no sean de un solo dueño
+        for i in range(20):
+            session.add(DeviceData(device_id=f"device_{100000 + i}", device_code=str(100000 + i), user_memory={}, conversation_history=[]))
+        await session.flush()
+        for i in range(memories):
+            session.add(Memory(
+                device_id=DEVICE_ID if i % 2 == 0 else f"device_{100000 + i % 20}",
+                content=SAMPLE_MEMORIES[i % len(SAMPLE_MEMORIES)],
+                timestamp=start + timedelta(hours=i),
+            ))
+        for i in range(messages):
+            session.add(FamilyMessages(
+                device_id=DEVICE_ID if i % 2 == 0 else f"device_{100000 + i % 20}",
+                telegram_chat_id=CHAT_ID if i % 4 else CHAT_ID + 3,
+                sender_name="Lucía",
+                message="¡Hola mamá! Mañana vamos a verte con los niños.",
+                timestamp=start + timedelta(hours=3 * i),
+                read=i % 3 == 0,
+            ))
+        session.add(UserConnections(telegram_chat_id=CHAT_ID, device_id=DEVICE_ID, alias=ALIAS))
+        # Segundo dispositivo del mismo chat para /m a varios
+        session.add(UserConnections(telegram_chat_id=CHAT_ID, device_id="device_100000", alias="Abuelo"))
+        # Un año de contadores diarios por dispositivo y de los totales ("*")
+        for device_id in [DEVICE_ID, "*"] + [f"device_{100000 + i}" for i in range(20)]:
+            for day in range(365):
+                session.add(UsageDaily(device_id=device_id, day=(start + timedelta(days=day)).date(), turns=day % 7))
+        await session.commit()
+
+
+async def run_turns(main):
+    """Turnos de /ws por el mismo camino que el endpoint (TurnQueue con debounce 0)"""
+    import functools
+    from backend.turn_queue import TurnQueue
+    from backend.db_instrumentation import LAST_SCOPES
+    from backend.metrics import metrics
+
+    websocket = FakeWebSocket()
+    memory_manager = main.MemoryManager(DEVICE_ID)
+    turn_queue = TurnQueue(
+        functools.partial(main.prepare_turn, memory_manager),
+        functools.partial(main.commit_turn, websocket, memory_manager),
+        debounce=0.0,
+    )
+    results = []
+    try:
+        for label, utterance in TURN_UTTERANCES:
+            done = metrics.counters["db.ws.turn.scopes"] + 1
+            turn_queue.put(utterance)
+            while metrics.counters["db.ws.turn.scopes"] < done:
+                await asyncio.sleep(0.01)
+            results.append((label, LAST_SCOPES["ws.turn"]))
+    finally:
+        await turn_queue.close()
+    return results
+
+
+async def run_http(main):
+    import httpx
+    from backend.db_instrumentation import LAST_SCOPES
+
+    # /family/messages solo comprueba que el bot exista
+    main.telegram_bot = main.telegram_bot or SimpleNamespace()
+    results = []
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for path, scope in [
+            ("/family/messages", "http.get_family_messages"),
+            ("/memory/cofre", "http.get_memory_cofre"),
+        ]:
+            response = await client.get(path, params={"device_id": DEVICE_ID})
+            response.raise_for_status()
+            results.append((f"GET {path}", LAST_SCOPES[scope]))
+
+        # Listados de /admin: primera página (con total) y la siguiente por cursor
+        for path, scope in [
+            ("/admin/authorized-users", "http.get_authorized_users"),
+            ("/admin/pending-requests", "http.get_pending_requests"),
+        ]:
+            response = await client.get(path, params={"limit": 1})
+            response.raise_for_status()
+            results.append((f"GET {path}", LAST_SCOPES[scope]))
+            response = await client.get(path, params={"limit": 1, "after": response.json()["next_after"] or 0})
+            response.raise_for_status()
+            results.append((f"GET {path} (after)", LAST_SCOPES[scope]))
+
+        response = await client.post("/family/messages/1/read")
+        response.raise_for_status()
+        results.append(("POST /family/messages/<id>/read", LAST_SCOPES["http.mark_message_read"]))
+
+        # Paneles de uso: 30 días de un dispositivo y un trimestre de los totales
+        today = datetime.utcnow().date()
+        for path, scope, params in [
+            ("/usage/daily", "http.get_usage_daily", {"device_id": DEVICE_ID}),
+            ("/usage/summary", "http.get_usage_summary", {"start": (today - timedelta(days=90)).isoformat()}),
+        ]:
+            response = await client.get(path, params=params)
+            response.raise_for_status()
+            results.append((f"GET {path}", LAST_SCOPES[scope]))
+
+        for path, scope, body in [
+            ("/admin/authorize-user", "http.authorize_user", {"chat_id": CHAT_ID + 2, "device_id": DEVICE_ID}),
+            ("/admin/revoke-user", "http.revoke_user", {"chat_id": CHAT_ID + 2}),
+        ]:
+            response = await client.post(path, json=body)
+            response.raise_for_status()
+            results.append((f"POST {path}", LAST_SCOPES[scope]))
+    return results
+
+
+async def run_bot_commands(main):
+    from backend import telegram_bot
+    from backend.db_instrumentation import counted, LAST_SCOPES
+
+    bot = telegram_bot.FamilyMessagesBot(token=None)
+    other_chat = CHAT_ID + 1
+    commands = [
+        ("/connect", "bot.connect", bot.connect_command, fake_update(other_chat), fake_context(DEVICE_CODE)),
+        ("/alias", "bot.alias", bot.alias_command, fake_update(), fake_context(DEVICE_CODE, "Abuela")),
+        ("/m", "bot.m", bot.message_command, fake_update(), fake_context("Abuela", "¿Has", "comido?")),
+        ("/m a varios", "bot.m", bot.message_command, fake_update(), fake_context("Abuela,Abuelo", "¡Feliz", "domingo!")),
+        ("/m todos", "bot.m", bot.message_command, fake_update(), fake_context("todos", "Buenas", "noches")),
+        ("/disconnect", "bot.disconnect", bot.disconnect_command, fake_update(), fake_context("Abuela")),
+        ("/login", "bot.login", bot.login_command, fake_update(), fake_context()),
+    ]
+    results = []
+    for label, scope, handler, update, context in commands:
+        # Mismo envoltorio que en FamilyMessagesBot.start_bot
+        await counted(scope)(handler)(update, context)
+        results.append((label, LAST_SCOPES[scope]))
+    return results
+
+
+def print_results(results):
+    print(f"\n{'ámbito':<42} {'sentencias':>10} {'viajes':>7} {'conex.':>7} {'presup.':>8}")
+    failed = []
+    for label, stats in results:
+        budget = stats.budget if stats.budget is not None else "-"
+        mark = "❌" if stats.over_budget() else "✅"
+        print(f"{mark} {label:<40} {stats.statements:>10} {stats.round_trips:>7} {stats.connections:>7} {budget:>8}")
+        if stats.over_budget():
+            failed.append(label)
+    return failed
+
+
+async def print_plans(engine, results):
+    from backend.db_instrumentation import explain
+
+    seq_scans = []
+    analyzed = 0
+    for label, stats in results:
+        for statement, plan, sequential in await explain(engine, stats):
+            analyzed += 1
+            if sequential:
+                seq_scans.append(label)
+                print(f"\n❌ Recorrido secuencial en {label}:")
+                print("   " + " ".join(statement.split())[:200])
+                for line in plan:
+                    print(f"      {line}")
+    print(f"\n🔎 {analyzed} SELECT analizados con EXPLAIN")
+    return seq_scans
+
+
+async def run(args):
+    from backend import db_instrumentation, migrations
+    from backend.database import get_engine
+    from benchmarks.ws_loadtest import FakeGemini
+
+    db_instrumentation.DB_EXPLAIN = args.explain
+    await migrations.upgrade()
+    await seed(args.memories, args.messages)
+
+    from backend import main
+    main.GEMINI_CLIENT = FakeGemini(0.0, 0.0)
+
+    results = []
+    try:
+        # Los logs de la app ocultan la tabla; --verbose los muestra
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w")):
+            results += await run_turns(main)
+            results += await run_http(main)
+            results += await run_bot_commands(main)
+        failed = print_results(results)
+        seq_scans = await print_plans(get_engine(), results) if args.explain else []
+    finally:
+        await get_engine().dispose()
+
+    if failed:
+        print(f"\n❌ Por encima del presupuesto de consultas: {', '.join(failed)}")
+    if seq_scans:
+        print(f"\n❌ Consultas sin índice en: {', '.join(sorted(set(seq_scans)))}")
+    if failed or seq_scans:
+        return 1
+    print("\n✅ Todos los ámbitos dentro del presupuesto")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Presupuesto de consultas SQL por turno/endpoint/comando")
+    parser.add_argument("--explain", action="store_true", help="pide el plan de cada SELECT y falla con recorridos secuenciales")
+    parser.add_argument("--memories", type=int, default=300, help="recuerdos sembrados")
+    parser.add_argument("--messages", type=int, default=200, help="mensajes familiares sembrados")
+    parser.add_argument("--verbose", action="store_true", help="muestra los logs de la app")
+    parser.add_argument("--database-url", help="base de datos desechable (por defecto, SQLite temporal)")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="compa-query-budget-")
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite+aiosqlite:///{os.path.join(workdir, 'budget.db')}"
+    os.environ["MEMORY_INDEX_DIR"] = os.path.join(workdir, "memory_index")
+    for key in ("GEMINI_TOKEN", "TELEGRAM_BOT_TOKEN"):
+        os.environ.pop(key, None)
+    try:
+        code = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
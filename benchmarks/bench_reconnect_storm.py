@@ -0,0 +1,157 @@
+"""
+Tormenta de reconexiones contra /ws.
+
+Los clientes móviles se reconectan constantemente (cambio de red, pantalla
+apagada...). Este benchmark arranca backend.main:app como ws_loadtest (LLM y
+Telegram simulados, SQLite temporal) y hace que cada dispositivo se conecte,
+envíe initial_data, espere su device_info y cierre, una y otra vez.
+
+Informa de handshakes por segundo, latencia del cliente hasta device_info
+(p50/p95/p99), el tiempo de ws.handshake del servidor y las sentencias SQL por
+handshake (contadores db.ws.handshake.* de /metrics). Falla (código 1) si hay
+errores o si se supera el presupuesto de sentencias del handshake.
+
+Uso:
+    python -m benchmarks.bench_reconnect_storm [--devices 200] [--reconnects 10] [--concurrency 100]
+    python -m benchmarks.bench_reconnect_storm --url ws://host:8080/ws   # servidor ya arrancado
+"""
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import websockets
+
+from backend.metrics import Metrics
+from benchmarks.ws_loadtest import (
+    raise_open_files_limit, start_server_process, wait_until_ready, http_get_json,
+)
+
+
+async def reconnect_loop(device_code, args, results, semaphore):
+    device_id = f"device_{device_code}"
+    for _ in range(args.reconnects):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with websockets.connect(
+                    args.url, open_timeout=args.timeout, ping_interval=None, max_size=None,
+                ) as ws:
+                    await ws.send(json.dumps({
+                        "type": "initial_data",
+                        "data": {"device_id": device_id, "device_code": device_code},
+                    }))
+                    while True:
+                        frame = json.loads(await asyncio.wait_for(ws.recv(), timeout=args.timeout))
+                        if frame.get("type") == "device_info":
+                            break
+                results.observe("client.handshake", time.perf_counter() - started)
+                results.inc("handshakes.ok")
+            except Exception:
+                results.inc("handshakes.error")
+        if args.pause:
+            await asyncio.sleep(random.uniform(0, args.pause))
+
+
+async def run_storm(args):
+    raise_open_files_limit()
+    workdir = tempfile.mkdtemp(prefix="compa-reconnect-")
+    process = None
+    if args.url is None:
+        args.url = f"ws://127.0.0.1:{args.port}/ws"
+        # Mismos parámetros del servidor que ws_loadtest (sin turnos de conversación)
+        server_args = argparse.Namespace(
+            port=args.port, database_url=args.database_url, debounce=0.8,
+            llm_latency=0.0, llm_jitter=0.0, family_rate=0.0,
+            no_deflate=False, server_log=args.server_log,
+        )
+        process = start_server_process(server_args, workdir)
+    base_url = args.url.replace("ws://", "http://").replace("wss://", "https://").rsplit("/ws", 1)[0]
+
+    try:
+        await wait_until_ready(base_url, process)
+        print(f"🚀 Servidor listo en {base_url}")
+        before = await asyncio.to_thread(http_get_json, f"{base_url}/metrics")
+
+        results = Metrics(sample_size=args.devices * args.reconnects)
+        codes = random.Random(args.seed).sample(range(100000, 1000000), args.devices)
+        semaphore = asyncio.Semaphore(args.concurrency)
+        started = time.perf_counter()
+        await asyncio.gather(*(reconnect_loop(str(code), args, results, semaphore) for code in codes))
+        duration = time.perf_counter() - started
+
+        after = await asyncio.to_thread(http_get_json, f"{base_url}/metrics")
+        return build_report(args, results, duration, before, after)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def build_report(args, results, duration, before, after):
+    snapshot = results.snapshot()
+    ok = snapshot["counters"].get("handshakes.ok", 0)
+
+    def delta(name):
+        return after["counters"].get(name, 0) - before["counters"].get(name, 0)
+
+    scopes = delta("db.ws.handshake.scopes")
+    return {
+        "devices": args.devices,
+        "reconnects": args.reconnects,
+        "handshakes_ok": ok,
+        "handshakes_error": snapshot["counters"].get("handshakes.error", 0),
+        "handshakes_per_second": round(ok / duration, 1) if duration else 0.0,
+        "client": snapshot["timings"].get("client.handshake"),
+        "server": after["timings"].get("ws.handshake"),
+        "statements_per_handshake": round(delta("db.ws.handshake.statements") / scopes, 2) if scopes else None,
+        "round_trips_per_handshake": round(delta("db.ws.handshake.round_trips") / scopes, 2) if scopes else None,
+        "over_budget": delta("db.ws.handshake.over_budget"),
+    }
+
+
+def print_report(report):
+    print(f"\n🔁 {report['handshakes_ok']} handshakes ({report['devices']} dispositivos x {report['reconnects']})"
+          f", {report['handshakes_error']} errores, {report['handshakes_per_second']} handshakes/s")
+    for label, timing in (("cliente hasta device_info", report["client"]), ("servidor ws.handshake", report["server"])):
+        if timing:
+            print(f"   {label:<28} p50 {timing['p50_ms']:.1f} ms  p95 {timing['p95_ms']:.1f} ms  p99 {timing['p99_ms']:.1f} ms")
+    print(f"   sentencias SQL por handshake: {report['statements_per_handshake']}"
+          f" (viajes a la DB: {report['round_trips_per_handshake']})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tormenta de reconexiones contra /ws")
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--reconnects", type=int, default=10, help="reconexiones por dispositivo")
+    parser.add_argument("--concurrency", type=int, default=100, help="handshakes simultáneos")
+    parser.add_argument("--pause", type=float, default=0.0, help="pausa máxima entre reconexiones (s)")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--url", help="URL ws:// de un servidor ya arrancado")
+    parser.add_argument("--database-url", help="DATABASE_URL del servidor local (por defecto SQLite temporal)")
+    parser.add_argument("--server-log", action="store_true")
+    parser.add_argument("--json", metavar="PATH", help="guarda el informe en JSON")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_storm(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if report["handshakes_error"] or report["over_budget"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Micro-benchmarks de las funciones de texto que se ejecutan en cada mensaje.
+
+Mide cada función de backend/text_processing.py (y el emparejado de la ruta
+rápida) sobre el corpus benchmarks/corpus/utterances_es.txt, además del
+pre-procesado completo de un mensaje tal como lo hace prepare_turn().
+
+Cada tiempo se normaliza con un bucle de calibración medido justo antes, de
+modo que el baseline guardado sirve en otras máquinas y con carga variable. --check falla (código 1) si
+alguna función es más lenta que el baseline por encima del umbral.
+
+Uso:
+    python -m benchmarks.bench_text_processing
+    python -m benchmarks.bench_text_processing --save-baseline
+    python -m benchmarks.bench_text_processing --check [--threshold 0.25]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from backend.text_processing import (
+    memory_regex, is_question, detect_intent, detect_message_intent,
+    parse_spanish_date_fragment, analyze_utterance, limit_sentences,
+)
+from backend.fast_responder import fast_responder
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_PATH = os.path.join(BENCH_DIR, "corpus", "utterances_es.txt")
+BASELINE_PATH = os.path.join(BENCH_DIR, "baselines", "text_processing.json")
+
+# Respuestas tipo del LLM para el recorte de frases
+SAMPLE_REPLIES = [
+    "¡Qué bonito, querida! Seguro que disfrutaste mucho. ¿Qué más recuerdas de aquel día? Me encanta escucharte.",
+    "Hoy es martes. ¿Te apetece que hablemos de lo que has hecho esta mañana?",
+    "Vamos a buscarlas juntas. ¿Has mirado en la mesa de la cocina? A veces las dejamos allí. No te preocupes.",
+    "Antonio debía de ser un gran bailarín.",
+]
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def preprocess_message(text):
+    """Pre-procesado de un mensaje en prepare_turn(): ruta rápida, banderas e intención"""
+    if fast_responder.match(text) is not None:
+        return None
+    analysis = analyze_utterance(text)
+    if analysis["is_family_request"]:
+        analysis["intent"] = detect_message_intent(text)
+    return analysis
+
+
+def calibration(text):
+    """Carga de referencia en Python puro para normalizar entre máquinas"""
+    return len(text.lower().split())
+
+
+def build_cases(corpus):
+    return {
+        "is_question": (is_question, corpus),
+        "memory_regex": (memory_regex.search, corpus),
+        "detect_intent": (detect_intent, corpus),
+        "detect_message_intent": (detect_message_intent, corpus),
+        "parse_spanish_date_fragment": (parse_spanish_date_fragment, corpus),
+        "analyze_utterance": (analyze_utterance, corpus),
+        "fast_path_match": (fast_responder.match, corpus),
+        "limit_sentences": (limit_sentences, SAMPLE_REPLIES),
+        "pipeline": (preprocess_message, corpus),
+    }
+
+
+def time_case(func, inputs, min_time, repeat):
+    """Mejor tiempo por llamada (ns) de varias rondas sobre todas las entradas"""
+    for item in inputs:
+        func(item)
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            for item in inputs:
+                func(item)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        loops *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            for item in inputs:
+                func(item)
+        best = min(best, time.perf_counter() - start)
+    return best / (loops * len(inputs)) * 1e9
+
+
+def measure(func, inputs, corpus, min_time, repeat):
+    # Calibración justo antes de la función: compensa cambios de carga de la máquina
+    calibration_ns = time_case(calibration, corpus, min_time, repeat)
+    ns_per_call = time_case(func, inputs, min_time, repeat)
+    return {
+        "ns_per_call": round(ns_per_call, 1),
+        "calls_per_second": round(1e9 / ns_per_call) if ns_per_call else 0,
+        "relative_cost": round(ns_per_call / calibration_ns, 4),
+    }
+
+
+def run(min_time, repeat, corpus=None):
+    corpus = corpus or load_corpus()
+    results = {}
+    for name, (func, inputs) in build_cases(corpus).items():
+        results[name] = measure(func, inputs, corpus, min_time, repeat)
+    return {"corpus_size": len(corpus), "results": results}
+
+
+def print_results(report):
+    print(f"Corpus: {report['corpus_size']} frases")
+    print(f"{'función':<30} {'ns/llamada':>12} {'llamadas/s':>12} {'coste rel.':>11}")
+    for name, timing in report["results"].items():
+        print(f"{name:<30} {timing['ns_per_call']:>12.1f} {timing['calls_per_second']:>12} {timing['relative_cost']:>11.3f}")
+
+
+def check(report, baseline, threshold, min_time, repeat, retries=2):
+    """
+    Compara el coste relativo con el baseline y devuelve las regresiones.
+    Una función que supera el umbral se vuelve a medir (hasta `retries` veces)
+    antes de darla por regresión, para no fallar por ruido puntual.
+    """
+    corpus = load_corpus()
+    cases = build_cases(corpus)
+    regressions = []
+    for name, timing in report["results"].items():
+        old = baseline["results"].get(name)
+        if not old:
+            continue
+        change = timing["relative_cost"] / old["relative_cost"] - 1
+        for _ in range(retries):
+            if change <= threshold:
+                break
+            func, inputs = cases[name]
+            retry = measure(func, inputs, corpus, min_time, repeat)
+            change = min(change, retry["relative_cost"] / old["relative_cost"] - 1)
+        worse = change > threshold
+        print(f"{'❌' if worse else '✅'} {name}: {change:+.1%}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks del pre-procesado de texto")
+    parser.add_argument("--min-time", type=float, default=0.1, help="tiempo mínimo por ronda (s)")
+    parser.add_argument("--repeat", type=int, default=7, help="rondas por función (se usa la mejor)")
+    parser.add_argument("--save-baseline", action="store_true", help=f"guarda {BASELINE_PATH}")
+    parser.add_argument("--check", action="store_true", help="falla si hay regresiones frente al baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="regresión tolerada (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    report = run(args.min_time, args.repeat)
+    print_results(report)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Baseline guardado en {BASELINE_PATH}")
+
+    if args.check:
+        if not os.path.exists(BASELINE_PATH):
+            print(f"⚠️ No hay baseline en {BASELINE_PATH}; ejecuta con --save-baseline")
+            sys.exit(2)
+        with open(BASELINE_PATH, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = check(report, baseline, args.threshold, args.min_time, args.repeat)
+        if regressions:
+            print(f"❌ Regresiones por encima del {args.threshold:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Benchmark de los codecs de /ws (json estándar, orjson y MessagePack).
+
+Genera frames con tamaños realistas (un mensaje corto, un data_update de una
+sesión normal y el data_update máximo con 1000 turnos de conversación) y mide
+tiempo de codificación/decodificación, bytes en el cable y bytes tras
+permessage-deflate (zlib raw, como hace la extensión).
+
+Uso:
+    python -m benchmarks.bench_ws_codec [--turns 1000] [--memories 200] [--repeat 200]
+"""
+import argparse
+import json
+import random
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from backend.ws_protocol import JsonCodec, MsgpackCodec, orjson, msgpack
+
+
+SAMPLE_USER = [
+    "Hoy he visto a mi hija Lucía, vino a comer con los niños",
+    "¿Qué día es hoy?",
+    "Me acuerdo de cuando vivíamos en Sevilla, cerca del río",
+    "No encuentro las gafas, creo que las dejé en la cocina",
+    "Mi marido se llamaba Antonio y le gustaba mucho bailar",
+]
+SAMPLE_ASSISTANT = [
+    "¡Qué bonito, querida! Seguro que disfrutaste mucho con Lucía y los niños.",
+    "Hoy es martes. ¿Te apetece que hablemos de lo que has hecho esta mañana?",
+    "Sevilla es preciosa. ¿Qué es lo que más recuerdas de aquel barrio?",
+    "Vamos a buscarlas juntas. ¿Has mirado en la mesa de la cocina?",
+    "Antonio debía de ser un gran bailarín. ¿Dónde bailabais?",
+]
+
+
+def make_conversation(turns, rng):
+    start = datetime(2025, 1, 1, 9, 0)
+    return [
+        {
+            "timestamp": (start + timedelta(minutes=7 * i)).isoformat(),
+            "user": rng.choice(SAMPLE_USER),
+            "assistant": rng.choice(SAMPLE_ASSISTANT),
+        }
+        for i in range(turns)
+    ]
+
+
+def make_user_memory(memories, rng):
+    start = datetime(2024, 6, 1, 10, 0)
+    return {
+        "user_preferences": {"music": "copla", "drink": "café con leche"},
+        "important_memories": [
+            {
+                "id": i + 1,
+                "content": rng.choice(SAMPLE_USER),
+                "category": "personal",
+                "timestamp": (start + timedelta(hours=5 * i)).isoformat(),
+                "last_recalled": None,
+            }
+            for i in range(memories)
+        ],
+        "family_members": ["Lucía", "Antonio", "Pablo"],
+        "daily_routine": {"morning": "paseo", "afternoon": "siesta"},
+        "emotional_state": "calm",
+    }
+
+
+def make_frames(turns, memories):
+    rng = random.Random(42)
+    return {
+        "message": {"type": "message", "text": SAMPLE_ASSISTANT[0], "reply_to": ["9f1c2d4e-1"]},
+        "data_update_50": {
+            "type": "data_update",
+            "user_memory": make_user_memory(min(memories, 20), rng),
+            "conversation_history": make_conversation(50, rng),
+        },
+        f"data_update_{turns}": {
+            "type": "data_update",
+            "user_memory": make_user_memory(memories, rng),
+            "conversation_history": make_conversation(turns, rng),
+        },
+    }
+
+
+class StdlibJson:
+    name = "json (stdlib)"
+
+    @staticmethod
+    def encode(frame):
+        return json.dumps(frame, ensure_ascii=False)
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data)
+
+
+def deflate_size(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))
+
+
+def bench(codec, frame, repeat):
+    encoded = codec.encode(frame)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        codec.encode(frame)
+    encode_us = (time.perf_counter() - start) / repeat * 1e6
+    start = time.perf_counter()
+    for _ in range(repeat):
+        codec.decode(encoded)
+    decode_us = (time.perf_counter() - start) / repeat * 1e6
+    size = len(encoded.encode("utf-8") if isinstance(encoded, str) else encoded)
+    return encode_us, decode_us, size, deflate_size(encoded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--turns", type=int, default=1000)
+    parser.add_argument("--memories", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    codecs = [StdlibJson]
+    if orjson is not None:
+        codecs.append(JsonCodec)
+    else:
+        print("⚠️ orjson no instalado: JsonCodec usa json estándar")
+    if msgpack is not None:
+        codecs.append(MsgpackCodec)
+    else:
+        print("⚠️ msgpack no instalado: se omite MessagePack")
+
+    header = f"{'frame':<18} {'codec':<14} {'encode µs':>10} {'decode µs':>10} {'bytes':>9} {'deflate':>9}"
+    print(header)
+    print("-" * len(header))
+    for frame_name, frame in make_frames(args.turns, args.memories).items():
+        for codec in codecs:
+            encode_us, decode_us, size, compressed = bench(codec, frame, args.repeat)
+            name = getattr(codec, "name", "")
+            if codec is JsonCodec:
+                name = "orjson"
+            print(f"{frame_name:<18} {name:<14} {encode_us:>10.1f} {decode_us:>10.1f} {size:>9} {compressed:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,552 @@
+"""
+Prueba de carga end-to-end de /ws con un Gemini y un Telegram simulados.
+
+Arranca backend.main:app en un subproceso con un LLM falso (latencia
+configurable), un bot de Telegram falso y una base de datos SQLite local, y
+conecta miles de dispositivos simulados. Cada dispositivo hace el handshake con
+initial_data, envía keepalives y dice frases del corpus en español esperando la
+respuesta a cada una (reply_to).
+
+Informa de turnos por segundo, latencias p50/p95/p99 del cliente y de cada
+etapa del servidor (leídas de /metrics) y de la memoria por conexión (RSS del
+servidor). Los resultados se pueden guardar como baseline y comparar después.
+
+Uso:
+    python -m benchmarks.ws_loadtest --devices 1000 --turns 5 --llm-latency 0.8
+    python -m benchmarks.ws_loadtest --devices 500 --save-baseline local
+    python -m benchmarks.ws_loadtest --devices 500 --compare local
+    python -m benchmarks.ws_loadtest --url ws://host:8080/ws   # servidor ya arrancado
+
+Requiere el paquete websockets (ya lo instala uvicorn[standard]) y aiosqlite
+para la base de datos local.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import uuid
+
+import websockets
+
+from backend.metrics import Metrics
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.dirname(BENCH_DIR)
+CORPUS_PATH = os.path.join(BENCH_DIR, "corpus", "utterances_es.txt")
+BASELINES_DIR = os.path.join(BENCH_DIR, "baselines")
+
+# Etapas del servidor que se incluyen en el informe
+SERVER_STAGES = [
+    "ws.handshake", "turn.prepare", "turn.retrieval", "turn.llm",
+    "turn.commit", "turn.persist", "turn.data_update",
+]
+
+# Métricas comparadas con el baseline: (ruta, True si más alto es mejor)
+BASELINE_CHECKS = [
+    (("turns_per_second",), True),
+    (("latency_ms", "client.turn", "p95_ms"), False),
+    (("latency_ms", "client.connect", "p95_ms"), False),
+    (("memory", "kb_per_connection"), False),
+]
+
+
+def load_corpus(path=CORPUS_PATH):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def raise_open_files_limit():
+    """Sube el límite de descriptores abiertos al máximo permitido"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def read_rss_kb(pid):
+    """RSS de un proceso en KB (Linux /proc; psutil si está instalado)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss // 1024
+    except Exception:
+        return None
+
+
+# ============================================
+# SERVIDOR - app real con Gemini y Telegram simulados
+# ============================================
+
+class FakeGeminiResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGemini:
+    """Sustituye a GEMINI_CLIENT: responde tras una latencia configurable"""
+
+    REPLIES = [
+        "¡Qué bonito, querida! Cuéntame un poco más.",
+        "Aquí estoy contigo. ¿Cómo te sientes ahora?",
+        "Me encanta escucharte. ¿Qué más recuerdas?",
+        "Tranquila, vamos poco a poco. ¿Te apetece hablar de tu familia?",
+    ]
+
+    def __init__(self, latency, jitter):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = 0
+
+    async def generate_content_async(self, prompt, generation_config=None):
+        self.calls += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        return FakeGeminiResponse(random.choice(self.REPLIES))
+
+
+class FakeTelegramBot:
+    """Sustituye a FamilyMessagesBot: mensajes familiares falsos y notificaciones periódicas"""
+
+    def __init__(self, active_websockets, notifications_per_second):
+        self.active_websockets = active_websockets
+        self.notifications_per_second = notifications_per_second
+        self._notifier = None
+
+    def _fake_messages(self, count=3):
+        now = time.localtime()
+        return [
+            {
+                "id": i + 1,
+                "sender_name": "Lucía",
+                "message": "¡Hola mamá! Mañana vamos a verte con los niños.",
+                "chat_id": 1000 + i,
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", now),
+                "date": time.strftime("%d/%m/%Y", now),
+                "time": time.strftime("%H:%M", now),
+                "read": False,
+            }
+            for i in range(count)
+        ]
+
+    async def get_unread_messages(self):
+        return self._fake_messages()
+
+    async def get_all_messages(self):
+        return self._fake_messages(10)
+
+    async def get_messages_by_date(self, date_str):
+        return self._fake_messages(1)
+
+    async def process_connection_response(self, request_id, approved, websocket):
+        return None
+
+    async def _notify_loop(self):
+        from backend.ws_protocol import send_frame
+        interval = 1.0 / self.notifications_per_second
+        while True:
+            await asyncio.sleep(interval)
+            if not self.active_websockets:
+                continue
+            websocket = random.choice(list(self.active_websockets.values()))
+            try:
+                await send_frame(websocket, {"type": "new_message_notification"})
+            except Exception:
+                pass
+
+    async def start_bot(self):
+        if self.notifications_per_second > 0:
+            self._notifier = asyncio.create_task(self._notify_loop())
+        return True
+
+    async def stop_bot(self):
+        if self._notifier:
+            self._notifier.cancel()
+
+
+def run_server(args):
+    """Proceso servidor: importa la app, sustituye los servicios externos y arranca uvicorn"""
+    import uvicorn
+
+    raise_open_files_limit()
+    from backend import main
+
+    main.GEMINI_CLIENT = FakeGemini(args.llm_latency, args.llm_jitter)
+    main.telegram_bot = FakeTelegramBot(main.ACTIVE_WEBSOCKETS, args.family_rate)
+
+    uvicorn.run(
+        main.app, host="127.0.0.1", port=args.port, log_level="warning",
+        ws="websockets", ws_per_message_deflate=not args.no_deflate, backlog=4096,
+    )
+
+
+def start_server_process(args, workdir):
+    env = dict(os.environ)
+    env["DATABASE_URL"] = args.database_url or f"sqlite+aiosqlite:///{os.path.join(workdir, 'loadtest.db')}"
+    env["MEMORY_INDEX_DIR"] = os.path.join(workdir, "memory_index")
+    env["TURN_COALESCE_SECONDS"] = str(args.debounce)
+    env["PYTHONPATH"] = PROJECT_ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    env.pop("GEMINI_TOKEN", None)
+    env.pop("TELEGRAM_BOT_TOKEN", None)
+
+    command = [
+        sys.executable, "-m", "benchmarks.ws_loadtest", "--serve",
+        "--port", str(args.port),
+        "--llm-latency", str(args.llm_latency),
+        "--llm-jitter", str(args.llm_jitter),
+        "--family-rate", str(args.family_rate),
+    ]
+    if args.no_deflate:
+        command.append("--no-deflate")
+    output = None if args.server_log else subprocess.DEVNULL
+    # El servidor solo comprueba la versión del esquema: se migra antes
+    subprocess.run([sys.executable, "-m", "backend.migrations", "upgrade"],
+                   cwd=PROJECT_ROOT, env=env, stdout=output, stderr=output, check=True)
+    return subprocess.Popen(command, cwd=PROJECT_ROOT, env=env, stdout=output, stderr=output)
+
+
+def http_get_json(url, timeout=5.0):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+async def wait_until_ready(base_url, process=None, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"el servidor terminó con código {process.returncode}")
+        try:
+            await asyncio.to_thread(http_get_json, f"{base_url}/ready", 1.0)
+            return
+        except Exception:
+            await asyncio.sleep(0.25)
+    raise RuntimeError("el servidor no respondió a /ready a tiempo")
+
+
+# ============================================
+# CLIENTE - dispositivos simulados
+# ============================================
+
+class SimulatedDevice:
+    """Un dispositivo: handshake, keepalives y turnos esperando su reply_to"""
+
+    def __init__(self, index, device_code, args, corpus, results):
+        self.index = index
+        self.device_id = f"device_{device_code}"
+        self.device_code = device_code
+        self.args = args
+        self.corpus = corpus
+        self.results = results
+        self.rng = random.Random(args.seed + index)
+        self.ws = None
+        self.binary = args.codec == "msgpack"
+        self._pending = {}
+        self._handshake = None
+
+    def encode(self, frame):
+        if self.binary:
+            import msgpack
+            return msgpack.packb(frame, use_bin_type=True)
+        return json.dumps(frame, ensure_ascii=False)
+
+    def decode(self, data):
+        if isinstance(data, bytes):
+            import msgpack
+            return msgpack.unpackb(data, raw=False)
+        return json.loads(data)
+
+    async def connect(self):
+        started = time.perf_counter()
+        subprotocols = ["compa.msgpack"] if self.binary else None
+        self.ws = await websockets.connect(
+            self.args.url, subprotocols=subprotocols,
+            compression=None if self.args.no_deflate else "deflate",
+            max_size=None, open_timeout=self.args.turn_timeout, ping_interval=None,
+        )
+        self._handshake = asyncio.get_running_loop().create_future()
+        self._reader = asyncio.create_task(self._read())
+        await self.ws.send(self.encode({
+            "type": "initial_data",
+            "data": {"device_id": self.device_id, "device_code": self.device_code, "locale": "es"},
+        }))
+        await asyncio.wait_for(self._handshake, timeout=self.args.turn_timeout)
+        self.results.observe("client.connect", time.perf_counter() - started)
+
+    async def _read(self):
+        try:
+            async for data in self.ws:
+                frame = self.decode(data)
+                frame_type = frame.get("type")
+                self.results.inc(f"frames.{frame_type}")
+                if frame_type == "message" and not frame.get("reply_to"):
+                    # Saludo de bienvenida: fin del handshake
+                    if not self._handshake.done():
+                        self._handshake.set_result(True)
+                for message_id in frame.get("reply_to") or []:
+                    future = self._pending.pop(message_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(frame_type)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("conexión cerrada"))
+
+    async def keepalive(self):
+        while True:
+            await asyncio.sleep(self.args.keepalive)
+            await self.ws.send(self.encode({"type": "keepalive", "ts": time.time()}))
+
+    async def speak(self):
+        keepalive = asyncio.create_task(self.keepalive())
+        try:
+            for _ in range(self.args.turns):
+                await asyncio.sleep(self.rng.uniform(0, self.args.think))
+                message_id = uuid.uuid4().hex
+                future = asyncio.get_running_loop().create_future()
+                self._pending[message_id] = future
+                started = time.perf_counter()
+                await self.ws.send(self.encode({
+                    "type": "utterance", "id": message_id, "text": self.rng.choice(self.corpus),
+                }))
+                try:
+                    await asyncio.wait_for(future, timeout=self.args.turn_timeout)
+                    self.results.observe("client.turn", time.perf_counter() - started)
+                    self.results.inc("turns.ok")
+                except asyncio.TimeoutError:
+                    self._pending.pop(message_id, None)
+                    self.results.inc("turns.timeout")
+                except ConnectionError:
+                    self.results.inc("turns.closed")
+                    return
+        finally:
+            keepalive.cancel()
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+            self._reader.cancel()
+
+
+async def connect_all(devices, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def connect_one(device):
+        async with semaphore:
+            try:
+                await device.connect()
+                return device
+            except Exception as e:
+                device.results.inc("connect.errors")
+                if device.results.counters["connect.errors"] <= 3:
+                    print(f"⚠️ Error conectando {device.device_id}: {e!r}")
+                return None
+
+    connected = await asyncio.gather(*(connect_one(d) for d in devices))
+    return [d for d in connected if d is not None]
+
+
+def build_report(args, results, connected, duration, server_metrics, memory):
+    snapshot = results.snapshot()
+    turns_ok = results.counters["turns.ok"]
+    stages = {}
+    for name in SERVER_STAGES:
+        timing = (server_metrics or {}).get("timings", {}).get(name)
+        if timing:
+            stages[name] = timing
+    return {
+        "config": {
+            "devices": args.devices, "turns": args.turns, "think": args.think,
+            "llm_latency": args.llm_latency, "llm_jitter": args.llm_jitter,
+            "debounce": args.debounce, "codec": args.codec, "deflate": not args.no_deflate,
+        },
+        "connected": len(connected),
+        "connect_errors": results.counters["connect.errors"],
+        "turns_ok": turns_ok,
+        "turns_timeout": results.counters["turns.timeout"],
+        "turns_closed": results.counters["turns.closed"],
+        "busy_frames": results.counters["frames.busy"],
+        "duration_s": round(duration, 3),
+        "turns_per_second": round(turns_ok / duration, 2) if duration else 0.0,
+        "latency_ms": {name: snapshot["timings"][name] for name in ("client.connect", "client.turn") if name in snapshot["timings"]},
+        "server_stages": stages,
+        "server_counters": {
+            k: v for k, v in (server_metrics or {}).get("counters", {}).items()
+            if k.startswith(("turn.", "fast_path.turns", "response_cache."))
+        },
+        "memory": memory,
+    }
+
+
+def print_report(report):
+    print("\n📊 Resultado de la prueba de carga")
+    print(f"   dispositivos conectados: {report['connected']}/{report['config']['devices']}"
+          f" (errores: {report['connect_errors']})")
+    print(f"   turnos ok: {report['turns_ok']}  timeouts: {report['turns_timeout']}"
+          f"  cerrados: {report['turns_closed']}  busy: {report['busy_frames']}")
+    print(f"   duración: {report['duration_s']} s  →  {report['turns_per_second']} turnos/s")
+    memory = report["memory"]
+    if memory.get("kb_per_connection") is not None:
+        print(f"   RSS servidor: {memory['rss_idle_kb']} KB en reposo, {memory['rss_connected_kb']} KB conectados"
+              f"  →  {memory['kb_per_connection']} KB/conexión")
+
+    rows = [(name, t) for name, t in report["latency_ms"].items()] + list(report["server_stages"].items())
+    print(f"\n   {'etapa':<20} {'n':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, t in rows:
+        print(f"   {name:<20} {t['count']:>7} {t['p50_ms']:>9.1f} {t['p95_ms']:>9.1f} {t['p99_ms']:>9.1f} {t['max_ms']:>9.1f}")
+
+
+def baseline_path(name):
+    return os.path.join(BASELINES_DIR, f"{name}.json")
+
+
+def save_baseline(report, name):
+    os.makedirs(BASELINES_DIR, exist_ok=True)
+    with open(baseline_path(name), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 Baseline guardado en {baseline_path(name)}")
+
+
+def compare_baseline(report, name, tolerance):
+    """Devuelve la lista de regresiones respecto al baseline"""
+    with open(baseline_path(name), encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("config") != report.get("config"):
+        print("⚠️ La configuración difiere de la del baseline; la comparación es orientativa")
+
+    regressions = []
+    print(f"\n🔎 Comparación con el baseline '{name}' (tolerancia {tolerance:.0%})")
+    for path, higher_is_better in BASELINE_CHECKS:
+        old, new = baseline, report
+        for key in path:
+            old = (old or {}).get(key)
+            new = (new or {}).get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        label = ".".join(path)
+        print(f"   {'❌' if worse else '✅'} {label}: {old} → {new} ({change:+.1%})")
+        if worse:
+            regressions.append(label)
+    return regressions
+
+
+async def run_loadtest(args):
+    raise_open_files_limit()
+    corpus = load_corpus(args.corpus)
+    workdir = tempfile.mkdtemp(prefix="compa-loadtest-")
+    process = None
+    server_pid = args.server_pid
+
+    if args.url is None:
+        args.url = f"ws://127.0.0.1:{args.port}/ws"
+        process = start_server_process(args, workdir)
+        server_pid = process.pid
+    base_url = args.url.replace("ws://", "http://").replace("wss://", "https://").rsplit("/ws", 1)[0]
+
+    try:
+        await wait_until_ready(base_url, process)
+        print(f"🚀 Servidor listo en {base_url}")
+
+        results = Metrics(sample_size=max(args.devices * args.turns, args.devices))
+        codes = random.Random(args.seed).sample(range(100000, 1000000), args.devices)
+        devices = [SimulatedDevice(i, str(code), args, corpus, results) for i, code in enumerate(codes)]
+
+        rss_idle = read_rss_kb(server_pid) if server_pid else None
+        connected = await connect_all(devices, args.connect_concurrency)
+        await asyncio.sleep(1.0)
+        rss_connected = read_rss_kb(server_pid) if server_pid else None
+        print(f"🔌 {len(connected)} dispositivos conectados")
+
+        memory = {"rss_idle_kb": rss_idle, "rss_connected_kb": rss_connected, "kb_per_connection": None}
+        if rss_idle is not None and rss_connected is not None and connected:
+            memory["kb_per_connection"] = round((rss_connected - rss_idle) / len(connected), 2)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(device.speak() for device in connected))
+        duration = time.perf_counter() - started
+
+        try:
+            server_metrics = await asyncio.to_thread(http_get_json, f"{base_url}/metrics")
+        except Exception as e:
+            print(f"⚠️ No se pudieron leer las métricas del servidor: {e}")
+            server_metrics = None
+
+        await asyncio.gather(*(device.close() for device in connected), return_exceptions=True)
+        return build_report(args, results, connected, duration, server_metrics, memory)
+    finally:
+        if process is not None:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga end-to-end de /ws")
+    parser.add_argument("--devices", type=int, default=200, help="dispositivos simulados")
+    parser.add_argument("--turns", type=int, default=5, help="frases por dispositivo")
+    parser.add_argument("--think", type=float, default=2.0, help="pausa máxima entre frases (s)")
+    parser.add_argument("--keepalive", type=float, default=25.0, help="intervalo de keepalive (s)")
+    parser.add_argument("--turn-timeout", type=float, default=60.0)
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--codec", choices=["json", "msgpack"], default="json")
+    parser.add_argument("--no-deflate", action="store_true", help="sin permessage-deflate")
+    parser.add_argument("--llm-latency", type=float, default=0.8, help="latencia media del LLM falso (s)")
+    parser.add_argument("--llm-jitter", type=float, default=0.2)
+    parser.add_argument("--family-rate", type=float, default=0.0, help="notificaciones de Telegram falsas por segundo")
+    parser.add_argument("--debounce", type=float, default=0.8, help="TURN_COALESCE_SECONDS del servidor")
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--url", help="URL ws:// de un servidor ya arrancado (no se lanza uno local)")
+    parser.add_argument("--server-pid", type=int, help="pid del servidor externo para medir su memoria")
+    parser.add_argument("--database-url", help="DATABASE_URL del servidor local (por defecto SQLite temporal)")
+    parser.add_argument("--server-log", action="store_true", help="muestra la salida del servidor")
+    parser.add_argument("--save-baseline", metavar="NAME")
+    parser.add_argument("--compare", metavar="NAME")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="regresión tolerada frente al baseline")
+    parser.add_argument("--json", metavar="PATH", help="guarda el informe completo en JSON")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.serve:
+        run_server(args)
+        return
+
+    report = asyncio.run(run_loadtest(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        save_baseline(report, args.save_baseline)
+    if args.compare:
+        regressions = compare_baseline(report, args.compare, args.tolerance)
+        if regressions:
+            print(f"❌ Regresiones: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -178,6 +178,7 @@ if (window.__ACOMPANIA_APPJS_LOADED) {
     let speakEnabled = true;                     // Global flag to enable/disable TTS
     let sendSilenceTimer = null;                 // Timeout for sending recognized text after silence
     let pendingFinal = '';                       // Buffer for final recognized transcripts
+    let unackedUtterances = [];                  // Utterances sent but not answered yet ({type, id, text})
     let uiConversation = document.querySelector('#conversation'); // Conversation display element
     const btnId = 'showMemories';                // ID for memories button
     const memoryListId = 'memoryList';           // ID for memories list container
@@ -252,12 +253,20 @@ if (window.__ACOMPANIA_APPJS_LOADED) {
         };
         ws.send(JSON.stringify(initialData));
         console.log('📤 Datos iniciales enviados al servidor');
+
+        // Resend unanswered utterances with their original ids;
+        // the server answers retries from its dedup window
+        unackedUtterances.forEach((msg) => ws.send(JSON.stringify(msg)));
     });
 
     // Handle incoming messages from server
     ws.addEventListener('message', (ev) => {
         try {
             const parsed = JSON.parse(ev.data);
+            // Acknowledge utterances answered by this frame
+            if (parsed && Array.isArray(parsed.reply_to)) {
+              unackedUtterances = unackedUtterances.filter((msg) => !parsed.reply_to.includes(msg.id));
+            }
             // Handle connection request from family member
             if (parsed && parsed.type === 'connection_request') {
             showConnectionRequestModal(parsed.request_id, parsed.user_info);
@@ -337,8 +346,8 @@ if (window.__ACOMPANIA_APPJS_LOADED) {
           }
           // --- FIN BLOQUE AÑADIDO ---
 
-          // Ignore WebSocket control messages (ping/pong)
-          else if (parsed && (parsed.type === 'pong' || parsed.type === 'ping')) {
+          // Ignore WebSocket control messages (ping/pong, busy backpressure)
+          else if (parsed && (parsed.type === 'pong' || parsed.type === 'ping' || parsed.type === 'busy')) {
             if (VERBOSE) console.log('WS control:', parsed.type, parsed.ts || parsed);
           } 
           
@@ -427,6 +436,30 @@ if (window.__ACOMPANIA_APPJS_LOADED) {
       }
   }
 
+    // Generate a client-side id for an utterance (idempotent retries)
+    function newMessageId() {
+      if (window.crypto && typeof window.crypto.randomUUID === 'function') return window.crypto.randomUUID();
+      return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+    }
+
+    // Send a recognized utterance with an id; it is kept until the server answers it
+    function sendUtterance(text) {
+      // The server ignores blank utterances and never acks them
+      if (!text || !text.trim()) return;
+      const msg = { type: 'utterance', id: newMessageId(), text: text };
+      unackedUtterances.push(msg);
+      if (!ws || ws.readyState !== WebSocket.OPEN) {
+        // Will be flushed by the 'open' handler
+        connectWebSocket();
+        return;
+      }
+      try {
+        ws.send(JSON.stringify(msg));
+      } catch (e) {
+        console.error('Error enviando por WS:', e);
+      }
+    }
+
     // Send message to server via WebSocket
     function sendMessageToServer(text) {
       try {
@@ -773,9 +806,9 @@ if (window.__ACOMPANIA_APPJS_LOADED) {
               appendConversation('Tú', pendingFinal);
               try {
                 const maybe = JSON.parse(pendingFinal);
-                if (!(maybe && maybe.type === 'keepalive')) sendMessageToServer(pendingFinal);
+                if (!(maybe && maybe.type === 'keepalive')) sendUtterance(pendingFinal);
               } catch (e) {
-                sendMessageToServer(pendingFinal);
+                sendUtterance(pendingFinal);
               }
               pendingFinal = '';
             }
@@ -897,6 +930,19 @@ if (window.__ACOMPANIA_APPJS_LOADED) {
     // FAMILY MESSAGES - Family communication feature
     // ============================================
     // Fetch and display family messages from server
+
+    // Voice note or photo attached to a family message. preload="none" and
+    // lazy images: the file is fetched (with Range requests) only when played or shown
+    function renderFamilyMedia(media) {
+      if (!media || !media.url) return '';
+      if (media.type === 'voice') {
+        return `<div class="family-item-media"><audio controls preload="none" src="${media.url}"></audio></div>`;
+      }
+      if (media.type === 'photo') {
+        return `<div class="family-item-media"><img loading="lazy" alt="Foto" src="${media.url}"></div>`;
+      }
+      return '';
+    }
     
     async function loadFamilyMessages() {
       const deviceId = storageManager.getDeviceId();
@@ -971,6 +1017,7 @@ if (window.__ACOMPANIA_APPJS_LOADED) {
               <span class="family-item-date">📅 ${date} 🕐 ${time}</span>
             </div>
             <div class="family-item-message">${msg.message || ''}</div>
+            ${renderFamilyMedia(msg.media)}
             <div class="family-item-actions">
               <button class="btn-read" data-id="${msg.id}">Leer</button>
               ${!msg.read ? `<button class="btn-mark-read" data-id="${msg.id}">Marcar leído</button>` : ''}
@@ -1537,7 +1584,7 @@ if (window.__ACOMPANIA_APPJS_LOADED) {
           reconnectWS: () => connectWebSocket(),
 
           // Message sending
-          sendMessage: (t) => { appendConversation('You', t); sendMessageToServer(t); },
+          sendMessage: (t) => { appendConversation('You', t); sendUtterance(t); },
 
           // TTS control
           enableSpeech: (b) => { speakEnabled = !!b; console.log('TTS enabled =', speakEnabled); },
@@ -0,0 +1,147 @@
+"""
+Comprobación local del reparto de lecturas entre el primario y una réplica.
+
+Usa dos bases de datos SQLite: el primario y una "réplica" que es una copia
+del primario tomada tras las migraciones y que no vuelve a actualizarse. Así
+se ve qué base de datos responde a cada lectura (ver read_session en
+backend/database.py):
+1. POST /memory/cofre escribe en el primario,
+2. GET /memory/cofre justo después lee del primario (lectura de lo escrito),
+3. pasado READ_YOUR_WRITES_SECONDS lee de la réplica, que no tiene el recuerdo,
+4. una sesión creada solo en el primario se valida igualmente (si la réplica
+   no la encuentra se repite la consulta en el primario),
+5. las escrituras del bot (FamilyMessages) también fijan el dispositivo al primario,
+6. con el bot en otro proceso (python -m backend.bot_worker), el aviso que
+   entrega el servidor web fija el dispositivo al primario.
+
+Falla (código 1) si algún paso no se cumple.
+
+Uso:
+    python -m scripts.check_read_replicas
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+
+DEVICE_ID = "device_424242"
+STICKY_SECONDS = 0.5
+
+
+async def run(workdir):
+    primary = os.path.join(workdir, "primary.db")
+    replica = os.path.join(workdir, "replica.db")
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{primary}"
+    os.environ["DATABASE_REPLICA_URLS"] = f"sqlite+aiosqlite:///{replica}"
+    os.environ["READ_YOUR_WRITES_SECONDS"] = str(STICKY_SECONDS)
+
+    import httpx
+    from backend.migrations import upgrade
+    from backend import database
+    from backend.database import get_engine, dispose_engines, async_session, DeviceData, UserSession
+    from backend.bot_outbox import deliver_to_devices
+    from backend.auth_tokens import new_token, hash_token
+    from backend.metrics import metrics
+    from backend.telegram_bot import FamilyMessagesBot
+
+    await upgrade()
+    async with async_session() as session:
+        session.add(DeviceData(device_id=DEVICE_ID, user_memory={}, conversation_history=[]))
+        await session.commit()
+    await get_engine().dispose()
+    shutil.copy(primary, replica)
+
+    import backend.main as main
+    main.telegram_bot = main.telegram_bot or SimpleNamespace()
+    failures = []
+
+    def check(label, ok, detail=""):
+        print(f"{'✅' if ok else '❌'} {label}{f' ({detail})' if detail else ''}")
+        if not ok:
+            failures.append(label)
+
+    def replica_reads():
+        return metrics.counters["db.reads.replica"]
+
+    try:
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://check") as client:
+            response = await client.post("/memory/cofre", json={"device_id": DEVICE_ID, "content": "Mi nieta Lucía vive en Sevilla"})
+            check("POST /memory/cofre", response.status_code == 200)
+
+            before = replica_reads()
+            total = (await client.get("/memory/cofre", params={"device_id": DEVICE_ID})).json()["total_memories"]
+            check("lectura de lo escrito desde el primario", total == 1 and replica_reads() == before, f"{total} recuerdo(s)")
+
+            await asyncio.sleep(STICKY_SECONDS + 0.1)
+            total = (await client.get("/memory/cofre", params={"device_id": DEVICE_ID})).json()["total_memories"]
+            check("lectura posterior desde la réplica", total == 0 and replica_reads() == before + 1, f"{total} recuerdo(s)")
+
+            token = new_token()
+            async with async_session() as session:
+                session.add(UserSession(
+                    phone_number="555000111",
+                    token_hash=hash_token(token),
+                    device_id=DEVICE_ID,
+                    verified=True,
+                    expires_at=datetime.utcnow() + timedelta(days=1),
+                ))
+                await session.commit()
+            response = await client.post("/auth/validate-session", json={"session_token": token})
+            check("sesión nueva validada (réplica y luego primario)", response.json().get("valid") is True)
+
+            await asyncio.sleep(STICKY_SECONDS + 0.1)
+            bot = FamilyMessagesBot(None)
+            connection = SimpleNamespace(device_id=DEVICE_ID, alias="Mama")
+            async with async_session() as session:
+                await bot._send_family_message(session, 555000111, "Lucía", [connection], "¡Hola mamá!")
+            before = replica_reads()
+            messages = (await client.get("/family/messages", params={"device_id": DEVICE_ID})).json()
+            check(
+                "mensaje del bot leído desde el primario",
+                messages["total_unread"] == 1 and replica_reads() == before,
+            )
+
+            frames = []
+
+            async def send_text(data):
+                frames.append(data)
+
+            websocket = SimpleNamespace(state=SimpleNamespace(), send_text=send_text)
+            await deliver_to_devices({DEVICE_ID: websocket})
+            frames.clear()
+            async with async_session() as session:
+                await bot._send_family_message(session, 555000111, "Lucía", [connection], "¿Vienes el domingo?")
+            # mark_written del bot no llega al servidor web si el bot corre aparte
+            database._recent_writes.clear()
+            await deliver_to_devices({DEVICE_ID: websocket})
+            before = replica_reads()
+            messages = (await client.get("/family/messages", params={"device_id": DEVICE_ID})).json()
+            check(
+                "mensaje del bot en otro proceso leído desde el primario tras el aviso",
+                len(frames) == 1 and messages["total_unread"] == 2 and replica_reads() == before,
+            )
+    finally:
+        await dispose_engines()
+
+    if failures:
+        print(f"\n❌ Fallaron {len(failures)} comprobaciones")
+        return 1
+    print("\n✅ Lecturas repartidas entre primario y réplica correctamente")
+    return 0
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix="compa-replicas-")
+    try:
+        sys.exit(asyncio.run(run(workdir)))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+"""
+Prueba de extremo a extremo del bot de Telegram como proceso aparte.
+
+Arranca en local los dos procesos contra la misma base de datos SQLite temporal:
+- el servidor web (uvicorn backend.main:app con TELEGRAM_BOT_MODE=worker),
+- el bot (python -m backend.bot_worker),
+y un servidor falso de la Bot API de Telegram dentro de este script
+(TELEGRAM_API_BASE_URL), que entrega los comandos como updates de getUpdates y
+recoge los sendMessage del bot.
+
+Recorre el flujo completo a través de bot_outbox:
+1. un dispositivo se conecta por /ws y recibe su código,
+2. /connect <código> llega al dispositivo como connection_request,
+3. el dispositivo aprueba y el chat recibe "Conexión Aprobada",
+4. /alias y /m: el dispositivo recibe new_message_notification y el mensaje
+   aparece en GET /family/messages,
+5. una nota de voz se descarga por trozos al almacén y se sirve con Range
+   (206), ETag y 304,
+6. /m con el dispositivo desconectado: la notificación llega al reconectar.
+
+Falla (código 1) si algún paso no se cumple a tiempo y muestra el final de los
+logs de ambos procesos.
+
+Uso:
+    python -m scripts.e2e_bot_worker [--timeout 15] [--keep-logs]
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+import httpx
+import uvicorn
+import websockets
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOT_TOKEN = "123456:E2E-TEST-TOKEN"
+CHAT_ID = 555000111
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeTelegramAPI:
+    """Bot API mínima: getUpdates con long polling y registro de sendMessage"""
+
+    def __init__(self):
+        self.updates = []
+        self.sent = []
+        self.files = {}
+        self._changed = asyncio.Condition()
+        self.app = Starlette(routes=[
+            Route("/bot{token}/{method}", self.handle, methods=["GET", "POST"]),
+            Route("/file/bot{token}/{path:path}", self.download),
+        ])
+
+    async def _push_message(self, fields, chat_id=CHAT_ID, name="Lucía"):
+        message = {
+            "message_id": len(self.updates) + 1,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": name},
+            "from": {"id": chat_id, "is_bot": False, "first_name": name, "last_name": "García", "username": name.lower()},
+            **fields,
+        }
+        async with self._changed:
+            self.updates.append({"update_id": len(self.updates) + 1, "message": message})
+            self._changed.notify_all()
+
+    async def push_command(self, text, **kwargs):
+        command = text.split()[0]
+        await self._push_message({
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        }, **kwargs)
+
+    async def push_voice(self, data, caption=None, **kwargs):
+        file_id = f"voice{len(self.files) + 1}"
+        self.files[file_id] = data
+        fields = {"voice": {"file_id": file_id, "file_unique_id": file_id, "duration": 3,
+                            "mime_type": "audio/ogg", "file_size": len(data)}}
+        if caption:
+            fields["caption"] = caption
+        await self._push_message(fields, **kwargs)
+
+    async def download(self, request):
+        data = self.files.get(request.path_params["path"].rsplit("/", 1)[-1])
+        if data is None:
+            return Response(status_code=404)
+        return Response(data, media_type="application/octet-stream")
+
+    async def wait_sent(self, fragment, timeout):
+        """Espera un sendMessage al chat cuyo texto contenga fragment"""
+        async def match():
+            async with self._changed:
+                while True:
+                    for params in self.sent:
+                        if fragment in params.get("text", ""):
+                            self.sent.remove(params)
+                            return params
+                    await self._changed.wait()
+        return await asyncio.wait_for(match(), timeout)
+
+    async def handle(self, request):
+        method = request.path_params["method"]
+        params = {k: v[0] for k, v in parse_qs((await request.body()).decode()).items()}
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Compa", "username": "compa_e2e_bot"}
+        elif method == "getUpdates":
+            offset = int(params.get("offset", 0) or 0)
+            timeout = min(float(params.get("timeout", 0) or 0), 1.0)
+            async with self._changed:
+                pending = [u for u in self.updates if u["update_id"] >= offset]
+                if not pending and timeout:
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    pending = [u for u in self.updates if u["update_id"] >= offset]
+            result = pending
+        elif method == "getFile":
+            file_id = params["file_id"]
+            result = {"file_id": file_id, "file_unique_id": file_id,
+                      "file_size": len(self.files[file_id]), "file_path": f"voice/{file_id}"}
+        elif method == "sendMessage":
+            async with self._changed:
+                self.sent.append(params)
+                self._changed.notify_all()
+            result = {
+                "message_id": len(self.sent) + 1000,
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        else:
+            # setMyCommands, deleteWebhook...
+            result = True
+        return JSONResponse({"ok": True, "result": result})
+
+
+class DeviceClient:
+    """Cliente /ws que guarda los frames recibidos por tipo"""
+
+    def __init__(self, url):
+        self.url = url
+        self.ws = None
+        self.frames = []
+        self._changed = asyncio.Condition()
+        self._reader = None
+
+    async def connect(self, device_id=None, device_code=None):
+        self.ws = await websockets.connect(self.url, ping_interval=None)
+        self._reader = asyncio.create_task(self._read())
+        await self.ws.send(json.dumps({
+            "type": "initial_data",
+            "data": {"device_id": device_id, "device_code": device_code},
+        }))
+
+    async def _read(self):
+        try:
+            async for data in self.ws:
+                async with self._changed:
+                    self.frames.append(json.loads(data))
+                    self._changed.notify_all()
+        except websockets.ConnectionClosed:
+            pass
+
+    async def wait_frame(self, frame_type, timeout):
+        async def match():
+            async with self._changed:
+                while True:
+                    for frame in self.frames:
+                        if frame.get("type") == frame_type:
+                            self.frames.remove(frame)
+                            return frame
+                    await self._changed.wait()
+        return await asyncio.wait_for(match(), timeout)
+
+    async def send(self, frame):
+        await self.ws.send(json.dumps(frame))
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self._reader is not None:
+            await self._reader
+
+
+def start_process(command, env, log_path):
+    log = open(log_path, "w", encoding="utf-8")
+    return subprocess.Popen(command, cwd=PROJECT_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def wait_until_up(base_url, process, timeout):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"el servidor web terminó con código {process.returncode}")
+            try:
+                if (await client.get(f"{base_url}/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError("el servidor web no arrancó a tiempo")
+
+
+async def run_scenario(args, api, base_url, steps):
+    timeout = args.timeout
+
+    async def step(label, coro):
+        started = time.perf_counter()
+        result = await coro
+        steps.append((label, time.perf_counter() - started))
+        print(f"✅ {label} ({(time.perf_counter() - started) * 1000:.0f} ms)")
+        return result
+
+    device = DeviceClient(base_url.replace("http://", "ws://") + "/ws")
+    await device.connect()
+    info = await step("device_info por /ws", device.wait_frame("device_info", timeout))
+    device_id, code = info["device_id"], info["device_code"]
+
+    await api.push_command(f"/connect {code}")
+    await step("/connect respondido en Telegram", api.wait_sent("Solicitud enviada", timeout))
+    request = await step("connection_request en el dispositivo", device.wait_frame("connection_request", timeout))
+
+    await device.send({"type": "connection_response", "request_id": request["request_id"], "approved": True})
+    await step("connection_approved en el dispositivo", device.wait_frame("connection_approved", timeout))
+    await step("\"Conexión Aprobada\" en Telegram", api.wait_sent("Conexión Aprobada", timeout))
+
+    await api.push_command(f"/alias {code} Mama")
+    await step("/alias respondido en Telegram", api.wait_sent("Alias actualizado", timeout))
+
+    await api.push_command("/m Mama ¡Hola desde Telegram!")
+    await step("/m respondido en Telegram", api.wait_sent("Mensaje enviado", timeout))
+    await step("new_message_notification en el dispositivo", device.wait_frame("new_message_notification", timeout))
+
+    async with httpx.AsyncClient() as client:
+        response = await client.get(f"{base_url}/family/messages", params={"device_id": device_id})
+        response.raise_for_status()
+        texts = [m["message"] for m in response.json()["messages"]]
+    if "¡Hola desde Telegram!" not in texts:
+        raise AssertionError(f"/family/messages no contiene el mensaje: {texts}")
+    print("✅ mensaje en GET /family/messages")
+
+    # Nota de voz (un solo dispositivo: no hace falta alias) servida por trozos
+    voice = os.urandom(300 * 1024)
+    await api.push_voice(voice)
+    await step("nota de voz respondida en Telegram", api.wait_sent("Nota de voz enviada", timeout))
+    await step("new_message_notification (nota de voz)", device.wait_frame("new_message_notification", timeout))
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        messages = (await client.get("/family/messages", params={"device_id": device_id})).json()["messages"]
+        media = next((m["media"] for m in messages if m.get("media")), None)
+        if not media or media["type"] != "voice" or media["size"] != len(voice):
+            raise AssertionError(f"/family/messages sin la nota de voz: {messages}")
+        partial = await client.get(media["url"], headers={"Range": "bytes=1000-1999"})
+        if partial.status_code != 206 or partial.content != voice[1000:2000]:
+            raise AssertionError(f"Range: {partial.status_code} {partial.headers}")
+        full = await client.get(media["url"])
+        if full.status_code != 200 or full.content != voice or "immutable" not in full.headers["cache-control"]:
+            raise AssertionError(f"GET completo: {full.status_code} {full.headers}")
+        cached = await client.get(media["url"], headers={"If-None-Match": full.headers["etag"]})
+        if cached.status_code != 304:
+            raise AssertionError(f"If-None-Match: {cached.status_code}")
+    print(f"✅ nota de voz servida con Range/ETag ({media['url']})")
+
+    # Con la app cerrada, la notificación espera en el outbox
+    await device.close()
+    await asyncio.sleep(0.5)
+    await api.push_command("/m Mama ¿Has comido?")
+    await step("/m (app cerrada) respondido en Telegram", api.wait_sent("Mensaje enviado", timeout))
+    device = DeviceClient(device.url)
+    await device.connect(device_id, code)
+    await step("notificación entregada al reconectar", device.wait_frame("new_message_notification", timeout))
+    await device.close()
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="compa-e2e-bot-")
+    web_port, api_port = free_port(), free_port()
+    base_url = f"http://127.0.0.1:{web_port}"
+
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(workdir, 'e2e.db')}",
+        "MEMORY_INDEX_DIR": os.path.join(workdir, "memory_index"),
+        "TELEGRAM_BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_BOT_MODE": "worker",
+        "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{api_port}/bot",
+        "TELEGRAM_API_BASE_FILE_URL": f"http://127.0.0.1:{api_port}/file/bot",
+        "MEDIA_DIR": os.path.join(workdir, "media"),
+        "OUTBOX_POLL_SECONDS": "0.2",
+        "PYTHONPATH": PROJECT_ROOT + os.pathsep + env.get("PYTHONPATH", ""),
+        "PYTHONUNBUFFERED": "1",
+    })
+    for key in ("GEMINI_TOKEN", "TWILIO_ACCOUNT_SID"):
+        env.pop(key, None)
+
+    api = FakeTelegramAPI()
+    api_server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=api_port, log_level="warning"))
+    api_task = asyncio.create_task(api_server.serve())
+
+    logs = {"web": os.path.join(workdir, "web.log"), "bot": os.path.join(workdir, "bot.log")}
+    processes = []
+    steps = []
+    ok = False
+    try:
+        # Esquema primero, como en un despliegue (los dos procesos solo lo comprueban)
+        subprocess.run([sys.executable, "-m", "backend.migrations", "upgrade"],
+                       cwd=PROJECT_ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+        processes.append(start_process(
+            [sys.executable, "-m", "uvicorn", "backend.main:app", "--host", "127.0.0.1", "--port", str(web_port),
+             "--ws", "websockets", "--log-level", "warning"],
+            env, logs["web"],
+        ))
+        processes.append(start_process([sys.executable, "-m", "backend.bot_worker"], env, logs["bot"]))
+        await wait_until_up(base_url, processes[0], 60.0)
+        print(f"🚀 Servidor web en {base_url}, bot worker pid {processes[1].pid}")
+
+        await run_scenario(args, api, base_url, steps)
+        ok = True
+    except Exception as e:
+        print(f"\n❌ Prueba fallida: {type(e).__name__}: {e}")
+    finally:
+        for process in processes:
+            stop_process(process)
+        api_server.should_exit = True
+        await api_task
+        if not ok or args.keep_logs:
+            for name, path in logs.items():
+                if os.path.exists(path):
+                    with open(path, encoding="utf-8", errors="replace") as f:
+                        tail = f.readlines()[-40:]
+                    print(f"\n--- {name} ({path}) ---\n" + "".join(tail))
+        if not args.keep_logs:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if ok:
+        print(f"\n✅ Flujo bot worker <-> servidor web correcto ({len(steps)} pasos)")
+    return 0 if ok else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba e2e del bot de Telegram como proceso aparte")
+    parser.add_argument("--timeout", type=float, default=15.0, help="espera máxima por paso (s)")
+    parser.add_argument("--keep-logs", action="store_true", help="muestra y conserva los logs de los procesos")
+    args = parser.parse_args(argv)
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()